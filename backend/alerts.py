@@ -0,0 +1,247 @@
+# alerts.py
+# Stock alert rules, alert state and the change feed behind the push endpoints.
+#
+# evaluate() checks every product against the min/max rules, and against a
+# projected stockout within ALERT_STOCKOUT_DAYS at the forecast usage rate,
+# in one NumPy pass; only alerts that fire get a message built. The dashboard
+# job (scheduler.py) passes each location's result to sync(), which diffs it
+# against that location's active_alerts, appends a 'raised' or 'cleared' row
+# to alert_events for every change and sends a NOTIFY. Dashboards read those events from /alert-events
+# (long-poll) or /alert-stream (Server-Sent Events, ASGI only) instead of
+# polling /stock-status, so they only receive alerts that changed. Events are
+# only recorded where the scheduler runs, in-process or as the sidecar.
+
+import os, select, threading, time
+from operator import itemgetter
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+from db import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER, pooled_connection
+
+STOCKOUT_DAYS = float(os.getenv("ALERT_STOCKOUT_DAYS", "3"))
+EVENT_RETENTION_DAYS = int(os.getenv("ALERT_EVENT_RETENTION_DAYS", "30"))
+MAX_WAIT_SECONDS = float(os.getenv("ALERT_MAX_WAIT_SECONDS", "30"))
+MAX_EVENTS = 500
+
+CHANNEL = "stock_alerts"
+RULES = ('low', 'high', 'stockout')
+
+EVENTS_QUERY = """
+    SELECT id, location_id, product_id, type, event, value, threshold, message, created_at
+    FROM alert_events
+    WHERE location_id = %(location)s AND id > %(after)s
+    ORDER BY id
+    LIMIT %(limit)s;
+"""
+
+LATEST_EVENT_QUERY = "SELECT COALESCE(MAX(id), 0) as id FROM alert_events;"
+
+# One statement so the diff, the state update and the event log can't drift
+# apart: alerts missing from the current set are deleted and logged as
+# cleared, new ones inserted and logged as raised (xmax = 0 tells an insert
+# from an update), and ones still firing just get their value refreshed.
+_SYNC_QUERY = """
+    WITH current AS (
+        SELECT * FROM unnest(%(product_ids)s::varchar[], %(types)s::varchar[], %(values)s::float8[],
+                             %(thresholds)s::float8[], %(messages)s::text[])
+            AS c(product_id, type, value, threshold, message)
+    ),
+    cleared AS (
+        DELETE FROM active_alerts a
+        WHERE a.location_id = %(location)s
+          AND NOT EXISTS (SELECT 1 FROM current c WHERE c.product_id = a.product_id AND c.type = a.type)
+        RETURNING a.product_id, a.type, a.value, a.threshold, a.message
+    ),
+    upserted AS (
+        INSERT INTO active_alerts (location_id, product_id, type, value, threshold, message)
+        SELECT %(location)s, product_id, type, value, threshold, message FROM current
+        ON CONFLICT (location_id, product_id, type) DO UPDATE
+        SET value = EXCLUDED.value, threshold = EXCLUDED.threshold, message = EXCLUDED.message
+        WHERE (active_alerts.value, active_alerts.threshold) IS DISTINCT FROM (EXCLUDED.value, EXCLUDED.threshold)
+        RETURNING product_id, type, value, threshold, message, xmax = 0 as raised
+    )
+    INSERT INTO alert_events (location_id, product_id, type, event, value, threshold, message)
+    SELECT %(location)s, product_id, type, 'cleared', value, threshold, message FROM cleared
+    UNION ALL
+    SELECT %(location)s, product_id, type, 'raised', value, threshold, message FROM upserted WHERE raised
+    RETURNING id, location_id, product_id, type, event, value, threshold, message, created_at;
+"""
+
+
+def _message(rule, product, days_left, usage):
+    if rule == 'low':
+        return f"{product['name']} is below minimum stock ({product['remaining_stock']}/{product['min_stock']})."
+    if rule == 'high':
+        return f"{product['name']} is over maximum stock ({product['remaining_stock']}/{product['max_stock']})."
+    return (f"{product['name']} is projected to run out in {days_left:.1f} days "
+            f"({product['remaining_stock']} left, using about {usage:.1f} {product.get('unit', '')}/day).")
+
+
+def evaluate(products, usage_rates=None):
+    """
+    Evaluates every alert rule over all products at once.
+
+    Args:
+        products: Stock status rows (remaining_stock, min_stock, max_stock, ...).
+        usage_rates: {product id: forecast demand per day}; without it the
+            stockout rule never fires.
+
+    Returns:
+        list: {type, message, product_id, value, threshold} for each alert that
+        fires, in product order. low and high are exclusive; stockout is
+        independent of both.
+    """
+    count = len(products)
+    remaining, min_stock, max_stock = (
+        np.fromiter(map(itemgetter(column), products), dtype=np.int64, count=count)
+        for column in ('remaining_stock', 'min_stock', 'max_stock')
+    )
+    days_left = np.full(count, np.inf)
+    if usage_rates:
+        ids = map(itemgetter('id'), products)
+        usage = np.fromiter((usage_rates.get(product_id, 0.0) for product_id in ids), dtype=float, count=count)
+        np.divide(remaining, usage, out=days_left, where=usage > 0)
+    else:
+        usage = np.zeros(count)
+
+    low = remaining < min_stock
+    high = ~low & (remaining > max_stock)
+    stockout = (remaining > 0) & (days_left < STOCKOUT_DAYS)
+    firing = np.stack([low, high, stockout], axis=1)
+    values = np.stack([remaining, remaining, days_left], axis=1)
+    thresholds = np.stack([min_stock, max_stock, np.full(count, STOCKOUT_DAYS)], axis=1)
+
+    # Gather the firing cells in one go; only the message loop stays in Python.
+    rows, rules = np.nonzero(firing)
+    fired = zip(rows.tolist(), rules.tolist(), values[rows, rules].round(2).tolist(),
+                thresholds[rows, rules].tolist(), days_left[rows].tolist(), usage[rows].tolist())
+    return [
+        {
+            "type": RULES[r],
+            "message": _message(RULES[r], products[i], days, rate),
+            "product_id": products[i]['id'],
+            "value": value,
+            "threshold": threshold,
+        }
+        for i, r, value, threshold, days, rate in fired
+    ]
+
+
+def sync(cur, location, alerts):
+    """
+    Records the transitions between the location's stored alert state and
+    `alerts`, the full set firing there now. Call inside the transaction that
+    read the stock levels, or one that has checked they haven't changed since
+    (scheduler.precompute_location); listeners are notified when it commits.
+
+    Returns:
+        list: the new alert_events rows, oldest first.
+    """
+    cur.execute(_SYNC_QUERY, {
+        "location": location,
+        "product_ids": [a['product_id'] for a in alerts],
+        "types": [a['type'] for a in alerts],
+        "values": [a['value'] for a in alerts],
+        "thresholds": [a['threshold'] for a in alerts],
+        "messages": [a['message'] for a in alerts],
+    })
+    events = sorted((dict(row) for row in cur.fetchall()), key=lambda event: event['id'])
+    if events:
+        cur.execute("SELECT pg_notify(%s, %s);", (CHANNEL, str(events[-1]['id'])))
+    cur.execute(
+        "DELETE FROM alert_events WHERE created_at < CURRENT_TIMESTAMP - %s * interval '1 day';",
+        (EVENT_RETENTION_DAYS,)
+    )
+    return events
+
+
+def fetch_events(cur, location, after, limit=MAX_EVENTS):
+    cur.execute(EVENTS_QUERY, {"location": location, "after": after, "limit": limit})
+    return [dict(row) for row in cur.fetchall()]
+
+def latest_event_id(cur):
+    """The newest event id at any location; a valid `after` for every location's feed."""
+    cur.execute(LATEST_EVENT_QUERY)
+    return cur.fetchone()[0]
+
+def fetch_active(cur, location):
+    """Alerts currently firing at the location, with the id of the last event they reflect."""
+    cur.execute("""
+        SELECT a.product_id, p.name, a.type, a.value, a.threshold, a.message, a.raised_at
+        FROM active_alerts a
+        JOIN products p ON p.id = a.product_id
+        WHERE a.location_id = %s
+        ORDER BY a.raised_at, a.product_id, a.type;
+    """, (location,))
+    active = [dict(row) for row in cur.fetchall()]
+    return active, latest_event_id(cur)
+
+
+# Long-poll support for the Flask routes: one LISTEN connection per process
+# wakes every waiting request, and waiting requests don't hold a pooled
+# connection.
+
+_changed = threading.Event()
+_changed_lock = threading.Lock()
+_listener_pid = None
+
+def _signal_change():
+    global _changed
+    with _changed_lock:
+        changed, _changed = _changed, threading.Event()
+    changed.set()
+
+def _listen_forever():
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CHANNEL};")
+            # Anything committed while we were disconnected is picked up by
+            # the waiters' own re-read.
+            _signal_change()
+            while True:
+                if select.select([conn], [], [], 60) != ([], [], []):
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        _signal_change()
+        except psycopg2.Error as e:
+            print(f"Error in alert listener: {e}")
+            if conn is not None:
+                conn.close()
+            time.sleep(5)
+
+def _start_listener():
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _changed_lock:
+        if _listener_pid != os.getpid():
+            threading.Thread(target=_listen_forever, name="alert-listener", daemon=True).start()
+            _listener_pid = os.getpid()
+
+
+def wait_for_events(location, after, timeout):
+    """
+    Returns the location's events after `after`, waiting up to `timeout`
+    seconds for the next one if there are none yet (an empty list when the
+    wait runs out).
+    """
+    _start_listener()
+    deadline = time.monotonic() + min(timeout, MAX_WAIT_SECONDS)
+    while True:
+        # Taken before the read so a NOTIFY arriving in between still wakes us.
+        changed = _changed
+        with pooled_connection() as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            events = fetch_events(cur, location, after)
+            cur.close()
+            conn.rollback()
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0:
+            return events
+        changed.wait(remaining)
@@ -0,0 +1,247 @@
+# approvals.py
+# Receiving approved invoices into stock, off the request path.
+#
+# save_invoice/update_invoice lock the invoice row, record the approval and
+# call enqueue() in the same transaction, which copies the approved items into
+# stock_applications. The primary key on invoice_id keeps one row per invoice,
+# so concurrent or repeated approvals can't receive the same order twice; an
+# approval while the row is still queued or failed replaces its items, so a
+# corrected invoice is received as corrected. A worker thread in every web process (or `python approvals.py
+# worker`) claims queued invoices with FOR UPDATE SKIP LOCKED, inserts their
+# IN movements with one COPY per invoice location, folds them into that
+# location's ledger and marks them applied, all in one transaction: a crash or error rolls the whole batch back
+# to 'queued', and an invoice is never applied twice. Clients poll
+# /invoice-stock/<id> for the outcome.
+#
+# Usage:
+#   python approvals.py worker         # run the worker in the foreground
+#   python approvals.py retry-failed   # re-queue invoices whose application failed
+
+import argparse, os, sys, threading
+from collections import defaultdict
+
+import psycopg2
+import psycopg2.extras
+
+import cache
+import scheduler
+from db import pooled_connection
+from ledger import apply_movements
+from movements import insert_movements
+
+APPLY_WORKER_ENABLED = os.getenv("APPLY_WORKER_ENABLED", "1") == "1"
+APPLY_BATCH_SIZE = int(os.getenv("APPLY_BATCH_SIZE", "200"))
+APPLY_POLL_SECONDS = float(os.getenv("APPLY_POLL_SECONDS", "1"))
+
+STATUS_QUERY = """
+    SELECT a.invoice_id, a.status, a.attempts, a.movements, a.last_error, a.queued_at, a.applied_at
+    FROM stock_applications a
+    JOIN invoices i ON i.id = a.invoice_id
+    WHERE a.invoice_id = %s AND i.location_id = %s;
+"""
+
+# Invoices whose stock was received before the queue existed (or by datagen).
+BACKFILL_QUERY = """
+    INSERT INTO stock_applications (invoice_id, items, status, movements, queued_at, applied_at)
+    SELECT i.id, COALESCE(i.items, '[]'::jsonb), 'applied', count(m.id), MIN(m.movement_date), MIN(m.movement_date)
+    FROM invoices i
+    JOIN stock_movements m ON m.invoice_id = i.id
+    GROUP BY i.id
+    ON CONFLICT (invoice_id) DO NOTHING;
+"""
+
+_CLAIM_QUERY = """
+    SELECT a.invoice_id, a.items, i.location_id, v.name as vendor_name
+    FROM stock_applications a
+    JOIN invoices i ON i.id = a.invoice_id
+    JOIN vendors v ON v.id = i.vendor_id
+    WHERE a.status = 'queued' {invoice_filter}
+    ORDER BY a.invoice_id
+    LIMIT %(limit)s
+    FOR UPDATE OF a SKIP LOCKED;
+"""
+
+
+def enqueue(cur, location, invoice_id, items):
+    """
+    Queues an approved invoice's items to be received into stock. Call in the
+    approving transaction, with the invoice row locked. An invoice still
+    queued, or failed, is queued again with these items, so a corrected
+    invoice replaces the ones that failed; once applied (even if since
+    un-approved) it is left as it is.
+
+    Returns:
+        dict: the invoice's stock_applications status row.
+    """
+    cur.execute("""
+        INSERT INTO stock_applications (invoice_id, items) VALUES (%s, %s)
+        ON CONFLICT (invoice_id) DO UPDATE SET items = EXCLUDED.items, status = 'queued',
+            last_error = NULL, queued_at = CURRENT_TIMESTAMP
+        WHERE stock_applications.status <> 'applied';
+    """, (invoice_id, psycopg2.extras.Json(items)))
+    return fetch_status(cur, location, invoice_id)
+
+def fetch_status(cur, location, invoice_id):
+    """The invoice's stock_applications row, or None if it isn't queued or belongs to another location."""
+    cur.execute(STATUS_QUERY, (invoice_id, location))
+    row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def _apply_claimed(cur, claimed):
+    """Returns {location: inserted movements}."""
+    by_location = defaultdict(list)
+    for row in claimed:
+        by_location[row['location_id']].append(row)
+    movements = {}
+    # Locations in order, like the products within each, so batches can't deadlock.
+    for location, rows in sorted(by_location.items()):
+        movements[location] = insert_movements(cur, location, [
+            {"product_id": item['id'], "quantity": item['quantity'], "movement_type": 'IN',
+             "description": f"Received from {row['vendor_name']} order #{row['invoice_id']}",
+             "total_cost": item['cost'], "invoice_id": row['invoice_id']}
+            for row in rows for item in row['items']
+        ])
+        apply_movements(cur, location, movements[location])
+        scheduler.invalidate_stock_results(cur, location)
+    cur.execute("""
+        UPDATE stock_applications a
+        SET status = 'applied', applied_at = CURRENT_TIMESTAMP, attempts = attempts + 1, last_error = NULL,
+            movements = jsonb_array_length(a.items)
+        WHERE invoice_id = ANY(%s);
+    """, ([row['invoice_id'] for row in claimed],))
+    return movements
+
+def apply_queued(conn, invoice_ids=None, limit=APPLY_BATCH_SIZE):
+    """
+    Applies up to `limit` queued invoices (or just `invoice_ids`) in one
+    transaction. If the batch fails, each invoice is retried on its own so one
+    bad invoice (say, an item whose product was deleted) is marked failed
+    without holding back the rest.
+
+    Returns:
+        int: invoices applied.
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    invoice_filter = "AND a.invoice_id = ANY(%(invoice_ids)s)" if invoice_ids is not None else ""
+    cur.execute(_CLAIM_QUERY.format(invoice_filter=invoice_filter), {"limit": limit, "invoice_ids": invoice_ids})
+    claimed = cur.fetchall()
+    if not claimed:
+        conn.rollback()
+        cur.close()
+        return 0
+    try:
+        movements = _apply_claimed(cur, claimed)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        if len(claimed) > 1:
+            cur.close()
+            return sum(apply_queued(conn, [row['invoice_id']]) for row in claimed)
+        print(f"Error applying stock for invoice {claimed[0]['invoice_id']}: {e}")
+        # The rollback released the claim, so another worker may have applied
+        # the invoice since; only a row that is still queued is marked failed.
+        cur.execute(
+            "UPDATE stock_applications SET status = 'failed', attempts = attempts + 1, last_error = %s WHERE invoice_id = %s AND status = 'queued';",
+            (str(e).strip(), claimed[0]['invoice_id'])
+        )
+        conn.commit()
+        cur.close()
+        return 0
+    cur.close()
+    for location, inserted in movements.items():
+        cache.invalidate_stock_status(location, inserted)
+    scheduler.request_refresh()
+    return len(claimed)
+
+def drain(conn):
+    """Applies queued invoices batch by batch until none are left. Returns how many were applied."""
+    applied = 0
+    while True:
+        count = apply_queued(conn)
+        if not count:
+            return applied
+        applied += count
+
+def retry_failed(conn):
+    """Re-queues failed invoices, except any whose movements exist (received after all)."""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE stock_applications a SET status = 'queued'
+        WHERE a.status = 'failed'
+          AND NOT EXISTS (SELECT 1 FROM stock_movements m WHERE m.invoice_id = a.invoice_id);
+    """)
+    count = cur.rowcount
+    conn.commit()
+    cur.close()
+    return count
+
+
+# One worker thread per process, woken right away by approvals made here and
+# every APPLY_POLL_SECONDS for those queued by other processes.
+
+_wake = threading.Event()
+_stop = threading.Event()
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+def _work_forever():
+    while not _stop.is_set():
+        _wake.wait(APPLY_POLL_SECONDS)
+        _wake.clear()
+        try:
+            with pooled_connection() as conn:
+                drain(conn)
+        except Exception as e:
+            print(f"Error in stock apply worker: {e}")
+
+def start_worker():
+    """
+    Starts this process's worker when APPLY_WORKER_ENABLED=1. Safe to call on
+    every request; like the scheduler it is per PID.
+    """
+    global _worker, _worker_pid
+    if not APPLY_WORKER_ENABLED or _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid != os.getpid():
+            _stop.clear()
+            _worker = threading.Thread(target=_work_forever, name="stock-apply-worker", daemon=True)
+            _worker.start()
+            _worker_pid = os.getpid()
+
+def stop_worker(timeout=10):
+    """Stops this process's worker, letting a batch in progress commit first."""
+    global _worker, _worker_pid
+    with _worker_lock:
+        if _worker is not None and _worker_pid == os.getpid():
+            _stop.set()
+            _wake.set()
+            _worker.join(timeout)
+        _worker = None
+        _worker_pid = None
+
+def wake():
+    """Asks this process's worker to look at the queue now; call after committing an approval."""
+    _wake.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply approved invoices to stock.")
+    parser.add_argument("command", choices=["worker", "retry-failed"])
+    args = parser.parse_args(argv)
+
+    if args.command == "retry-failed":
+        with pooled_connection() as conn:
+            print(f"Re-queued {retry_failed(conn)} invoices.")
+        return 0
+    try:
+        _work_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
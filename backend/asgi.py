@@ -0,0 +1,357 @@
+# asgi.py
+# Production entry point: uvicorn asgi:app (see the Dockerfile for worker and
+# shutdown settings).
+#
+# The read endpoints that spend their time waiting on Postgres run here as
+# coroutines on psycopg 3's async driver (async_db.py), so one worker keeps
+# hundreds of slow requests in flight without a thread per request. Every
+# other route is the Flask app from server.py behind a WSGI adapter with its
+# own thread pool, so writes, invoice generation and the rest are unchanged.
+# Responses are encoded with Flask's JSON provider, which keeps the JSON
+# identical to what the Flask versions of these routes return. Alert events
+# are pushed from here too (/alert-stream, /alert-events), woken by one LISTEN
+# connection per worker. Each route is scoped to the request's location like
+# its Flask version (locations.from_request).
+
+import asyncio, os, time
+from contextlib import asynccontextmanager
+from datetime import date
+
+from a2wsgi import WSGIMiddleware
+from psycopg.rows import tuple_row
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import alerts
+import approvals
+import async_db
+import cache
+import db
+import forecasting
+import instrumentation
+import locations
+import scheduler
+from ledger import STATUS_QUERY, InvalidSeriesQuery, build_series_query, format_series, parse_series_args
+from movements import (
+    EXPORT_BATCH_SIZE, EXPORT_MIMETYPES, InvalidLogQuery, build_log_query, export_head, export_rows, export_tail,
+    is_paginated, split_page
+)
+from server import INVOICE_LOGS_QUERY, app as flask_app
+
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "10"))
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+
+def _json(payload, status=200):
+    response = flask_app.json.response(payload)
+    return Response(response.get_data(), status_code=status, media_type=response.mimetype)
+
+def _error(message, status=500):
+    return _json({"error": message}, status)
+
+
+async def _cached(request, key, view):
+    """Async counterpart of cache.cached: same keys, ETags and counters as the Flask routes."""
+    if key is None:
+        return await view()
+    entry = await run_in_threadpool(cache.lookup, key)
+    if entry is None:
+        response = await view()
+        if response.status_code != 200:
+            return response
+        entry = await run_in_threadpool(cache.store, key, response.body, response.media_type)
+    body, etag, mimetype = entry
+    headers = {"ETag": f'"{etag}"'}
+    if cache.not_modified(etag, request.headers.get('if-none-match')):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=mimetype, headers=headers)
+
+
+def _instrumented(handler, route):
+    """Records an async route in the same metrics as the Flask routes, under the Flask rule's name."""
+    if not instrumentation.INSTRUMENTATION_ENABLED:
+        return handler
+
+    async def endpoint(request):
+        tokens = instrumentation.begin_request(route)
+        started = time.perf_counter()
+        try:
+            response = await handler(request)
+        except Exception:
+            instrumentation.end_request(tokens, request.method, route, 500, time.perf_counter() - started)
+            raise
+        duration = time.perf_counter() - started
+        stats = instrumentation.end_request(tokens, request.method, route, response.status_code, duration)
+        response.headers['Server-Timing'] = instrumentation.server_timing(stats, duration)
+        return response
+    return endpoint
+
+
+async def _location(request):
+    """The request's location; the known-locations cache loads on a pooled psycopg2 connection."""
+    return await run_in_threadpool(locations.from_request, request.query_params, request.headers)
+
+
+async def _fetch_all(query, params):
+    async with async_db.connection() as conn:
+        cur = await conn.execute(query, params)
+        return await cur.fetchall()
+
+
+async def get_stock_status(request):
+    record_date_str = request.query_params.get('date', date.today().isoformat())
+    try:
+        location = await _location(request)
+    except locations.InvalidLocation as e:
+        return _error(str(e), 400)
+
+    async def view():
+        try:
+            if record_date_str == date.today().isoformat():
+                rows = await _fetch_all(
+                    "SELECT payload FROM precomputed_results WHERE key = %s;",
+                    (scheduler.stock_status_key(location, record_date_str),)
+                )
+                if rows:
+                    return _json(rows[0]['payload'])
+
+            products = await _fetch_all(STATUS_QUERY, {"location": location, "date": record_date_str})
+            usage_rates = None
+            if record_date_str == date.today().isoformat():
+                rows = await _fetch_all(forecasting.USAGE_RATE_QUERY, {
+                    "location": location, "product_ids": [p['id'] for p in products],
+                    "min_observations": forecasting.MIN_OBSERVATIONS
+                })
+                usage_rates = {row['product_id']: row['rate'] for row in rows}
+            return _json({"stockItems": products, "alerts": alerts.evaluate(products, usage_rates)})
+        except Exception as e:
+            print(f"Error fetching stock status: {e}")
+            return _error("Failed to fetch stock status")
+
+    return await _cached(request, cache.stock_status_key(location, request.query_params.get('date')), view)
+
+
+async def get_stock_series(request):
+    try:
+        from_date, to_date, interval, product_ids = parse_series_args(request.query_params)
+        location = await _location(request)
+    except (InvalidSeriesQuery, locations.InvalidLocation) as e:
+        return _error(str(e), 400)
+
+    async def view():
+        try:
+            rows = await _fetch_all(*build_series_query(location, from_date, to_date, interval, product_ids))
+            return _json(format_series(rows, from_date, to_date, interval))
+        except Exception as e:
+            print(f"Error fetching stock series: {e}")
+            return _error("Failed to fetch stock series")
+
+    return await _cached(request, cache.stock_series_key(location, from_date, to_date, interval, product_ids), view)
+
+
+async def get_movement_log(request):
+    """Async version of server.get_movement_log: keyset pages, or a JSON/NDJSON/CSV stream."""
+    try:
+        args = request.query_params
+        location = await _location(request)
+        export_format = args.get('format', 'json')
+        if export_format in ('ndjson', 'csv') or not is_paginated(args):
+            query, params, _ = build_log_query(location, args, paginate=False)
+            export_format = export_format if export_format in EXPORT_MIMETYPES else 'json'
+            return StreamingResponse(_stream_log(query, params, export_format), media_type=EXPORT_MIMETYPES[export_format])
+
+        query, params, limit = build_log_query(location, args)
+        logs, next_cursor = split_page(await _fetch_all(query, params), limit)
+        response = _json(logs)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    except (InvalidLogQuery, locations.InvalidLocation) as e:
+        return _error(str(e), 400)
+    except Exception as e:
+        print(f"Error fetching movement log: {e}")
+        return _error("Failed to fetch movement log")
+
+async def _stream_log(query, params, export_format):
+    async with async_db.connection() as conn:
+        async with conn.cursor(name='movement_log_export', row_factory=tuple_row) as cur:
+            await cur.execute(query, params)
+            yield export_head(export_format)
+            first = True
+            while True:
+                rows = await cur.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield export_rows(rows, export_format, first)
+                first = False
+            yield export_tail(export_format)
+
+
+async def get_vendors(request):
+    async def view():
+        try:
+            return _json(await _fetch_all('SELECT id, name FROM vendors ORDER BY name;', ()))
+        except Exception as e:
+            print(f"Error fetching vendors: {e}")
+            return _error("Failed to fetch vendors")
+
+    return await _cached(request, "vendors", view)
+
+
+async def get_vendor_products(request):
+    vendor_id = request.path_params['vendor_id']
+
+    async def view():
+        try:
+            query = """
+                SELECT p.id, p.name, p.unit, vp.price, vp.bundles
+                FROM products p
+                JOIN vendor_products vp ON p.id = vp.product_id
+                WHERE vp.vendor_id = %s
+                ORDER BY p.name;
+            """
+            return _json(await _fetch_all(query, (vendor_id,)))
+        except Exception as e:
+            print(f"Error fetching vendor products: {e}")
+            return _error("Failed to fetch vendor products")
+
+    return await _cached(request, f"vendor-products:{vendor_id}", view)
+
+
+async def get_invoice_logs(request):
+    invoice_id = request.path_params['invoice_id']
+    try:
+        location = await _location(request)
+    except locations.InvalidLocation as e:
+        return _error(str(e), 400)
+
+    async def view():
+        try:
+            return _json(await _fetch_all(INVOICE_LOGS_QUERY, (invoice_id, location)))
+        except Exception as e:
+            print(f"Error fetching invoice logs: {e}")
+            return _error("Failed to fetch invoice logs")
+
+    return await _cached(request, f"invoice-logs:{location}:{invoice_id}", view)
+
+
+# Replaced (and the old one set) on every NOTIFY, so a waiter that took the
+# current event before reading the log is woken by anything committed after.
+_alerts_changed = asyncio.Event()
+
+async def _listen_for_alerts():
+    global _alerts_changed
+    async for _ in async_db.notifications(alerts.CHANNEL):
+        changed, _alerts_changed = _alerts_changed, asyncio.Event()
+        changed.set()
+
+async def _alert_cursor(after):
+    if after is None:
+        return (await _fetch_all(alerts.LATEST_EVENT_QUERY, ()))[0]['id']
+    return int(after)
+
+async def _fetch_events(location, after):
+    return await _fetch_all(alerts.EVENTS_QUERY, {"location": location, "after": after, "limit": alerts.MAX_EVENTS})
+
+
+async def get_alert_events(request):
+    """Async version of server.get_alert_events: the long-poll waits as a coroutine, not a thread."""
+    try:
+        location = await _location(request)
+        after = await _alert_cursor(request.query_params.get('after'))
+        wait = min(float(request.query_params.get('wait', 0)), alerts.MAX_WAIT_SECONDS)
+    except locations.InvalidLocation as e:
+        return _error(str(e), 400)
+    except ValueError:
+        return _error("Invalid 'after' or 'wait'", 400)
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            changed = _alerts_changed
+            events = await _fetch_events(location, after)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return _json({"events": events, "lastEventId": events[-1]['id'] if events else after})
+    except Exception as e:
+        print(f"Error fetching alert events: {e}")
+        return _error("Failed to fetch alert events")
+
+
+async def stream_alert_events(request):
+    """
+    Server-Sent Events feed of alert transitions. Each event's id is its
+    alert_events id, so a reconnecting EventSource resumes from Last-Event-ID;
+    a new one starts from the latest event (or ?after=).
+    """
+    try:
+        location = await _location(request)
+        after = await _alert_cursor(request.headers.get('last-event-id') or request.query_params.get('after'))
+    except locations.InvalidLocation as e:
+        return _error(str(e), 400)
+    except ValueError:
+        return _error("Invalid 'after'", 400)
+
+    async def events():
+        nonlocal after
+        while True:
+            changed = _alerts_changed
+            for event in await _fetch_events(location, after):
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {flask_app.json.dumps(event)}\n\n"
+                after = event['id']
+            try:
+                await asyncio.wait_for(changed.wait(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+
+    # X-Accel-Buffering stops nginx from holding events back.
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def get_async_pool_stats(request):
+    """Reports async connection pool usage for this worker process."""
+    return _json({"pid": os.getpid(), **async_db.metrics()})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await async_db.open_pool()
+    scheduler.start()
+    approvals.start_worker()
+    listener = asyncio.create_task(_listen_for_alerts())
+    yield
+    listener.cancel()
+    # Runs once the server has stopped accepting requests and in-flight ones
+    # have finished (or the graceful shutdown timeout ran out).
+    scheduler.shutdown()
+    await run_in_threadpool(approvals.stop_worker)
+    await async_db.close_pool()
+    db.close_pool()
+
+
+app = Starlette(
+    routes=[
+        Route('/stock-status', _instrumented(get_stock_status, '/stock-status'), methods=['GET']),
+        Route('/stock-series', _instrumented(get_stock_series, '/stock-series'), methods=['GET']),
+        Route('/movement-log', _instrumented(get_movement_log, '/movement-log'), methods=['GET']),
+        Route('/vendors', _instrumented(get_vendors, '/vendors'), methods=['GET']),
+        Route('/vendor-products/{vendor_id}', _instrumented(get_vendor_products, '/vendor-products/<vendor_id>'), methods=['GET']),
+        Route('/invoice-logs/{invoice_id:int}', _instrumented(get_invoice_logs, '/invoice-logs/<int:invoice_id>'), methods=['GET']),
+        Route('/alert-events', _instrumented(get_alert_events, '/alert-events'), methods=['GET']),
+        Route('/alert-stream', stream_alert_events, methods=['GET']),
+        Route('/async-pool-stats', get_async_pool_stats, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=WSGI_THREADS)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                           expose_headers=['X-Next-Cursor'])],
+    lifespan=lifespan,
+)
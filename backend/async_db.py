@@ -0,0 +1,92 @@
+# async_db.py
+# Connection pool for the async routes in asgi.py, on psycopg 3's asyncio driver.
+#
+# Separate from the psycopg2 pool in db.py, which the synchronous Flask routes
+# keep using. A request waiting here for a connection is a suspended coroutine
+# rather than a blocked thread, so the pool can be small while many requests
+# are in flight.
+
+import asyncio, os
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from db import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from instrumentation import INSTRUMENTATION_ENABLED, instrument_async_connection
+
+ASYNC_POOL_MIN_SIZE = int(os.getenv("ASYNC_DB_POOL_MIN", "1"))
+# Per worker process, on top of db.py's pool; see docker-compose.yml for the total.
+ASYNC_POOL_MAX_SIZE = int(os.getenv("ASYNC_DB_POOL_MAX", "16"))
+ASYNC_POOL_TIMEOUT = float(os.getenv("ASYNC_DB_POOL_TIMEOUT", "30"))
+
+_CONNECT_KWARGS = {
+    "dbname": DB_NAME, "user": DB_USER, "password": DB_PASS, "host": DB_HOST, "port": DB_PORT,
+    # psycopg 3 returns bytes for text columns of SQL_ASCII databases unless
+    # told which encoding to decode with.
+    "client_encoding": "utf8", "row_factory": dict_row,
+}
+
+_pool = None
+
+
+async def _configure(conn):
+    instrument_async_connection(conn)
+
+
+async def open_pool():
+    """Creates and opens the pool; called once per worker from the ASGI lifespan."""
+    global _pool
+    _pool = AsyncConnectionPool(
+        kwargs=_CONNECT_KWARGS,
+        min_size=ASYNC_POOL_MIN_SIZE, max_size=ASYNC_POOL_MAX_SIZE, timeout=ASYNC_POOL_TIMEOUT,
+        configure=_configure if INSTRUMENTATION_ENABLED else None, open=False
+    )
+    await _pool.open()
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def connection():
+    """
+    Usage: async with connection() as conn. Rows come back as dicts. The
+    connection's transaction is ended when it goes back to the pool.
+    """
+    return _pool.connection()
+
+
+async def notifications(channel):
+    """
+    Yields the payload of every NOTIFY on channel, from a dedicated connection
+    outside the pool (it is busy for as long as the listener runs). Reconnects
+    after connection errors and yields None once reconnected, since anything
+    sent in between was missed.
+    """
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(**_CONNECT_KWARGS, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {channel};")
+                yield None
+                async for notify in conn.notifies():
+                    yield notify.payload
+        except psycopg.OperationalError as e:
+            print(f"Error listening on {channel}: {e}")
+            await asyncio.sleep(5)
+
+
+def metrics():
+    stats = _pool.get_stats()
+    return {
+        "minSize": stats["pool_min"],
+        "maxSize": stats["pool_max"],
+        "size": stats["pool_size"],
+        "idle": stats["pool_available"],
+        "waiting": stats["requests_waiting"],
+        "checkouts": stats.get("requests_num", 0),
+        "checkoutFailures": stats.get("requests_errors", 0),
+        "waitTimeTotalMs": stats.get("requests_wait_ms", 0),
+    }
@@ -0,0 +1,373 @@
+# bench.py
+# Endpoint and function benchmarks with results saved as JSON.
+#
+# Endpoints are called in-process through Flask's test client by default, so
+# the database round trips each request makes can be counted, or over HTTP
+# against a running server with --url. The response cache, scheduler and apply
+# worker are disabled during in-process runs so every call measures the real
+# query path, and only the benchmark thread's queries are counted. Load a bigger
+# dataset with datagen.py first; the seed data is too small to show much.
+# Everything runs against DEFAULT_LOCATION.
+#
+# Usage:
+#   python bench.py run --output before.json
+#   python bench.py run --url http://localhost:5001 --concurrency 20 --output asgi.json
+#   python bench.py compare before.json after.json
+
+import argparse, json, platform, subprocess, sys, threading, time, timeit
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import psycopg2.extensions
+import psycopg2.extras
+
+import db
+from db import pooled_connection
+from ledger import fetch_stock_status
+from locations import DEFAULT_LOCATION
+
+
+class _QueryCounter:
+    """
+    Counts the statements, COPYs, commits and rollbacks that the thread which
+    entered it sends over pool connections (see _CountingConnection), so work
+    done on other threads or connections isn't attributed to the benchmark.
+    """
+
+    active = None
+
+    def __init__(self):
+        self.count = 0
+        self._thread = None
+
+    def record(self):
+        if threading.get_ident() == self._thread:
+            self.count += 1
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        _QueryCounter.active = self
+        return self
+
+    def __exit__(self, *exc):
+        _QueryCounter.active = None
+
+
+def _record_round_trip():
+    counter = _QueryCounter.active
+    if counter is not None:
+        counter.record()
+
+
+class _CountingCursorMixin:
+    def execute(self, *args, **kwargs):
+        _record_round_trip()
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _record_round_trip()
+        return super().executemany(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        _record_round_trip()
+        return super().copy_expert(*args, **kwargs)
+
+
+_counting_cursor_classes = {}
+
+class _CountingConnection(db.CONNECTION_FACTORY):
+    """Pool connection whose cursors, commits and rollbacks report to the active _QueryCounter."""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        if base not in _counting_cursor_classes:
+            _counting_cursor_classes[base] = type('Counting' + base.__name__, (_CountingCursorMixin, base), {})
+        kwargs['cursor_factory'] = _counting_cursor_classes[base]
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        _record_round_trip()
+        return super().commit()
+
+    def rollback(self):
+        _record_round_trip()
+        return super().rollback()
+
+
+def _prepare_in_process():
+    """
+    Keeps the app's background threads from running queries during in-process
+    runs, and opens the pool with counting connections. Call before the pool
+    is first used.
+    """
+    import approvals, scheduler
+    scheduler.SCHEDULER_ENABLED = False
+    approvals.APPLY_WORKER_ENABLED = False
+    db.CONNECTION_FACTORY = _CountingConnection
+
+
+def _percentiles(latencies_ms):
+    latencies = np.asarray(latencies_ms)
+    return {
+        "p50Ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95Ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99Ms": round(float(np.percentile(latencies, 99)), 3),
+        "meanMs": round(float(latencies.mean()), 3),
+        "maxMs": round(float(latencies.max()), 3),
+    }
+
+
+def _scenarios(conn):
+    """(name, method, path, json body) for each endpoint benchmark, built from the data in the database."""
+    today = date.today()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    stock_items = fetch_stock_status(cur, DEFAULT_LOCATION, today.isoformat())
+    cur.execute(
+        "SELECT product_id FROM stock_movements WHERE location_id = %s GROUP BY product_id ORDER BY count(*) DESC LIMIT 1;",
+        (DEFAULT_LOCATION,)
+    )
+    busiest = cur.fetchone()
+    cur.execute("SELECT vendor_id FROM vendor_products GROUP BY vendor_id ORDER BY count(*) DESC LIMIT 1;")
+    biggest_vendor = cur.fetchone()
+    cur.close()
+    conn.rollback()
+
+    for item in stock_items:
+        item['remaining_stock'] = int(item['remaining_stock'])
+    scenarios = [
+        ("stock-status", "GET", "/stock-status", None),
+        ("stock-status-past", "GET", f"/stock-status?date={today - timedelta(days=180)}", None),
+        ("stock-series", "GET", f"/stock-series?from={today - timedelta(days=89)}&to={today}", None),
+        ("stock-series-weekly", "GET", f"/stock-series?from={today - timedelta(days=364)}&to={today}&interval=week", None),
+        ("movement-log", "GET", "/movement-log?limit=500", None),
+        ("vendors", "GET", "/vendors", None),
+        ("spending-by-vendor", "GET", f"/spending-by-vendor?from={today - timedelta(days=364)}&to={today}&interval=month", None),
+        ("generate-invoice", "POST", "/generate-invoice", {"stockItems": stock_items}),
+        ("generate-invoice-basket", "POST", "/generate-invoice",
+         {"stockItems": stock_items, "optimizationMode": "basket", "timeBudgetMs": 2000}),
+        ("reorder-suggestions", "GET", "/reorder-suggestions", None),
+    ]
+    if busiest:
+        scenarios.append((
+            "movement-log-product", "GET",
+            f"/movement-log?productId={busiest[0]}&from={today - timedelta(days=90)}&limit=500", None
+        ))
+    if biggest_vendor:
+        scenarios.append(("vendor-products", "GET", f"/vendor-products/{biggest_vendor[0]}", None))
+    return scenarios
+
+
+def _in_process_caller(method, path, body):
+    import cache
+    from server import app
+    cache.set_backend(cache.MemoryBackend(max_entries=0))
+
+    def call():
+        response = app.test_client().open(path, method=method, json=body)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+    return call
+
+
+def _http_caller(base_url, method, path, body):
+    data = json.dumps(body).encode() if body is not None else None
+
+    def call():
+        request = urllib.request.Request(
+            base_url.rstrip('/') + path, data=data, method=method,
+            headers={"Content-Type": "application/json"} if data else {}
+        )
+        with urllib.request.urlopen(request, timeout=120) as response:
+            response.read()
+    return call
+
+
+def bench_endpoint(call, iterations, concurrency, warmup=2, count_queries=False):
+    """
+    Runs call() `iterations` times from `concurrency` threads and reports
+    latency and throughput, plus queries per request for single-threaded
+    in-process runs when count_queries is set.
+    """
+    for _ in range(warmup):
+        call()
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def timed(_):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception as e:
+            with lock:
+                errors += 1
+            print(f"Error during benchmark: {e}", file=sys.stderr)
+            return
+        with lock:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    counter = _QueryCounter() if count_queries and concurrency == 1 else None
+    started = time.perf_counter()
+    if counter:
+        with counter:
+            for i in range(iterations):
+                timed(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    result = {"requests": len(latencies), "errors": errors, "throughput": round(len(latencies) / elapsed, 2)}
+    if latencies:
+        result.update(_percentiles(latencies))
+    if counter:
+        result["queriesPerRequest"] = round(counter.count / iterations, 2)
+    return result
+
+
+def bench_functions(conn, repeat=5):
+    """Micro-benchmarks of the pricing, ordering and alerting functions on the current data."""
+    from optimization import _calculate_item_cost, _calculate_offer_costs, _load_vendor_offers, _price_offers
+    from prediction import calculate_orders
+    from report import generate_stock_alerts
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    products = fetch_stock_status(cur, DEFAULT_LOCATION, date.today().isoformat())
+    cur.close()
+    offers = _load_vendor_offers([p['id'] for p in products], conn)
+    conn.rollback()
+    quantities = np.random.default_rng(0).integers(1, 500, size=len(offers))
+    prices = offers['price'].astype(float).to_numpy()
+    pricing = list(zip(offers['price'], offers['bundles']))
+    order_amounts = dict(zip(offers['product_id'], quantities.tolist()))
+
+    cases = {
+        "_calculate_item_cost": (lambda: [_calculate_item_cost(int(q), p) for q, p in zip(quantities, pricing)], len(offers)),
+        "_calculate_offer_costs": (lambda: _calculate_offer_costs(quantities, prices, offers['bundles']), len(offers)),
+        "_price_offers": (lambda: _price_offers(order_amounts, conn, []), len(offers)),
+        "calculate_orders": (lambda: calculate_orders(products, conn, DEFAULT_LOCATION), len(products)),
+        "generate_stock_alerts": (lambda: generate_stock_alerts(products, location=DEFAULT_LOCATION), len(products)),
+    }
+    results = {}
+    for name, (func, size) in cases.items():
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        runs = np.array(timer.repeat(repeat=repeat, number=number)) / number * 1000
+        results[name] = {
+            "inputSize": size,
+            "bestMs": round(float(runs.min()), 4),
+            "medianMs": round(float(np.median(runs)), 4),
+            "perItemUs": round(float(runs.min()) * 1000 / size, 4) if size else None,
+        }
+        conn.rollback()
+    return results
+
+
+def _dataset(conn):
+    cur = conn.cursor()
+    counts = {}
+    for table in ("products", "vendors", "vendor_products", "invoices", "stock_movements", "stock_history"):
+        cur.execute(f"SELECT count(*) FROM {table};")
+        counts[table] = cur.fetchone()[0]
+    cur.close()
+    conn.rollback()
+    return counts
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(iterations=20, concurrency=1, url=None, only=None, functions=True):
+    if not url:
+        _prepare_in_process()
+    with pooled_connection() as conn:
+        scenarios = _scenarios(conn)
+        report = {
+            "meta": {
+                "startedAt": datetime.now().isoformat(timespec='seconds'),
+                "commit": _git_commit(),
+                "mode": f"http {url}" if url else "in-process",
+                "iterations": iterations,
+                "concurrency": concurrency,
+                "python": platform.python_version(),
+                "dataset": _dataset(conn),
+            },
+            "endpoints": {},
+        }
+        for name, method, path, body in scenarios:
+            if only and name not in only:
+                continue
+            call = _http_caller(url, method, path, body) if url else _in_process_caller(method, path, body)
+            report["endpoints"][name] = bench_endpoint(call, iterations, concurrency, count_queries=not url)
+            print(f"{name:<26}{report['endpoints'][name].get('p50Ms', '-'):>10} ms p50", file=sys.stderr)
+        if functions:
+            report["functions"] = bench_functions(conn)
+    return report
+
+
+def compare(before, after, threshold=0.1):
+    """
+    Prints metric changes between two reports.
+
+    Returns:
+        list: (section, name, metric, before, after) for metrics that got worse by more than threshold.
+    """
+    regressions = []
+    sections = (("endpoints", ("p50Ms", "p95Ms", "p99Ms", "queriesPerRequest")), ("functions", ("bestMs", "medianMs")))
+    print(f"{'':<40}{'metric':<20}{'before':>12}{'after':>12}{'change':>10}")
+    for section, metrics in sections:
+        for name in sorted(set(before.get(section, {})) & set(after.get(section, {}))):
+            for metric in metrics:
+                old, new = before[section][name].get(metric), after[section][name].get(metric)
+                if old is None or new is None:
+                    continue
+                change = (new - old) / old if old else 0.0
+                flag = ""
+                if change > threshold:
+                    flag = "  REGRESSION"
+                    regressions.append((section, name, metric, old, new))
+                print(f"{section + '/' + name:<40}{metric:<20}{old:>12}{new:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark API endpoints and hot functions.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run")
+    run_parser.add_argument("--iterations", type=int, default=20, help="requests per endpoint")
+    run_parser.add_argument("--concurrency", type=int, default=1, help="parallel requests (query counts need 1)")
+    run_parser.add_argument("--url", help="benchmark a running server instead of calling the app in-process")
+    run_parser.add_argument("--only", action="append", help="endpoint scenario to run (repeatable)")
+    run_parser.add_argument("--skip-functions", action="store_true")
+    run_parser.add_argument("--output", help="write the JSON report to this file (default: stdout)")
+    compare_parser = sub.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        return 1 if compare(before, after, args.threshold) else 0
+
+    report = run(args.iterations, args.concurrency, args.url, args.only, not args.skip_functions)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
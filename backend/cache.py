@@ -0,0 +1,286 @@
+# cache.py
+# Response cache for read endpoints whose data rarely changes.
+#
+# Views opt in with @cached(key_func). Successful responses are stored with an
+# ETag so that clients sending If-None-Match get a 304 without a body, and the
+# write routes invalidate exactly the keys their change affects. With one
+# worker process the default backend is an in-process TTL/LRU map; with more
+# (UVICORN_WORKERS > 1) it is RESPONSE_CACHE_BACKEND=postgres, which keeps
+# entries in an UNLOGGED table so that all workers share them (and see each
+# other's invalidations), over a small pool of its own: a
+# request already holds a connection from the main pool when its response is
+# stored, so taking a second one from there could exhaust it. Other backends
+# can be plugged in with set_backend().
+
+import hashlib, os, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from functools import wraps
+
+from flask import make_response, request
+from werkzeug.http import parse_etags
+
+import db
+
+# Worker processes serving the app; uvicorn reads UVICORN_WORKERS itself.
+WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "postgres" if WORKERS > 1 else "memory")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_POOL_MAX = int(os.getenv("RESPONSE_CACHE_POOL_MAX", "2"))
+
+
+class MemoryBackend:
+    """Thread-safe LRU map with a per-entry expiry time."""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys):
+        with self._lock:
+            return sum(self._entries.pop(key, None) is not None for key in keys)
+
+    def delete_prefix(self, prefix, min_suffix=None):
+        """Deletes keys starting with prefix (and, if given, whose remainder sorts >= min_suffix)."""
+        with self._lock:
+            doomed = [
+                key for key in self._entries
+                if key.startswith(prefix) and (min_suffix is None or key[len(prefix):] >= min_suffix)
+            ]
+            for key in doomed:
+                del self._entries[key]
+            return len(doomed)
+
+    def size(self):
+        return len(self._entries)
+
+
+class PostgresBackend:
+    """Shares entries between worker processes through the response_cache table."""
+
+    evictions = 0
+
+    def __init__(self, max_connections=RESPONSE_CACHE_POOL_MAX):
+        self.max_connections = max_connections
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    @contextmanager
+    def _connection(self):
+        """A connection from this backend's own pool (per PID, like db.get_pool)."""
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = db.ConnectionPool(
+                        0, self.max_connections, db.POOL_TIMEOUT,
+                        dbname=db.DB_NAME, user=db.DB_USER, password=db.DB_PASS, host=db.DB_HOST, port=db.DB_PORT
+                    )
+                    self._pool_pid = os.getpid()
+        pool = self._pool
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+
+    def get(self, key):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT body, etag, mimetype FROM response_cache WHERE key = %s AND expires_at > CURRENT_TIMESTAMP;",
+                (key,)
+            )
+            row = cur.fetchone()
+            cur.close()
+        return (bytes(row[0]), row[1], row[2]) if row else None
+
+    def set(self, key, value, ttl):
+        body, etag, mimetype = value
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO response_cache (key, body, etag, mimetype, expires_at)
+                VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + %s * interval '1 second')
+                ON CONFLICT (key) DO UPDATE SET body = EXCLUDED.body, etag = EXCLUDED.etag,
+                    mimetype = EXCLUDED.mimetype, expires_at = EXCLUDED.expires_at;
+            """, (key, body, etag, mimetype, ttl))
+            cur.execute("DELETE FROM response_cache WHERE expires_at <= CURRENT_TIMESTAMP;")
+            self.evictions += cur.rowcount
+            conn.commit()
+            cur.close()
+
+    def delete(self, keys):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM response_cache WHERE key = ANY(%s);", (list(keys),))
+            count = cur.rowcount
+            conn.commit()
+            cur.close()
+        return count
+
+    def delete_prefix(self, prefix, min_suffix=None):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "DELETE FROM response_cache WHERE starts_with(key, %s) AND (%s IS NULL OR substr(key, %s) >= %s);",
+                (prefix, min_suffix, len(prefix) + 1, min_suffix)
+            )
+            count = cur.rowcount
+            conn.commit()
+            cur.close()
+        return count
+
+    def size(self):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT count(*) FROM response_cache WHERE expires_at > CURRENT_TIMESTAMP;")
+            count = cur.fetchone()[0]
+            cur.close()
+        return count
+
+
+_BACKENDS = {"memory": MemoryBackend, "postgres": PostgresBackend}
+_backend = _BACKENDS[RESPONSE_CACHE_BACKEND]()
+if isinstance(_backend, MemoryBackend) and WORKERS > 1:
+    # Each worker would keep its own entries, and a write only clears those of
+    # the worker that served it; the rest go on serving stale bodies (and
+    # confirming them with 304s) until RESPONSE_CACHE_TTL runs out.
+    print(f"Warning: RESPONSE_CACHE_BACKEND=memory with UVICORN_WORKERS={WORKERS}; "
+          "invalidations won't reach the other workers. Use RESPONSE_CACHE_BACKEND=postgres.")
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "notModified": 0, "invalidations": 0}
+
+
+def set_backend(backend):
+    """
+    Replaces the cache backend (any object with get/set/delete/delete_prefix/size).
+    With several worker processes it must be shared between them.
+    """
+    global _backend
+    _backend = backend
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def lookup(key):
+    """Returns the (body, etag, mimetype) entry stored under key, or None."""
+    entry = _backend.get(key)
+    _count("hits" if entry is not None else "misses")
+    return entry
+
+def store(key, body, mimetype, ttl=None):
+    entry = (body, hashlib.sha1(body).hexdigest(), mimetype)
+    _backend.set(key, entry, RESPONSE_CACHE_TTL if ttl is None else ttl)
+    return entry
+
+def not_modified(etag, if_none_match):
+    """True if an If-None-Match header value matches etag."""
+    if parse_etags(if_none_match).contains(etag):
+        _count("notModified")
+        return True
+    return False
+
+
+def _conditional(body, etag, mimetype):
+    if not_modified(etag, request.headers.get('If-None-Match')):
+        response = make_response('', 304)
+    else:
+        response = make_response(body)
+        response.mimetype = mimetype
+    response.set_etag(etag)
+    return response
+
+
+def cached(key_func, ttl=None):
+    """
+    Caches a GET view's successful responses under key_func(**view_args).
+    key_func may return None to bypass the cache for a particular request.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = key_func(**kwargs)
+            if key is None:
+                return view(*args, **kwargs)
+
+            entry = lookup(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = store(key, response.get_data(), response.mimetype, ttl)
+            return _conditional(*entry)
+        return wrapper
+    return decorator
+
+
+def invalidate(*keys):
+    if keys:
+        _count("invalidations", _backend.delete(keys))
+
+def invalidate_prefix(prefix, min_suffix=None):
+    _count("invalidations", _backend.delete_prefix(prefix, min_suffix))
+
+
+def stock_status_key(location, record_date=None):
+    """Cache key for a past date's stock status at a location; None (don't cache) for today, future or bad dates."""
+    try:
+        record_date = date.fromisoformat(record_date or '')
+    except ValueError:
+        return None
+    return f"stock-status:{location}:{record_date}" if record_date < date.today() else None
+
+def stock_series_key(location, from_date, to_date, interval, product_ids=None):
+    """Cache key for a stock series that ends before today; None otherwise. The end date follows the location so invalidation can range over it."""
+    if to_date >= date.today():
+        return None
+    products = hashlib.sha1(",".join(product_ids).encode()).hexdigest() if product_ids else "all"
+    return f"stock-series:{location}:{to_date}:{from_date}:{interval}:{products}"
+
+def invalidate_stock_status(location, movements):
+    """Drops the location's cached stock status of every date, and every series ending, on or after the earliest movement."""
+    if movements:
+        earliest = min(movement[3] for movement in movements).isoformat()
+        invalidate_prefix(f"stock-status:{location}:", earliest)
+        invalidate_prefix(f"stock-series:{location}:", earliest)
+
+
+def metrics():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats.update({
+        "backend": type(_backend).__name__,
+        "entries": _backend.size(),
+        "evictions": _backend.evictions,
+        "hitRate": round(stats["hits"] / lookups, 4) if lookups else 0,
+    })
+    return stats
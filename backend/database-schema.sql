@@ -1,17 +1,39 @@
 -- This script completely resets and initializes the database.
 
+DROP TABLE IF EXISTS stock_ledger_locks;
+DROP TABLE IF EXISTS stock_applications;
+DROP TABLE IF EXISTS price_index_pruned;
+DROP TABLE IF EXISTS price_index_changes;
+DROP TABLE IF EXISTS spending_daily_product;
+DROP TABLE IF EXISTS spending_daily_vendor;
+DROP TABLE IF EXISTS alert_events;
+DROP TABLE IF EXISTS active_alerts;
 DROP TABLE IF EXISTS invoice_status_logs;
+DROP TABLE IF EXISTS ingest_batches;
+DROP TABLE IF EXISTS response_cache;
+DROP TABLE IF EXISTS precomputed_results;
+DROP TABLE IF EXISTS scheduled_job_runs;
+DROP TABLE IF EXISTS demand_forecasts;
 DROP TABLE IF EXISTS stock_movements;
 DROP TABLE IF EXISTS invoices;
 DROP TABLE IF EXISTS stock_history;
 DROP TABLE IF EXISTS vendor_products;
 DROP TABLE IF EXISTS vendors;
 DROP TABLE IF EXISTS products;
+DROP TABLE IF EXISTS locations;
 
 -- =================================================================
 -- CREATE TABLES
 -- =================================================================
 
+CREATE TABLE locations (
+    id VARCHAR(32) PRIMARY KEY CHECK (id ~ '^[a-z0-9_]{1,32}$'),
+    name VARCHAR(255) NOT NULL,
+    -- Bumped by every ledger write at the location (ledger.apply_movements).
+    ledger_version BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE products (
     id VARCHAR(255) PRIMARY KEY,
     name VARCHAR(255) NOT NULL,
@@ -44,17 +66,26 @@ CREATE TABLE vendor_products (
     FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
 );
 
+-- One LIST partition per location (see create_location_partitions below).
 CREATE TABLE stock_history (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
+    location_id VARCHAR(32) NOT NULL,
     product_id VARCHAR(255) NOT NULL,
     record_date DATE NOT NULL,
     remaining_stock INT NOT NULL,
-    UNIQUE(product_id, record_date),
+    daily_in INT NOT NULL DEFAULT 0,
+    daily_out INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (location_id, id),
+    UNIQUE (location_id, product_id, record_date),
+    FOREIGN KEY (location_id) REFERENCES locations(id),
     FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
-);
+) PARTITION BY LIST (location_id);
+
+CREATE INDEX idx_stock_history_date ON stock_history (record_date) INCLUDE (product_id, daily_in, daily_out);
 
 CREATE TABLE invoices (
     id SERIAL PRIMARY KEY,
+    location_id VARCHAR(32) NOT NULL,
     invoice_date DATE NOT NULL DEFAULT CURRENT_DATE,
     vendor_id VARCHAR(255) NOT NULL,
     status VARCHAR(50) DEFAULT 'Pending',
@@ -62,20 +93,71 @@ CREATE TABLE invoices (
     items JSONB,
     total_cost DECIMAL(10, 2),
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (location_id) REFERENCES locations(id),
     FOREIGN KEY (vendor_id) REFERENCES vendors(id)
 );
 
+CREATE INDEX idx_invoices_location_date ON invoices (location_id, invoice_date);
+
+-- One LIST partition per location, each split into monthly RANGE partitions
+-- on movement_date plus a default partition (see create_movement_partition).
 CREATE TABLE stock_movements (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
+    location_id VARCHAR(32) NOT NULL,
     product_id VARCHAR(255) NOT NULL,
     quantity INT NOT NULL,
     total_cost NUMERIC(10, 2) DEFAULT 0,
     movement_type VARCHAR(50) NOT NULL,
     description TEXT,
-    movement_date TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    movement_date TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    invoice_id INT,
+    PRIMARY KEY (movement_date, id, location_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
+    FOREIGN KEY (invoice_id) REFERENCES invoices(id) ON DELETE SET NULL
+) PARTITION BY LIST (location_id);
+
+CREATE INDEX idx_stock_movements_product_date ON stock_movements (product_id, movement_date);
+CREATE INDEX idx_stock_movements_invoice ON stock_movements (invoice_id);
+
+CREATE TABLE stock_ledger_locks (
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    PRIMARY KEY (location_id, product_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE,
     FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
 );
 
+CREATE OR REPLACE FUNCTION create_location_partitions(p_location VARCHAR) RETURNS void AS $$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF stock_movements FOR VALUES IN (%L) PARTITION BY RANGE (movement_date)',
+                   'stock_movements_' || p_location, p_location);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I DEFAULT',
+                   'stock_movements_' || p_location || '_default', 'stock_movements_' || p_location);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF stock_history FOR VALUES IN (%L)',
+                   'stock_history_' || p_location, p_location);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION create_movement_partition(p_location VARCHAR, p_month DATE) RETURNS boolean AS $$
+DECLARE
+    parent TEXT := 'stock_movements_' || p_location;
+    part TEXT := parent || '_' || to_char(p_month, 'YYYYMM');
+    month_start TIMESTAMP WITH TIME ZONE := date_trunc('month', p_month::timestamp with time zone);
+    month_end TIMESTAMP WITH TIME ZONE := date_trunc('month', p_month::timestamp with time zone) + interval '1 month';
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('movement-partitions:' || p_location));
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE stock_movements INCLUDING DEFAULTS)', part);
+    EXECUTE format('WITH moved AS (DELETE FROM %I WHERE movement_date >= %L AND movement_date < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                   parent || '_default', month_start, month_end, part);
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, part, month_start, month_end);
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
 CREATE TABLE invoice_status_logs (
     id SERIAL PRIMARY KEY,
     invoice_id INT NOT NULL,
@@ -86,10 +168,182 @@ CREATE TABLE invoice_status_logs (
     FOREIGN KEY (invoice_id) REFERENCES invoices(id) ON DELETE CASCADE
 );
 
+CREATE TABLE demand_forecasts (
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    fitted_through DATE NOT NULL,
+    level DOUBLE PRECISION NOT NULL,
+    seasonal DOUBLE PRECISION[] NOT NULL,
+    residual_var DOUBLE PRECISION NOT NULL,
+    observations INT NOT NULL,
+    horizon_days INT NOT NULL,
+    forecast DOUBLE PRECISION NOT NULL,
+    safety_stock DOUBLE PRECISION NOT NULL,
+    prediction INT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (location_id, product_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+CREATE TABLE precomputed_results (
+    key VARCHAR(255) PRIMARY KEY,
+    payload JSONB NOT NULL,
+    computed_for DATE NOT NULL,
+    computed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE scheduled_job_runs (
+    job_id VARCHAR(255) PRIMARY KEY,
+    last_started_at TIMESTAMP WITH TIME ZONE,
+    last_finished_at TIMESTAMP WITH TIME ZONE,
+    last_duration_ms DOUBLE PRECISION,
+    last_status VARCHAR(50),
+    last_error TEXT,
+    runs INT NOT NULL DEFAULT 0,
+    failures INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE ingest_batches (
+    idempotency_key VARCHAR(255) PRIMARY KEY,
+    response JSONB,
+    received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_ingest_batches_received_at ON ingest_batches (received_at);
+
+CREATE UNLOGGED TABLE response_cache (
+    key VARCHAR(255) PRIMARY KEY,
+    body BYTEA NOT NULL,
+    etag VARCHAR(64) NOT NULL,
+    mimetype VARCHAR(255) NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE TABLE active_alerts (
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    threshold DOUBLE PRECISION NOT NULL,
+    message TEXT NOT NULL,
+    raised_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (location_id, product_id, type),
+    FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+CREATE TABLE alert_events (
+    id BIGSERIAL PRIMARY KEY,
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    event VARCHAR(20) NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    threshold DOUBLE PRECISION NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_alert_events_created ON alert_events (created_at);
+CREATE INDEX idx_alert_events_location ON alert_events (location_id, id);
+
+CREATE TABLE spending_daily_vendor (
+    location_id VARCHAR(32) NOT NULL,
+    spend_date DATE NOT NULL,
+    vendor_id VARCHAR(255) NOT NULL,
+    invoices INT NOT NULL,
+    spend NUMERIC NOT NULL,
+    items_cost NUMERIC NOT NULL,
+    bundle_savings NUMERIC NOT NULL,
+    shipping_paid NUMERIC NOT NULL,
+    shipping_saved NUMERIC NOT NULL,
+    PRIMARY KEY (location_id, spend_date, vendor_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE,
+    FOREIGN KEY (vendor_id) REFERENCES vendors(id) ON DELETE CASCADE
+);
+
+CREATE TABLE spending_daily_product (
+    location_id VARCHAR(32) NOT NULL,
+    spend_date DATE NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    lines INT NOT NULL,
+    quantity NUMERIC NOT NULL,
+    spend NUMERIC NOT NULL,
+    bundle_savings NUMERIC NOT NULL,
+    PRIMARY KEY (location_id, spend_date, product_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+CREATE TABLE stock_applications (
+    invoice_id INT PRIMARY KEY,
+    items JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    movements INT,
+    last_error TEXT,
+    queued_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP WITH TIME ZONE,
+    FOREIGN KEY (invoice_id) REFERENCES invoices(id) ON DELETE CASCADE
+);
+
+CREATE INDEX idx_stock_applications_queued ON stock_applications (invoice_id) WHERE status = 'queued';
+
+CREATE TABLE price_index_changes (
+    source VARCHAR(16) NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (source, key)
+);
+
+CREATE INDEX idx_price_index_changes_xid ON price_index_changes (xid);
+
+CREATE TABLE price_index_pruned (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    through XID8 NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION log_price_index_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], '')
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid, changed_at = EXCLUDED.changed_at;
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], to_jsonb(OLD) ->> TG_ARGV[1])
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid, changed_at = EXCLUDED.changed_at;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], to_jsonb(NEW) ->> TG_ARGV[1])
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid, changed_at = EXCLUDED.changed_at;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER vendor_products_price_index AFTER INSERT OR UPDATE OR DELETE ON vendor_products
+    FOR EACH ROW EXECUTE FUNCTION log_price_index_change('product', 'product_id');
+CREATE TRIGGER vendor_products_price_index_truncate AFTER TRUNCATE ON vendor_products
+    FOR EACH STATEMENT EXECUTE FUNCTION log_price_index_change('all');
+CREATE TRIGGER vendors_price_index AFTER INSERT OR UPDATE OR DELETE ON vendors
+    FOR EACH ROW EXECUTE FUNCTION log_price_index_change('vendor', 'id');
+CREATE TRIGGER vendors_price_index_truncate AFTER TRUNCATE ON vendors
+    FOR EACH STATEMENT EXECUTE FUNCTION log_price_index_change('all');
+
 
 -- =================================================================
 -- INSERT INITIAL DATA
 -- =================================================================
+INSERT INTO locations (id, name) VALUES ('main', 'Main store');
+
+-- Partitions for the sample movements' months through two months from now.
+SELECT create_location_partitions('main');
+SELECT create_movement_partition('main', month::date)
+FROM generate_series('2025-07-01'::date, date_trunc('month', CURRENT_DATE) + interval '2 months', interval '1 month') month;
+
 INSERT INTO products (id, name, unit, image_url, remaining_stock, min_stock, max_stock, prediction) VALUES
 ('item1', 'Chicken', 'kg', '/item1.jpg', 100, 50, 200, 150),
 ('item2', 'Potatoes', 'kg', '/item2.jpg', 80, 40, 150, 120),
@@ -151,10 +405,10 @@ INSERT INTO vendor_products (vendor_id, product_id, price, bundles) VALUES
 ('vendor4', 'item9', 1.50, '[{"quantity": 100, "price": 140}]'),
 ('vendor4', 'item10', 0.05, '[{"quantity": 2000, "price": 95}]');
 
-INSERT INTO stock_movements (product_id, quantity, movement_type, description, total_cost) VALUES
-('item1', 50, 'IN', 'Received from Poultry King order #PK101', 425.00),
-('item1', -15, 'OUT', 'Used for daily sales', 0),
-('item2', -5, 'WASTE', 'Spoilage', 0);
+INSERT INTO stock_movements (location_id, product_id, quantity, movement_type, description, total_cost) VALUES
+('main', 'item1', 50, 'IN', 'Received from Poultry King order #PK101', 425.00),
+('main', 'item1', -15, 'OUT', 'Used for daily sales', 0),
+('main', 'item2', -5, 'WASTE', 'Spoilage', 0);
 
 
 -- =================================================================
@@ -162,35 +416,35 @@ INSERT INTO stock_movements (product_id, quantity, movement_type, description, t
 -- =================================================================
 
 -- Step 1: Set the initial stock on July 1st, 2025
-INSERT INTO stock_movements (product_id, quantity, movement_type, description, movement_date) VALUES
-('item1', 150, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item2', 120, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item3', 75, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item4', 30, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item5', 40, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item6', 40, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item7', 90, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item8', 2000, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item9', 80, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
-('item10', 1500, 'IN', 'Initial Stock', '2025-07-01 08:00:00');
+INSERT INTO stock_movements (location_id, product_id, quantity, movement_type, description, movement_date) VALUES
+('main', 'item1', 150, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item2', 120, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item3', 75, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item4', 30, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item5', 40, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item6', 40, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item7', 90, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item8', 2000, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item9', 80, 'IN', 'Initial Stock', '2025-07-01 08:00:00'),
+('main', 'item10', 1500, 'IN', 'Initial Stock', '2025-07-01 08:00:00');
 
 -- Step 2: Simulate daily usage (stock out) and deliveries (stock in)
-INSERT INTO stock_movements (product_id, quantity, movement_type, description, movement_date, total_cost) VALUES
-('item1', -20, 'OUT', 'Daily Sales', '2025-07-01 22:00:00', 0), ('item2', -15, 'OUT', 'Daily Sales', '2025-07-01 22:00:00', 0),
-('item1', -22, 'OUT', 'Daily Sales', '2025-07-02 22:00:00', 0), ('item2', -18, 'OUT', 'Daily Sales', '2025-07-02 22:00:00', 0),
-('item1', -18, 'OUT', 'Daily Sales', '2025-07-03 22:00:00', 0), ('item2', -12, 'OUT', 'Daily Sales', '2025-07-03 22:00:00', 0),
-('item1', -25, 'OUT', 'Daily Sales', '2025-07-04 22:00:00', 0), ('item2', -20, 'OUT', 'Daily Sales', '2025-07-04 22:00:00', 0),
-('item1', -30, 'OUT', 'Daily Sales', '2025-07-05 22:00:00', 0), ('item2', -25, 'OUT', 'Daily Sales', '2025-07-05 22:00:00', 0),
-('item1', 150, 'IN', 'Delivery from Poultry King', '2025-07-07 09:00:00', 1275.00), ('item2', 120, 'IN', 'Delivery from Farm Fresh', '2025-07-07 09:00:00', 144.00),
-('item1', -21, 'OUT', 'Daily Sales', '2025-07-08 22:00:00', 0), ('item2', -17, 'OUT', 'Daily Sales', '2025-07-08 22:00:00', 0),
-('item1', -23, 'OUT', 'Daily Sales', '2025-07-09 22:00:00', 0), ('item2', -19, 'OUT', 'Daily Sales', '2025-07-09 22:00:00', 0),
-('item1', -19, 'OUT', 'Daily Sales', '2025-07-10 22:00:00', 0), ('item2', -15, 'OUT', 'Daily Sales', '2025-07-10 22:00:00', 0),
-('item1', -28, 'OUT', 'Daily Sales', '2025-07-11 22:00:00', 0), ('item2', -22, 'OUT', 'Daily Sales', '2025-07-11 22:00:00', 0),
-('item1', -35, 'OUT', 'Daily Sales', '2025-07-12 22:00:00', 0), ('item2', -28, 'OUT', 'Daily Sales', '2025-07-12 22:00:00', 0),
-('item1', 150, 'IN', 'Delivery from Poultry King', '2025-07-14 09:00:00', 1275.00), ('item2', 120, 'IN', 'Delivery from Farm Fresh', '2025-07-14 09:00:00', 144.00),
-('item1', -20, 'OUT', 'Daily Sales', '2025-07-15 22:00:00', 0), ('item2', -16, 'OUT', 'Daily Sales', '2025-07-15 22:00:00', 0),
-('item1', -18, 'OUT', 'Daily Sales', '2025-08-10 22:00:00', 0), ('item2', -14, 'OUT', 'Daily Sales', '2025-08-10 22:00:00', 0),
-('item1', -19, 'OUT', 'Daily Sales', '2025-08-11 22:00:00', 0), ('item2', -16, 'OUT', 'Daily Sales', '2025-08-11 22:00:00', 0);
+INSERT INTO stock_movements (location_id, product_id, quantity, movement_type, description, movement_date, total_cost) VALUES
+('main', 'item1', -20, 'OUT', 'Daily Sales', '2025-07-01 22:00:00', 0), ('main', 'item2', -15, 'OUT', 'Daily Sales', '2025-07-01 22:00:00', 0),
+('main', 'item1', -22, 'OUT', 'Daily Sales', '2025-07-02 22:00:00', 0), ('main', 'item2', -18, 'OUT', 'Daily Sales', '2025-07-02 22:00:00', 0),
+('main', 'item1', -18, 'OUT', 'Daily Sales', '2025-07-03 22:00:00', 0), ('main', 'item2', -12, 'OUT', 'Daily Sales', '2025-07-03 22:00:00', 0),
+('main', 'item1', -25, 'OUT', 'Daily Sales', '2025-07-04 22:00:00', 0), ('main', 'item2', -20, 'OUT', 'Daily Sales', '2025-07-04 22:00:00', 0),
+('main', 'item1', -30, 'OUT', 'Daily Sales', '2025-07-05 22:00:00', 0), ('main', 'item2', -25, 'OUT', 'Daily Sales', '2025-07-05 22:00:00', 0),
+('main', 'item1', 150, 'IN', 'Delivery from Poultry King', '2025-07-07 09:00:00', 1275.00), ('main', 'item2', 120, 'IN', 'Delivery from Farm Fresh', '2025-07-07 09:00:00', 144.00),
+('main', 'item1', -21, 'OUT', 'Daily Sales', '2025-07-08 22:00:00', 0), ('main', 'item2', -17, 'OUT', 'Daily Sales', '2025-07-08 22:00:00', 0),
+('main', 'item1', -23, 'OUT', 'Daily Sales', '2025-07-09 22:00:00', 0), ('main', 'item2', -19, 'OUT', 'Daily Sales', '2025-07-09 22:00:00', 0),
+('main', 'item1', -19, 'OUT', 'Daily Sales', '2025-07-10 22:00:00', 0), ('main', 'item2', -15, 'OUT', 'Daily Sales', '2025-07-10 22:00:00', 0),
+('main', 'item1', -28, 'OUT', 'Daily Sales', '2025-07-11 22:00:00', 0), ('main', 'item2', -22, 'OUT', 'Daily Sales', '2025-07-11 22:00:00', 0),
+('main', 'item1', -35, 'OUT', 'Daily Sales', '2025-07-12 22:00:00', 0), ('main', 'item2', -28, 'OUT', 'Daily Sales', '2025-07-12 22:00:00', 0),
+('main', 'item1', 150, 'IN', 'Delivery from Poultry King', '2025-07-14 09:00:00', 1275.00), ('main', 'item2', 120, 'IN', 'Delivery from Farm Fresh', '2025-07-14 09:00:00', 144.00),
+('main', 'item1', -20, 'OUT', 'Daily Sales', '2025-07-15 22:00:00', 0), ('main', 'item2', -16, 'OUT', 'Daily Sales', '2025-07-15 22:00:00', 0),
+('main', 'item1', -18, 'OUT', 'Daily Sales', '2025-08-10 22:00:00', 0), ('main', 'item2', -14, 'OUT', 'Daily Sales', '2025-08-10 22:00:00', 0),
+('main', 'item1', -19, 'OUT', 'Daily Sales', '2025-08-11 22:00:00', 0), ('main', 'item2', -16, 'OUT', 'Daily Sales', '2025-08-11 22:00:00', 0);
 
 -- =================================================================
 -- Step 3: Calculate and update the final remaining_stock in the products table
@@ -201,3 +455,14 @@ SET remaining_stock = COALESCE((
     FROM stock_movements m
     WHERE m.product_id = p.id
 ), 0);
+
+-- =================================================================
+-- Step 4: Build the running-balance snapshot (see ledger.py)
+-- =================================================================
+INSERT INTO stock_history (location_id, product_id, record_date, remaining_stock, daily_in, daily_out)
+SELECT location_id, product_id, record_date,
+       (SUM(SUM(quantity)) OVER (PARTITION BY location_id, product_id ORDER BY record_date))::int,
+       COALESCE(SUM(quantity) FILTER (WHERE movement_type = 'IN'), 0)::int,
+       COALESCE(SUM(quantity) FILTER (WHERE movement_type != 'IN'), 0)::int
+FROM (SELECT location_id, product_id, quantity, movement_type, movement_date::date as record_date FROM stock_movements) m
+GROUP BY location_id, product_id, record_date;
@@ -0,0 +1,311 @@
+# datagen.py
+# Seeded synthetic data for load and scaling tests.
+#
+# Replaces the contents of the database with N products, M vendors with bundle
+# offers, and years of daily stock usage, reorders and approved invoices, then
+# rebuilds the derived tables (stock_history, demand_forecasts). Stock is
+# simulated day by day for all products at once: usage is drawn per product
+# and weekday, and a product that falls below min_stock is reordered up to
+# max_stock from its cheapest vendor, arriving a few days later. The same
+# --seed always produces the same data. Everything is loaded with COPY.
+# --locations N simulates N stores (DEFAULT_LOCATION, then store2, store3, ...)
+# sharing the catalog, each with its own stock, invoices and movements.
+#
+# Usage:
+#   python datagen.py --products 2000 --vendors 40 --years 3         # database from DB_* env
+#   python datagen.py --locations 4 ...                              # four stores
+#   python datagen.py --reset-schema ...                             # also (re)create the tables
+#   python datagen.py --container --products 2000 ...                # disposable postgres in docker
+
+import argparse, io, json, os, subprocess, sys, time
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import db
+import approvals, forecasting, ledger, locations, spending
+from optimization import _calculate_offer_costs
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database-schema.sql")
+UNITS = ['kg', 'liters', 'pcs', 'packs']
+WEEKDAY_FACTORS = np.array([0.85, 0.9, 0.95, 1.0, 1.15, 1.35, 1.1])
+BUNDLE_DAYS = [2, 5, 7, 14, 30]
+
+
+def generate(products=500, vendors=20, years=1.0, offers_per_product=4, bundle_rate=0.4, seed=42, end=None, stores=1):
+    """
+    Builds the dataset in memory.
+
+    Returns:
+        dict: table name -> DataFrame with that table's columns.
+    """
+    rng = np.random.default_rng(seed)
+    end = end or date.today() - timedelta(days=1)
+    days = pd.date_range(end - timedelta(days=int(years * 365) - 1), end, freq='D')
+    day_strings = days.strftime('%Y-%m-%d').to_numpy()
+
+    # Products: daily demand drives the stock limits and the static prediction.
+    base_demand = rng.lognormal(mean=2.0, sigma=0.8, size=products)
+    product_ids = np.array([f"p{i}" for i in range(1, products + 1)])
+    product_names = np.array([f"Product {i}" for i in range(1, products + 1)])
+    min_stock = np.ceil(base_demand * 3).astype(np.int64)
+    max_stock = np.ceil(base_demand * 14).astype(np.int64)
+    unit_price = np.round(rng.lognormal(mean=0.5, sigma=1.0, size=products), 2) + 0.05
+    products_df = pd.DataFrame({
+        "id": product_ids, "name": product_names,
+        "unit": rng.choice(UNITS, size=products),
+        "image_url": [f"/{pid}.jpg" for pid in product_ids],
+        "remaining_stock": 0, "min_stock": min_stock, "max_stock": max_stock,
+        "prediction": np.ceil(base_demand * 7).astype(np.int64),
+    })
+
+    vendor_ids = np.array([f"v{j}" for j in range(1, vendors + 1)])
+    vendor_names = np.array([f"Vendor {j}" for j in range(1, vendors + 1)])
+    shipping_cost = np.round(rng.uniform(10, 60, size=vendors))
+    threshold = np.round(rng.uniform(200, 1500, size=vendors) / 50) * 50
+    vendors_df = pd.DataFrame({
+        "id": vendor_ids, "name": vendor_names,
+        "shipping_cost": shipping_cost, "free_shipping_threshold": threshold,
+    })
+
+    # Offers: each product from 1..offers_per_product vendors, some with bundles.
+    offer_rows = []
+    for p in range(products):
+        count = rng.integers(1, min(vendors, offers_per_product) + 1)
+        for v in rng.choice(vendors, size=count, replace=False):
+            price = round(float(unit_price[p] * rng.uniform(0.85, 1.2)), 2) or 0.01
+            bundles = None
+            if rng.random() < bundle_rate:
+                sizes = sorted({max(2, int(round(base_demand[p] * d))) for d in rng.choice(BUNDLE_DAYS, size=rng.integers(1, 4))})
+                bundles = [
+                    {"quantity": q, "price": round(q * price * (1 - float(rng.uniform(0.03, 0.2))), 2)}
+                    for q in sizes
+                ]
+            offer_rows.append((p, v, price, bundles))
+    offers = pd.DataFrame(offer_rows, columns=['product', 'vendor', 'price', 'bundles'])
+    vendor_products_df = pd.DataFrame({
+        "vendor_id": vendor_ids[offers['vendor']], "product_id": product_ids[offers['product']],
+        "price": offers['price'],
+        "bundles": [json.dumps(b) if b else None for b in offers['bundles']],
+    })
+    cheapest = offers.loc[offers.groupby('product')['price'].idxmin()].set_index('product')
+
+    # Day-by-day stock simulation, one store after another.
+    location_ids = [locations.DEFAULT_LOCATION] + [f"store{k}" for k in range(2, stores + 1)]
+    invoice_rows, log_rows, movement_frames = [], [], []
+    for location in location_ids:
+        stock = max_stock.copy()
+        usage = np.zeros((products, len(days)), dtype=np.int64)
+        waste = np.zeros((products, len(days)), dtype=np.int64)
+        arrival_day = np.full(products, -1)
+        order_qty = np.zeros(products, dtype=np.int64)
+        orders = []  # (product, ordered on, arrives on, quantity)
+        for d, day in enumerate(days):
+            arriving = arrival_day == d
+            stock[arriving] += order_qty[arriving]
+            arrival_day[arriving] = -1
+
+            usage[:, d] = np.minimum(rng.poisson(base_demand * WEEKDAY_FACTORS[day.weekday()]), stock)
+            stock -= usage[:, d]
+            spoiled = (rng.random(products) < 0.01) & (stock > 0)
+            waste[spoiled, d] = np.minimum(rng.integers(1, np.ceil(base_demand[spoiled]).astype(np.int64) + 1), stock[spoiled])
+            stock -= waste[:, d]
+
+            reorder = (stock < min_stock) & (arrival_day < 0)
+            if d + 1 < len(days) and reorder.any():
+                lead = rng.integers(1, 4, size=reorder.sum())
+                order_qty[reorder] = max_stock[reorder] - stock[reorder]
+                arrival_day[reorder] = np.minimum(d + lead, len(days) - 1)
+                orders.extend(zip(np.flatnonzero(reorder), [d] * len(lead), arrival_day[reorder], order_qty[reorder]))
+        if location == location_ids[0]:
+            products_df['remaining_stock'] = stock
+
+        # Invoices: one per vendor per ordering day, priced with the greedy bundle rule.
+        orders = pd.DataFrame(orders, columns=['product', 'ordered', 'arrives', 'quantity'])
+        orders['vendor'] = cheapest['vendor'].reindex(orders['product']).to_numpy()
+        orders['price'] = cheapest['price'].reindex(orders['product']).to_numpy()
+        orders['bundles'] = cheapest['bundles'].reindex(orders['product']).to_numpy()
+        cost, _, _ = _calculate_offer_costs(orders['quantity'].to_numpy(), orders['price'].to_numpy(), orders['bundles'])
+        orders['cost'] = np.round(cost, 2)
+        orders['invoice_id'] = orders.groupby(['ordered', 'vendor'], sort=True).ngroup() + 1 + len(invoice_rows)
+
+        for invoice_id, group in orders.groupby('invoice_id', sort=True):
+            vendor = group['vendor'].iat[0]
+            subtotal = float(group['cost'].sum())
+            shipping = 0.0 if subtotal >= threshold[vendor] else float(shipping_cost[vendor])
+            items = [
+                {"id": product_ids[o.product], "name": product_names[o.product], "unit": products_df['unit'].iat[o.product],
+                 "quantity": int(o.quantity), "cost": float(o.cost), "price": float(o.price), "bundles": o.bundles}
+                for o in group.itertuples(index=False)
+            ]
+            ordered = day_strings[group['ordered'].iat[0]]
+            invoice_rows.append((invoice_id, location, ordered, vendor_ids[vendor], 'Approved', 'datagen', json.dumps(items),
+                                 round(subtotal + shipping, 2), f"{ordered} 10:00:00"))
+            log_rows.append((invoice_id, 'N/A', 'Approved', 'datagen', f"{ordered} 10:00:00"))
+
+        # Movements: opening stock, daily usage and waste, and deliveries.
+        movement_frames.append(pd.DataFrame({
+            "location_id": location, "product_id": product_ids, "quantity": max_stock, "movement_type": 'IN',
+            "description": 'Initial Stock', "total_cost": 0, "movement_date": f"{day_strings[0]} 08:00:00",
+            "invoice_id": pd.NA,
+        }))
+        for matrix, movement_type, description, hour in ((usage, 'OUT', 'Daily Sales', '22:00:00'), (waste, 'WASTE', 'Spoilage', '21:00:00')):
+            rows, cols = np.nonzero(matrix)
+            movement_frames.append(pd.DataFrame({
+                "location_id": location, "product_id": product_ids[rows], "quantity": -matrix[rows, cols],
+                "movement_type": movement_type, "description": description, "total_cost": 0,
+                "movement_date": pd.Series(day_strings[cols]) + f" {hour}", "invoice_id": pd.NA,
+            }))
+        movement_frames.append(pd.DataFrame({
+            "location_id": location, "product_id": product_ids[orders['product']], "quantity": orders['quantity'],
+            "movement_type": 'IN',
+            "description": [f"Received from {vendor_names[v]} order #{i}" for v, i in zip(orders['vendor'], orders['invoice_id'])],
+            "total_cost": orders['cost'], "movement_date": pd.Series(day_strings[orders['arrives']]) + " 09:00:00",
+            "invoice_id": orders['invoice_id'],
+        }))
+
+    locations_df = pd.DataFrame({
+        "id": location_ids, "name": ["Main store" if i == 0 else f"Store {i + 1}" for i in range(len(location_ids))],
+    })
+    invoices_df = pd.DataFrame(invoice_rows, columns=[
+        'id', 'location_id', 'invoice_date', 'vendor_id', 'status', 'modified_by', 'items', 'total_cost', 'created_at'
+    ])
+    logs_df = pd.DataFrame(log_rows, columns=['invoice_id', 'old_status', 'new_status', 'changed_by', 'change_date'])
+    movements_df = pd.concat(movement_frames, ignore_index=True)
+    movements_df['invoice_id'] = movements_df['invoice_id'].astype('Int64')
+    movements_df = movements_df.sort_values('movement_date', kind='stable', ignore_index=True)
+
+    return {
+        "locations": locations_df,
+        "products": products_df,
+        "vendors": vendors_df,
+        "vendor_products": vendor_products_df,
+        "invoices": invoices_df,
+        "invoice_status_logs": logs_df,
+        "stock_movements": movements_df,
+    }
+
+
+_LOAD_ORDER = ["locations", "products", "vendors", "vendor_products", "invoices", "invoice_status_logs", "stock_movements"]
+_SEQUENCES = {"invoices": "id", "invoice_status_logs": "id", "stock_movements": "id"}
+
+
+def load(conn, tables, forecasts=True):
+    """Replaces every table's contents with the generated data and rebuilds the derived tables."""
+    cur = conn.cursor()
+    cur.execute("""
+        TRUNCATE locations, products, vendors, vendor_products, stock_history, invoices, stock_movements,
+                 invoice_status_logs, demand_forecasts, precomputed_results, ingest_batches, response_cache,
+                 spending_daily_vendor, spending_daily_product, stock_applications, stock_ledger_locks
+        RESTART IDENTITY CASCADE;
+    """)
+    # Every month of movements gets its partition before the COPY, so nothing lands in the default partitions.
+    first = date.fromisoformat(tables["stock_movements"]["movement_date"].min()[:10])
+    for table in _LOAD_ORDER:
+        frame = tables[table]
+        if table == "stock_movements":
+            for location in tables["locations"]["id"]:
+                locations.create_partitions(cur, location, locations.month_range(first, date.today()))
+        buffer = io.StringIO()
+        frame.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    for table, column in _SEQUENCES.items():
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), COALESCE(MAX({column}), 0) + 1, false) FROM {table};")
+    cur.execute(approvals.BACKFILL_QUERY)
+    conn.commit()
+    locations.maintain(conn)
+
+    ledger.rebuild(conn)
+    spending.rebuild(conn)
+    if forecasts:
+        for location in tables["locations"]["id"]:
+            forecasting.refit(conn, location, full=True)
+    conn.autocommit = True
+    cur.execute("ANALYZE;")
+    conn.autocommit = False
+    cur.close()
+
+
+def reset_schema(conn):
+    """Drops and recreates every table from database-schema.sql."""
+    with open(SCHEMA_FILE) as f:
+        schema = f.read()
+    cur = conn.cursor()
+    cur.execute(schema)
+    conn.commit()
+    cur.close()
+
+
+def start_container(image, port, timeout=60):
+    """
+    Starts a throwaway Postgres container (removed when stopped) and waits
+    until it accepts connections.
+
+    Returns:
+        tuple: (container id, connection kwargs)
+    """
+    container = subprocess.check_output([
+        "docker", "run", "-d", "--rm", "-p", f"{port}:5432",
+        "-e", "POSTGRES_DB=stock_management", "-e", "POSTGRES_USER=postgres", "-e", "POSTGRES_PASSWORD=password",
+        image
+    ], text=True).strip()
+    dsn = {"dbname": "stock_management", "user": "postgres", "password": "password", "host": "localhost", "port": port}
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            psycopg2.connect(**dsn).close()
+            return container, dsn
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                subprocess.call(["docker", "stop", container])
+                raise
+            time.sleep(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the database with seeded synthetic data.")
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--vendors", type=int, default=20)
+    parser.add_argument("--years", type=float, default=1.0, help="length of the movement history")
+    parser.add_argument("--offers-per-product", type=int, default=4, help="maximum vendors selling each product")
+    parser.add_argument("--bundle-rate", type=float, default=0.4, help="share of offers with bundle deals")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--locations", type=int, default=1, help="stores to simulate")
+    parser.add_argument("--reset-schema", action="store_true", help="recreate the tables from database-schema.sql first")
+    parser.add_argument("--no-forecasts", action="store_true", help="skip fitting demand_forecasts")
+    parser.add_argument("--container", action="store_true", help="load into a new disposable postgres container")
+    parser.add_argument("--image", default="postgres:14-alpine")
+    parser.add_argument("--port", type=int, default=5439, help="host port for --container")
+    args = parser.parse_args(argv)
+
+    dsn = {"dbname": db.DB_NAME, "user": db.DB_USER, "password": db.DB_PASS, "host": db.DB_HOST, "port": db.DB_PORT}
+    container = None
+    if args.container:
+        container, dsn = start_container(args.image, args.port)
+
+    started = time.monotonic()
+    tables = generate(args.products, args.vendors, args.years, args.offers_per_product, args.bundle_rate, args.seed,
+                      stores=args.locations)
+    generated = time.monotonic()
+    conn = psycopg2.connect(**dsn)
+    try:
+        if args.reset_schema or container:
+            reset_schema(conn)
+        load(conn, tables, forecasts=not args.no_forecasts)
+    finally:
+        conn.close()
+
+    print(", ".join(f"{len(frame)} {table}" for table, frame in tables.items()))
+    print(f"Generated in {generated - started:.1f}s, loaded in {time.monotonic() - generated:.1f}s.")
+    if container:
+        print(f"Container {container[:12]} is running. Point the app at it with:")
+        print(f"  export DB_HOST=localhost DB_PORT={dsn['port']} DB_NAME=stock_management DB_USER=postgres DB_PASS=password")
+        print(f"and remove it with: docker stop {container[:12]}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
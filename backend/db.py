@@ -0,0 +1,169 @@
+# db.py
+# Bounded Postgres connection pool with request-scoped checkout for Flask routes.
+
+import os, threading, time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions as pg_extensions
+from flask import g
+
+from instrumentation import INSTRUMENTATION_ENABLED, InstrumentedConnection
+
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASS = os.getenv("DB_PASS")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT", "5432")
+
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN", "1"))
+# Per process; docker-compose.yml adds up every pool's connections against max_connections.
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+# Class the pool opens connections with (bench.py substitutes a subclass that
+# counts round trips); takes effect for pools created afterwards.
+CONNECTION_FACTORY = InstrumentedConnection if INSTRUMENTATION_ENABLED else pg_extensions.connection
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout."""
+
+
+class ConnectionPool:
+    """
+    Wraps psycopg2's ThreadedConnectionPool so that callers wait (up to a
+    timeout) for a free connection instead of failing as soon as the pool is
+    exhausted, and keeps counters about how the pool is being used.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._checkouts = 0
+        self._failures = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._failures += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.monotonic() - start
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._failures += 1
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        """Returns a connection, rolling back any transaction the caller left open."""
+        discard = bool(conn.closed)
+        if not discard:
+            try:
+                if conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        try:
+            self._pool.putconn(conn, close=discard)
+        finally:
+            self._slots.release()
+            with self._lock:
+                self._in_use -= 1
+                if discard:
+                    self._discarded += 1
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "minSize": self.minconn,
+                "maxSize": self.maxconn,
+                "inUse": self._in_use,
+                "idle": len(self._pool._pool),
+                "checkouts": self._checkouts,
+                "checkoutFailures": self._failures,
+                "discarded": self._discarded,
+                "waitTimeTotalMs": round(self._wait_total * 1000, 3),
+                "waitTimeMaxMs": round(self._wait_max * 1000, 3),
+                "waitTimeAvgMs": round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0,
+            }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns this process's pool, creating it on first use. The pool is keyed
+    by PID so that WSGI servers which fork workers after importing the app
+    (e.g. gunicorn --preload) never share sockets between processes.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool(
+                    POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT,
+                    dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT,
+                    connection_factory=CONNECTION_FACTORY
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+def close_pool():
+    """Closes this process's pool, e.g. when a worker shuts down."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+def get_db_connection():
+    """
+    Checks a connection out of the pool for the current request. Repeated calls
+    within one request return the same connection; it goes back to the pool
+    when the app context is torn down.
+    """
+    if 'db_conn' not in g:
+        g.db_conn = get_pool().getconn()
+    return g.db_conn
+
+def release_db_connection(exception=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+
+@contextmanager
+def pooled_connection():
+    """Checks out a connection outside of a request (background jobs, CLI commands)."""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def init_app(app):
+    app.teardown_appcontext(release_db_connection)
@@ -0,0 +1,302 @@
+# forecasting.py
+# Per-location, per-product demand forecasts from the OUT movements in
+# stock_movements.
+#
+# Daily demand is modelled with additive exponential smoothing: a level plus
+# one offset per weekday, updated one day at a time for all products at once
+# (products are rows of a NumPy matrix, days are columns). Each location is
+# fitted separately from its own movement partitions. The fitted state is
+# stored in demand_forecasts together with the resulting order-up-to level, so
+# a refit only has to replay the days since the last run and /generate-invoice
+# just reads the precomputed prediction.
+#
+# Usage:
+#   python forecasting.py refit                     # fold new complete days into every location's forecasts
+#   python forecasting.py rebuild --location main   # refit one location's products from their full history
+#   python forecasting.py backtest --holdout 28     # one-step-ahead error metrics per product
+
+import argparse, json, os, sys
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg2.extras
+
+from db import pooled_connection
+from locations import DEFAULT_LOCATION, location_ids
+
+ALPHA = float(os.getenv("FORECAST_ALPHA", "0.3"))      # level smoothing
+GAMMA = float(os.getenv("FORECAST_GAMMA", "0.1"))      # weekday offset smoothing
+RHO = float(os.getenv("FORECAST_RHO", "0.1"))          # residual variance smoothing
+HORIZON_DAYS = int(os.getenv("FORECAST_HORIZON_DAYS", "7"))
+SERVICE_Z = float(os.getenv("FORECAST_SERVICE_Z", "1.65"))
+MIN_OBSERVATIONS = int(os.getenv("FORECAST_MIN_OBSERVATIONS", "14"))
+
+
+class _State:
+    """Smoothing state for a set of products, one array entry per product."""
+
+    def __init__(self, count):
+        self.level = np.zeros(count)
+        self.seasonal = np.zeros((count, 7))
+        self.variance = np.zeros(count)
+        self.observations = np.zeros(count, dtype=np.int64)
+
+
+def _load_demand(cur, location, through, incremental=True):
+    """
+    Daily OUT demand at the location up to and including `through`. When
+    incremental, products that already have a fitted state only return the
+    days after it.
+    """
+    query = """
+        SELECT m.product_id, m.movement_date::date as day, -SUM(m.quantity) as demand
+        FROM stock_movements m
+        LEFT JOIN demand_forecasts f ON f.location_id = m.location_id AND f.product_id = m.product_id
+        WHERE m.location_id = %(location)s
+          AND m.movement_type = 'OUT'
+          AND m.movement_date < (%(through)s::date + 1)::timestamptz
+          AND (NOT %(incremental)s OR f.product_id IS NULL OR m.movement_date >= (f.fitted_through + 1)::timestamptz)
+        GROUP BY 1, 2
+    """
+    cur.execute(query, {"location": location, "through": through, "incremental": incremental})
+    return pd.DataFrame(cur.fetchall(), columns=['product_id', 'day', 'demand'])
+
+
+def _demand_matrix(demand, product_ids, start, end):
+    """Pivots (product, day, demand) rows into a products x days matrix covering start..end."""
+    days = pd.date_range(start, end, freq='D').date
+    matrix = np.zeros((len(product_ids), len(days)))
+    if not demand.empty:
+        rows = pd.Index(product_ids).get_indexer(demand['product_id'])
+        cols = pd.Index(days).get_indexer(demand['day'])
+        keep = (rows >= 0) & (cols >= 0)
+        matrix[rows[keep], cols[keep]] = demand['demand'].astype(float).to_numpy()[keep]
+    return matrix, days
+
+
+def _advance(state, demand, active, days, on_step=None):
+    """
+    Replays the demand matrix day by day for every product whose `active` flag
+    is set on that day. A product's first active day seeds its level.
+    on_step(day_index, one_step_forecast) is called before each update.
+    """
+    for d, day in enumerate(days):
+        weekday = day.weekday()
+        act = active[:, d]
+        y = demand[:, d]
+        season = state.seasonal[:, weekday]
+        predicted = np.maximum(state.level + season, 0.0)
+        if on_step is not None:
+            on_step(d, predicted)
+
+        fresh = act & (state.observations == 0)
+        seasoned = act & ~fresh
+        error = y - (state.level + season)
+        level = ALPHA * (y - season) + (1 - ALPHA) * state.level
+        state.seasonal[seasoned, weekday] = GAMMA * (y - level)[seasoned] + (1 - GAMMA) * season[seasoned]
+        state.variance[seasoned] = (1 - RHO) * state.variance[seasoned] + RHO * error[seasoned] ** 2
+        state.level[seasoned] = level[seasoned]
+        state.level[fresh] = y[fresh]
+        state.observations[act] += 1
+
+
+def _forecast(state, through, horizon=HORIZON_DAYS):
+    """Demand over the next `horizon` days, its safety stock and the resulting order-up-to level."""
+    weekdays = [(through + timedelta(days=h)).weekday() for h in range(1, horizon + 1)]
+    forecast = np.maximum(state.level[:, None] + state.seasonal[:, weekdays], 0.0).sum(axis=1)
+    safety_stock = SERVICE_Z * np.sqrt(state.variance * horizon)
+    prediction = np.ceil(forecast + safety_stock).astype(np.int64)
+    return forecast, safety_stock, prediction
+
+
+def _first_active_days(product_ids, days, start_by_product):
+    """Boolean products x days mask: True from each product's first day to replay onwards."""
+    first = np.full(len(product_ids), len(days))
+    index = {product_id: i for i, product_id in enumerate(product_ids)}
+    day_index = {day: d for d, day in enumerate(days)}
+    for product_id, start in start_by_product.items():
+        first[index[product_id]] = day_index.get(start, len(days))
+    return np.arange(len(days))[None, :] >= first[:, None]
+
+
+def refit(conn, location, through=None, full=False):
+    """
+    Brings the location's demand_forecasts up to date through `through`
+    (default: yesterday, the last complete day), replaying only days after each
+    product's last fit unless `full` is set.
+
+    Returns:
+        int: number of products whose forecast was written.
+    """
+    through = through or date.today() - timedelta(days=1)
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    if full:
+        cur.execute("DELETE FROM demand_forecasts WHERE location_id = %s;", (location,))
+    cur.execute("SELECT * FROM demand_forecasts WHERE location_id = %s;", (location,))
+    states = cur.fetchall()
+    demand = _load_demand(cur, location, through)
+
+    fitted = {row['product_id']: row for row in states if row['fitted_through'] < through}
+    new_products = sorted(set(demand['product_id']) - {row['product_id'] for row in states})
+    product_ids = list(fitted) + new_products
+    if not product_ids:
+        conn.commit()
+        cur.close()
+        return 0
+
+    start_by_product = {pid: row['fitted_through'] + timedelta(days=1) for pid, row in fitted.items()}
+    first_demand = demand.groupby('product_id')['day'].min()
+    for product_id in new_products:
+        start_by_product[product_id] = first_demand[product_id]
+    start = min(start_by_product.values())
+
+    matrix, days = _demand_matrix(demand, product_ids, start, through)
+    state = _State(len(product_ids))
+    for i, product_id in enumerate(fitted):
+        row = fitted[product_id]
+        state.level[i] = row['level']
+        state.seasonal[i] = row['seasonal']
+        state.variance[i] = row['residual_var']
+        state.observations[i] = row['observations']
+    _advance(state, matrix, _first_active_days(product_ids, days, start_by_product), days)
+    forecast, safety_stock, prediction = _forecast(state, through)
+
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO demand_forecasts (location_id, product_id, fitted_through, level, seasonal, residual_var,
+                                      observations, horizon_days, forecast, safety_stock, prediction)
+        VALUES %s
+        ON CONFLICT (location_id, product_id) DO UPDATE SET
+            fitted_through = EXCLUDED.fitted_through, level = EXCLUDED.level, seasonal = EXCLUDED.seasonal,
+            residual_var = EXCLUDED.residual_var, observations = EXCLUDED.observations,
+            horizon_days = EXCLUDED.horizon_days, forecast = EXCLUDED.forecast,
+            safety_stock = EXCLUDED.safety_stock, prediction = EXCLUDED.prediction,
+            updated_at = CURRENT_TIMESTAMP;
+    """, [
+        (location, product_id, through, float(state.level[i]), [float(s) for s in state.seasonal[i]],
+         float(state.variance[i]), int(state.observations[i]), HORIZON_DAYS,
+         float(forecast[i]), float(safety_stock[i]), int(prediction[i]))
+        for i, product_id in enumerate(product_ids)
+    ])
+    conn.commit()
+    cur.close()
+    return len(product_ids)
+
+
+def load_predictions(db_connection, location, product_ids):
+    """Returns {product id: forecast order-up-to level} at the location for products with enough history."""
+    cur = db_connection.cursor()
+    cur.execute(
+        "SELECT product_id, prediction FROM demand_forecasts WHERE location_id = %s AND product_id = ANY(%s) AND observations >= %s;",
+        (location, list(product_ids), MIN_OBSERVATIONS)
+    )
+    predictions = dict(cur.fetchall())
+    cur.close()
+    return predictions
+
+
+USAGE_RATE_QUERY = """
+    SELECT product_id, forecast / horizon_days as rate
+    FROM demand_forecasts
+    WHERE location_id = %(location)s AND product_id = ANY(%(product_ids)s) AND observations >= %(min_observations)s;
+"""
+
+def load_usage_rates(db_connection, location, product_ids):
+    """Returns {product id: forecast demand per day over the horizon} at the location for products with enough history."""
+    cur = db_connection.cursor()
+    cur.execute(USAGE_RATE_QUERY, {"location": location, "product_ids": list(product_ids), "min_observations": MIN_OBSERVATIONS})
+    rates = dict(cur.fetchall())
+    cur.close()
+    return rates
+
+
+def backtest(conn, location, holdout_days=28, through=None):
+    """
+    Fits on everything before the last `holdout_days` days, then walks through
+    the holdout one day at a time, forecasting each day before learning from it.
+
+    Returns:
+        list: per-product dicts with MAE, RMSE, bias, WAPE and the MAE of a
+        same-weekday-last-week naive forecast for comparison.
+    """
+    through = through or date.today() - timedelta(days=1)
+    cur = conn.cursor()
+    demand = _load_demand(cur, location, through, incremental=False)
+    cur.close()
+    conn.rollback()
+    if demand.empty:
+        return []
+
+    product_ids = sorted(demand['product_id'].unique())
+    first_demand = demand.groupby('product_id')['day'].min().to_dict()
+    start = min(first_demand.values())
+    matrix, days = _demand_matrix(demand, product_ids, start, through)
+    active = _first_active_days(product_ids, days, first_demand)
+    cutoff = max(len(days) - holdout_days, 0)
+
+    predictions = np.full(matrix.shape, np.nan)
+    def record(d, predicted):
+        if d >= cutoff:
+            predictions[:, d] = predicted
+    _advance(_State(len(product_ids)), matrix, active, days, on_step=record)
+
+    window = slice(cutoff, len(days))
+    actual = matrix[:, window]
+    errors = predictions[:, window] - actual
+    naive = np.full(actual.shape, np.nan)
+    if cutoff >= 7:
+        naive = matrix[:, cutoff - 7:len(days) - 7]
+    scored = active[:, window]
+
+    results = []
+    for i, product_id in enumerate(product_ids):
+        mask = scored[i]
+        if not mask.any():
+            continue
+        e = errors[i, mask]
+        y = actual[i, mask]
+        results.append({
+            "productId": product_id,
+            "days": int(mask.sum()),
+            "mae": float(np.abs(e).mean()),
+            "rmse": float(np.sqrt((e ** 2).mean())),
+            "bias": float(e.mean()),
+            "wape": float(np.abs(e).sum() / y.sum()) if y.sum() else None,
+            "naiveMae": float(np.abs(naive[i, mask] - y).mean()) if cutoff >= 7 else None,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit and evaluate per-product demand forecasts.")
+    parser.add_argument("command", choices=["refit", "rebuild", "backtest"])
+    parser.add_argument("--holdout", type=int, default=28, help="backtest: number of final days to score")
+    parser.add_argument("--through", type=date.fromisoformat, help="last complete day to use (default: yesterday)")
+    parser.add_argument("--json", action="store_true", help="backtest: print results as JSON")
+    parser.add_argument("--location", help="location to fit or score (default: every location for refit/rebuild, "
+                                           "DEFAULT_LOCATION for backtest)")
+    args = parser.parse_args(argv)
+
+    with pooled_connection() as conn:
+        if args.command in ("refit", "rebuild"):
+            cur = conn.cursor()
+            for location in [args.location] if args.location else location_ids(cur):
+                count = refit(conn, location, args.through, full=args.command == "rebuild")
+                print(f"Updated forecasts for {count} products at {location}.")
+            cur.close()
+            return 0
+
+        results = backtest(conn, args.location or DEFAULT_LOCATION, args.holdout, args.through)
+        if args.json:
+            print(json.dumps(results, indent=2))
+            return 0
+        print(f"{'product':<20}{'days':>6}{'MAE':>10}{'RMSE':>10}{'bias':>10}{'WAPE':>8}{'naive MAE':>11}")
+        for r in results:
+            wape = f"{r['wape']:.1%}" if r['wape'] is not None else "-"
+            naive = f"{r['naiveMae']:.2f}" if r['naiveMae'] is not None else "-"
+            print(f"{r['productId']:<20}{r['days']:>6}{r['mae']:>10.2f}{r['rmse']:>10.2f}{r['bias']:>10.2f}{wape:>8}{naive:>11}")
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,419 @@
+# instrumentation.py
+# Per-request query accounting, slow query logging, Prometheus metrics and an
+# opt-in sampling profiler.
+#
+# Connections from db.py's pool (and async_db.py's) hand out cursors that time
+# every statement and count the rows fetched into the current request's
+# RequestStats, which lives in a context variable so that it follows the
+# request's thread or asyncio task. At the end of the request the totals are
+# added to the process-wide metrics served by /metrics, the same statement
+# repeated INSTRUMENT_N_PLUS_ONE times or more in one request is reported as
+# an N+1 pattern, and statements slower than SLOW_QUERY_MS are logged with
+# their EXPLAIN plan.
+#
+# With PROFILER_ENABLED=1 a background thread samples the stacks of threads
+# that are serving (PROFILER_ROUTES, default all) Flask routes and /profile
+# returns them in the collapsed format that flamegraph.pl and speedscope read.
+
+import os, sys, threading, time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+import psycopg
+import psycopg2.extensions
+from psycopg import sql as pg3_sql
+from psycopg.rows import tuple_row
+from psycopg2 import sql as pg_sql
+
+INSTRUMENTATION_ENABLED = os.getenv("INSTRUMENTATION_ENABLED", "1") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("INSTRUMENT_N_PLUS_ONE", "5"))
+# Statements are keyed (for N+1 detection and logging) on this many leading
+# characters, so a multi-megabyte bulk statement isn't rescanned on every call.
+STATEMENT_KEY_CHARS = int(os.getenv("INSTRUMENT_STATEMENT_CHARS", "1000"))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000
+PROFILER_ROUTES = {route for route in os.getenv("PROFILER_ROUTES", "").split(",") if route}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+
+class RequestStats:
+    """Database work done on behalf of one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.slow_queries = 0
+        self.statements = Counter()
+
+_current = ContextVar("request_stats", default=None)
+_route = ContextVar("route", default=None)
+
+
+def _normalize(query):
+    if isinstance(query, (pg_sql.Composable, pg3_sql.Composable)):
+        query = repr(query)
+    elif isinstance(query, bytes):
+        query = query[:STATEMENT_KEY_CHARS * 4].decode(errors='replace')
+    # Whitespace runs collapse, so take enough to fill the key after they do.
+    return ' '.join(query[:STATEMENT_KEY_CHARS * 4].split())[:STATEMENT_KEY_CHARS]
+
+def _record_query(query, duration):
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += duration
+        stats.statements[_normalize(query)] += 1
+        if duration * 1000 >= SLOW_QUERY_MS:
+            stats.slow_queries += 1
+
+def _record_rows(rows):
+    stats = _current.get()
+    if stats is not None:
+        stats.rows += rows
+
+def _log_slow_query(query, duration, plan):
+    route = _route.get() or "-"
+    print(f"Slow query ({duration * 1000:.1f} ms) on {route}: {_normalize(query)[:500]}")
+    if plan:
+        print("  " + "\n  ".join(plan))
+
+def _explainable(query):
+    return _normalize(query).split(' ', 1)[0].lower() in _EXPLAINABLE
+
+
+# =================================================================
+# psycopg2 (db.py)
+# =================================================================
+
+class _InstrumentedCursorMixin:
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._observe(query, vars, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._observe(query, None, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._observe(sql, None, time.perf_counter() - start)
+
+    def fetchone(self):
+        row = super().fetchone()
+        _record_rows(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        _record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _record_rows(len(rows))
+        return rows
+
+    def _observe(self, query, vars, duration):
+        _record_query(query, duration)
+        if duration * 1000 >= SLOW_QUERY_MS:
+            plan = None
+            # Named cursors only DECLARE here; their time shows up in fetches.
+            if self.name is None and _explainable(query):
+                plan = _explain(self.connection, query, vars)
+            _log_slow_query(query, duration, plan)
+
+
+def _explain(conn, query, vars):
+    """EXPLAIN (without ANALYZE, so nothing runs again) inside a savepoint so a failure can't abort the caller's transaction."""
+    cur = psycopg2.extensions.cursor(conn)
+    in_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    try:
+        if in_transaction:
+            cur.execute("SAVEPOINT instrumentation_explain;")
+        cur.execute(b"EXPLAIN " + cur.mogrify(query, vars))
+        plan = [row[0] for row in cur.fetchall()]
+        if in_transaction:
+            cur.execute("RELEASE SAVEPOINT instrumentation_explain;")
+        return plan
+    except psycopg2.Error as e:
+        if in_transaction:
+            cur.execute("ROLLBACK TO SAVEPOINT instrumentation_explain;")
+        return [f"(EXPLAIN failed: {e})"]
+    finally:
+        cur.close()
+
+
+_cursor_classes = {}
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection whose cursors, of whatever cursor_factory, report to the current request."""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        if base not in _cursor_classes:
+            _cursor_classes[base] = type('Instrumented' + base.__name__, (_InstrumentedCursorMixin, base), {})
+        kwargs['cursor_factory'] = _cursor_classes[base]
+        return super().cursor(*args, **kwargs)
+
+
+# =================================================================
+# psycopg 3 (async_db.py)
+# =================================================================
+
+class InstrumentedAsyncCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            _record_query(query, duration)
+            if duration * 1000 >= SLOW_QUERY_MS:
+                plan = await _explain_async(self.connection, query, params) if _explainable(query) else None
+                _log_slow_query(query, duration, plan)
+
+    async def fetchone(self):
+        row = await super().fetchone()
+        _record_rows(row is not None)
+        return row
+
+    async def fetchmany(self, size=0):
+        rows = await super().fetchmany(size)
+        _record_rows(len(rows))
+        return rows
+
+    async def fetchall(self):
+        rows = await super().fetchall()
+        _record_rows(len(rows))
+        return rows
+
+
+class InstrumentedAsyncServerCursor(psycopg.AsyncServerCursor):
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            _record_query(query, time.perf_counter() - start)
+
+    async def fetchmany(self, size=0):
+        start = time.perf_counter()
+        rows = await super().fetchmany(size)
+        stats = _current.get()
+        if stats is not None:
+            stats.db_time += time.perf_counter() - start
+        _record_rows(len(rows))
+        return rows
+
+
+def instrument_async_connection(conn):
+    """Makes a psycopg 3 connection's cursors report to the current request."""
+    conn.cursor_factory = InstrumentedAsyncCursor
+    conn.server_cursor_factory = InstrumentedAsyncServerCursor
+
+
+async def _explain_async(conn, query, params):
+    """Async counterpart of _explain(); conn.transaction() nests as a savepoint inside an open transaction."""
+    try:
+        async with conn.transaction():
+            cur = psycopg.AsyncCursor(conn, row_factory=tuple_row)
+            statement = query if isinstance(query, pg3_sql.Composable) else pg3_sql.SQL(query)
+            await cur.execute(pg3_sql.SQL("EXPLAIN ") + statement, params)
+            return [row[0] for row in await cur.fetchall()]
+    except psycopg.Error as e:
+        return [f"(EXPLAIN failed: {e})"]
+
+
+# =================================================================
+# Metrics
+# =================================================================
+
+_metrics_lock = threading.Lock()
+_requests = Counter()                           # (method, route, status) -> count
+_latency_buckets = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+_latency_sum = Counter()                        # (method, route) -> seconds
+_db_queries = Counter()                         # route -> statements
+_db_time = Counter()                            # route -> seconds
+_db_rows = Counter()                            # route -> rows fetched
+_slow_queries = Counter()                       # route -> statements over SLOW_QUERY_MS
+_n_plus_one = Counter()                         # route -> requests with a repeated statement
+
+
+def begin_request(route):
+    """Starts collecting for a request; pass the returned token to end_request()."""
+    return _current.set(RequestStats()), _route.set(route)
+
+def end_request(tokens, method, route, status, duration):
+    """Records the finished request in the metrics and returns its RequestStats."""
+    stats_token, route_token = tokens
+    stats = _current.get()
+    _current.reset(stats_token)
+    _route.reset(route_token)
+
+    repeated = [(statement, count) for statement, count in stats.statements.items() if count >= N_PLUS_ONE_THRESHOLD]
+    for statement, count in repeated:
+        print(f"N+1 query pattern on {method} {route}: {count}x {statement[:200]}")
+
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if duration <= bound), len(LATENCY_BUCKETS))
+    with _metrics_lock:
+        _requests[(method, route, str(status))] += 1
+        _latency_buckets[(method, route)][bucket] += 1
+        _latency_sum[(method, route)] += duration
+        _db_queries[route] += stats.queries
+        _db_time[route] += stats.db_time
+        _db_rows[route] += stats.rows
+        _slow_queries[route] += stats.slow_queries
+        _n_plus_one[route] += bool(repeated)
+    return stats
+
+
+def server_timing(stats, duration):
+    """Server-Timing header value, so per-request DB cost shows up in browser devtools."""
+    return (f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries, {stats.rows} rows", '
+            f'total;dur={duration * 1000:.2f}')
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+def render_metrics(extra=None):
+    """
+    Prometheus text exposition of this process's metrics. `extra` maps metric
+    name -> (type, help, value) for values owned elsewhere (pool, cache).
+    """
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    with _metrics_lock:
+        family("http_requests_total", "counter", "Requests handled, by route and status.")
+        for (method, route, status), count in sorted(_requests.items()):
+            lines.append(f"http_requests_total{_labels(method=method, route=route, status=status)} {count}")
+
+        family("http_request_duration_seconds", "histogram", "Request latency.")
+        for (method, route), buckets in sorted(_latency_buckets.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), buckets):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"http_request_duration_seconds_bucket{_labels(method=method, route=route, le=le)} {cumulative}")
+            lines.append(f"http_request_duration_seconds_sum{_labels(method=method, route=route)} {_latency_sum[(method, route)]:.6f}")
+            lines.append(f"http_request_duration_seconds_count{_labels(method=method, route=route)} {cumulative}")
+
+        for name, counter, help_text in (
+            ("db_queries_total", _db_queries, "Statements executed, by route."),
+            ("db_query_duration_seconds_total", _db_time, "Time spent in the database, by route."),
+            ("db_rows_fetched_total", _db_rows, "Rows fetched, by route."),
+            ("db_slow_queries_total", _slow_queries, f"Statements slower than {SLOW_QUERY_MS:g} ms, by route."),
+            ("db_n_plus_one_requests_total", _n_plus_one, "Requests that repeated one statement N+1 style, by route."),
+        ):
+            family(name, "counter", help_text)
+            for route, value in sorted(counter.items()):
+                lines.append(f"{name}{_labels(route=route)} {round(value, 6)}")
+
+    for name, (kind, help_text, value) in (extra or {}).items():
+        family(name, kind, help_text)
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# =================================================================
+# Sampling profiler
+# =================================================================
+
+_active_threads = {}                            # thread id -> route being served
+_stacks = Counter()                             # "route;frame;frame..." -> samples
+_profiler_thread = None
+_profiler_lock = threading.Lock()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _sample_forever():
+    while True:
+        time.sleep(PROFILER_INTERVAL)
+        frames = sys._current_frames()
+        for thread_id, route in list(_active_threads.items()):
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            with _profiler_lock:
+                _stacks[";".join([route] + stack[::-1])] += 1
+
+def _start_profiler():
+    global _profiler_thread
+    with _profiler_lock:
+        if _profiler_thread is None or not _profiler_thread.is_alive():
+            _profiler_thread = threading.Thread(target=_sample_forever, name="sampling-profiler", daemon=True)
+            _profiler_thread.start()
+
+def collapsed_stacks(route=None, reset=False):
+    """Sampled stacks as 'route;outer;...;inner count' lines, optionally for one route only."""
+    with _profiler_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_stacks.items())
+                 if route is None or stack.split(";", 1)[0] == route]
+        if reset:
+            _stacks.clear()
+    return "\n".join(lines) + ("\n" if lines else "")
+
+
+# =================================================================
+# Flask integration
+# =================================================================
+
+def init_app(app):
+    from flask import g, request
+
+    if not INSTRUMENTATION_ENABLED:
+        return
+
+    def _route_of():
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    @app.before_request
+    def _begin():
+        route = _route_of()
+        g.instrumentation = (begin_request(route), time.perf_counter())
+        if PROFILER_ENABLED and (not PROFILER_ROUTES or route in PROFILER_ROUTES):
+            _start_profiler()
+            _active_threads[threading.get_ident()] = route
+
+    def _finish(status):
+        tokens, started = g.pop('instrumentation')
+        _active_threads.pop(threading.get_ident(), None)
+        duration = time.perf_counter() - started
+        return end_request(tokens, request.method, _route_of(), status, duration), duration
+
+    @app.after_request
+    def _after(response):
+        if 'instrumentation' in g:
+            stats, duration = _finish(response.status_code)
+            response.headers['Server-Timing'] = server_timing(stats, duration)
+        return response
+
+    @app.teardown_request
+    def _teardown(exception=None):
+        # after_request is skipped when a view raises.
+        if 'instrumentation' in g:
+            _finish(500)
@@ -0,0 +1,344 @@
+# ledger.py
+# Running-balance snapshot of stock levels kept in the stock_history table.
+#
+# Every (location, product, day) that has at least one movement gets a
+# stock_history row holding that day's IN / non-IN totals and the closing
+# balance. The writers in server.py feed new movements through
+# apply_movements() in the same transaction as the INSERT into
+# stock_movements, so the stock level for any date is a single keyed lookup
+# instead of a SUM over the product's history, and a date range for many
+# products is one pass over the snapshot. Every query names its location, so
+# it only reads that location's stock_history partition.
+#
+# Usage:
+#   python ledger.py rebuild   # recompute stock_history from stock_movements
+#   python ledger.py verify    # report rows where the two disagree
+
+import argparse, os, sys
+from collections import defaultdict
+from datetime import date, timedelta
+
+import psycopg2.extras
+from psycopg2 import sql
+
+from db import pooled_connection
+
+SERIES_INTERVALS = ('day', 'week', 'month')
+DEFAULT_SERIES_DAYS = 90
+MAX_SERIES_DAYS = int(os.getenv("MAX_SERIES_DAYS", "1100"))
+
+# {location} is spliced in as a literal (execute_values takes no other
+# parameters) so the planner can prune to the location's partition.
+_APPLY_QUERY = sql.SQL("""
+    WITH d(product_id, record_date, delta, d_in, d_out) AS (VALUES %s),
+    shifted AS (
+        UPDATE stock_history h
+        SET remaining_stock = h.remaining_stock + s.delta,
+            daily_in = h.daily_in + s.d_in,
+            daily_out = h.daily_out + s.d_out
+        FROM (
+            SELECT h2.id,
+                   SUM(d.delta) as delta,
+                   COALESCE(SUM(d.d_in) FILTER (WHERE d.record_date = h2.record_date), 0) as d_in,
+                   COALESCE(SUM(d.d_out) FILTER (WHERE d.record_date = h2.record_date), 0) as d_out
+            FROM stock_history h2
+            JOIN d ON h2.product_id = d.product_id AND h2.record_date >= d.record_date
+            WHERE h2.location_id = {location}
+            GROUP BY h2.id
+        ) s
+        WHERE h.location_id = {location} AND h.id = s.id
+    )
+    INSERT INTO stock_history (location_id, product_id, record_date, remaining_stock, daily_in, daily_out)
+    SELECT {location}, d.product_id, d.record_date,
+           COALESCE((SELECT h.remaining_stock FROM stock_history h
+                     WHERE h.location_id = {location} AND h.product_id = d.product_id AND h.record_date < d.record_date
+                     ORDER BY h.record_date DESC LIMIT 1), 0)
+           + (SELECT SUM(d2.delta) FROM d d2
+              WHERE d2.product_id = d.product_id AND d2.record_date <= d.record_date),
+           d.d_in, d.d_out
+    FROM d
+    WHERE NOT EXISTS (SELECT 1 FROM stock_history h
+                      WHERE h.location_id = {location} AND h.product_id = d.product_id AND h.record_date = d.record_date)
+    ON CONFLICT (location_id, product_id, record_date) DO UPDATE
+    SET remaining_stock = stock_history.remaining_stock + EXCLUDED.daily_in + EXCLUDED.daily_out,
+        daily_in = stock_history.daily_in + EXCLUDED.daily_in,
+        daily_out = stock_history.daily_out + EXCLUDED.daily_out;
+""")
+
+# Same shape as the original per-movement SUMs, but each product is one
+# index probe on stock_history(location_id, product_id, record_date).
+STATUS_QUERY = """
+    SELECT
+        p.id, p.name, p.unit, p.image_url,
+        p.min_stock, p.max_stock, p.prediction,
+        COALESCE(h.remaining_stock, 0) as remaining_stock,
+        CASE WHEN h.record_date = %(date)s THEN h.daily_in ELSE 0 END as daily_in,
+        CASE WHEN h.record_date = %(date)s THEN h.daily_out ELSE 0 END as daily_out
+    FROM products p
+    LEFT JOIN LATERAL (
+        SELECT sh.record_date, sh.remaining_stock, sh.daily_in, sh.daily_out
+        FROM stock_history sh
+        WHERE sh.location_id = %(location)s AND sh.product_id = p.id AND sh.record_date <= %(date)s
+        ORDER BY sh.record_date DESC
+        LIMIT 1
+    ) h ON true
+    ORDER BY p.name;
+"""
+
+# Opening balance per product is one index probe for the day before the
+# range; the range's IN/OUT totals come from idx_stock_history_date and are
+# rolled into buckets (days, or weeks/months clipped to the range), and the
+# closing balances are the opening balance plus a running sum over buckets.
+# The optional product filter is spliced in as {product_filter} and
+# {history_filter}.
+SERIES_QUERY = """
+    WITH selected AS MATERIALIZED (
+        SELECT p.id,
+               COALESCE((SELECT sh.remaining_stock FROM stock_history sh
+                         WHERE sh.location_id = %(location)s AND sh.product_id = p.id AND sh.record_date < %(from)s
+                         ORDER BY sh.record_date DESC LIMIT 1), 0) as opening
+        FROM products p
+        {product_filter}
+    ),
+    buckets AS (
+        SELECT DISTINCT GREATEST(date_trunc(%(interval)s, d), %(from)s::timestamp)::date as bucket
+        FROM generate_series(%(from)s::timestamp, %(to)s::timestamp, interval '1 day') d
+    ),
+    totals AS (
+        SELECT h.product_id,
+               GREATEST(date_trunc(%(interval)s, h.record_date::timestamp), %(from)s::timestamp)::date as bucket,
+               SUM(h.daily_in)::int as b_in, SUM(h.daily_out)::int as b_out
+        FROM stock_history h
+        WHERE h.location_id = %(location)s AND h.record_date BETWEEN %(from)s AND %(to)s {history_filter}
+        GROUP BY 1, 2
+    ),
+    series AS (
+        SELECT s.id, b.bucket,
+               COALESCE(t.b_in, 0) as b_in, COALESCE(t.b_out, 0) as b_out,
+               (s.opening + SUM(COALESCE(t.b_in, 0) + COALESCE(t.b_out, 0))
+                   OVER (PARTITION BY s.id ORDER BY b.bucket))::int as closing
+        FROM selected s
+        CROSS JOIN buckets b
+        LEFT JOIN totals t ON t.product_id = s.id AND t.bucket = b.bucket
+    ),
+    arrays AS (
+        SELECT id,
+               array_agg(bucket ORDER BY bucket) as dates,
+               array_agg(closing - b_in - b_out ORDER BY bucket) as opening,
+               array_agg(b_in ORDER BY bucket) as "in",
+               array_agg(b_out ORDER BY bucket) as "out",
+               array_agg(closing ORDER BY bucket) as closing
+        FROM series
+        GROUP BY id
+    )
+    SELECT p.id, p.name, p.unit, a.dates, a.opening, a."in", a."out", a.closing
+    FROM arrays a
+    JOIN products p ON p.id = a.id
+    ORDER BY p.name;
+"""
+
+_LEDGER_AGGREGATE = """
+    SELECT location_id, product_id, record_date,
+           (SUM(SUM(quantity)) OVER (PARTITION BY location_id, product_id ORDER BY record_date))::int as remaining_stock,
+           COALESCE(SUM(quantity) FILTER (WHERE movement_type = 'IN'), 0)::int as daily_in,
+           COALESCE(SUM(quantity) FILTER (WHERE movement_type != 'IN'), 0)::int as daily_out
+    FROM (SELECT location_id, product_id, quantity, movement_type, movement_date::date as record_date FROM stock_movements) m
+    GROUP BY location_id, product_id, record_date
+"""
+
+
+def _lock_products(cur, location, product_ids, mode):
+    """
+    Locks the location's stock_ledger_locks rows for product_ids (all products
+    when None), creating missing ones, in id order until the transaction ends.
+    """
+    if product_ids is None:
+        cur.execute("""
+            INSERT INTO stock_ledger_locks (location_id, product_id) SELECT %s, id FROM products ORDER BY id
+            ON CONFLICT DO NOTHING;
+        """, (location,))
+        cur.execute(f"SELECT product_id FROM stock_ledger_locks WHERE location_id = %s ORDER BY product_id FOR {mode};", (location,))
+    else:
+        cur.execute("""
+            INSERT INTO stock_ledger_locks (location_id, product_id) SELECT %s, unnest(%s::varchar[])
+            ON CONFLICT DO NOTHING;
+        """, (location, product_ids))
+        cur.execute(
+            f"SELECT product_id FROM stock_ledger_locks WHERE location_id = %s AND product_id = ANY(%s) ORDER BY product_id FOR {mode};",
+            (location, product_ids)
+        )
+    cur.fetchall()
+
+def ledger_version(cur, location, lock=False):
+    """
+    The location's ledger version, which apply_movements bumps. A reader can
+    compute from one snapshot and later check the ledger hasn't moved on;
+    lock=True holds off the location's writers until the transaction ends.
+    """
+    cur.execute(f"SELECT ledger_version FROM locations WHERE id = %s{' FOR SHARE' if lock else ''};", (location,))
+    return cur.fetchone()[0]
+
+
+def apply_movements(cur, location, movements):
+    """
+    Folds newly inserted movements into the location's stock_history.
+
+    Args:
+        cur: Cursor inside the transaction that inserted the movements.
+        location: The location the movements were recorded at.
+        movements: Iterable of (product_id, quantity, movement_type, record_date),
+            where record_date is movement_date::date as returned by the INSERT.
+    """
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for product_id, quantity, movement_type, record_date in movements:
+        key = (product_id, record_date)
+        deltas[key][0] += quantity
+        deltas[key][1 if movement_type == 'IN' else 2] += quantity
+    if not deltas:
+        return
+
+    # Serialize ledger writers per location and product so the balance read for
+    # a new row can't race with another transaction's insert for the same one.
+    _lock_products(cur, location, sorted({product_id for product_id, _ in deltas}), "NO KEY UPDATE")
+
+    rows = [(product_id, record_date, *totals) for (product_id, record_date), totals in deltas.items()]
+    psycopg2.extras.execute_values(
+        cur, _APPLY_QUERY.format(location=sql.Literal(location)), rows,
+        template="(%s, %s::date, %s::int, %s::int, %s::int)",
+        page_size=len(rows)
+    )
+    cur.execute("UPDATE locations SET ledger_version = ledger_version + 1 WHERE id = %s;", (location,))
+
+
+def fetch_stock_status(cur, location, record_date):
+    """Returns every product with its closing stock and IN/OUT totals at the location for the given date."""
+    cur.execute(STATUS_QUERY, {"location": location, "date": record_date})
+    return [dict(row) for row in cur.fetchall()]
+
+
+class InvalidSeriesQuery(ValueError):
+    """Raised for malformed /stock-series parameters."""
+
+
+def parse_series_args(args):
+    """
+    Reads from, to (inclusive dates, default the last 90 days), interval
+    (day, week or month) and products (comma-separated ids, default all).
+
+    Returns:
+        tuple: (from_date, to_date, interval, product_ids or None)
+    """
+    try:
+        to_date = date.fromisoformat(args['to']) if args.get('to') else date.today()
+        from_date = date.fromisoformat(args['from']) if args.get('from') else to_date - timedelta(days=DEFAULT_SERIES_DAYS - 1)
+    except ValueError as e:
+        raise InvalidSeriesQuery("Invalid 'from' or 'to' date") from e
+    if from_date > to_date:
+        raise InvalidSeriesQuery("'from' is after 'to'")
+    if (to_date - from_date).days >= MAX_SERIES_DAYS:
+        raise InvalidSeriesQuery(f"Range is longer than {MAX_SERIES_DAYS} days")
+    interval = args.get('interval', 'day')
+    if interval not in SERIES_INTERVALS:
+        raise InvalidSeriesQuery(f"'interval' must be one of {', '.join(SERIES_INTERVALS)}")
+    product_ids = sorted({p for p in args.get('products', '').split(',') if p}) or None
+    return from_date, to_date, interval, product_ids
+
+
+def build_series_query(location, from_date, to_date, interval, product_ids):
+    """Returns (sql, params) for SERIES_QUERY."""
+    params = {"location": location, "from": from_date, "to": to_date, "interval": interval}
+    filters = {"product_filter": "", "history_filter": ""}
+    if product_ids:
+        filters = {
+            "product_filter": "WHERE p.id = ANY(%(product_ids)s)",
+            "history_filter": "AND h.product_id = ANY(%(product_ids)s)",
+        }
+        params['product_ids'] = product_ids
+    return SERIES_QUERY.format(**filters), params
+
+
+def format_series(rows, from_date, to_date, interval):
+    """
+    Shapes SERIES_QUERY rows as columnar JSON: one shared list of bucket start
+    dates, and per product one array each of opening, in, out and closing.
+    """
+    rows = [dict(row) for row in rows]
+    dates = [bucket.isoformat() for bucket in rows[0]['dates']] if rows else []
+    for row in rows:
+        del row['dates']
+    return {
+        "from": from_date.isoformat(),
+        "to": to_date.isoformat(),
+        "interval": interval,
+        "dates": dates,
+        "products": rows,
+    }
+
+
+def fetch_stock_series(cur, location, from_date, to_date, interval='day', product_ids=None):
+    """Daily (or weekly/monthly) opening, in, out and closing stock per product at the location over a date range."""
+    cur.execute(*build_series_query(location, from_date, to_date, interval, product_ids))
+    return format_series(cur.fetchall(), from_date, to_date, interval)
+
+
+def rebuild(conn):
+    """Recomputes stock_history from the raw stock_movements ledger."""
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE stock_movements IN SHARE MODE;")
+    cur.execute("TRUNCATE stock_history;")
+    cur.execute(f"""
+        INSERT INTO stock_history (location_id, product_id, record_date, remaining_stock, daily_in, daily_out)
+        {_LEDGER_AGGREGATE};
+    """)
+    count = cur.rowcount
+    conn.commit()
+    cur.close()
+    return count
+
+
+def verify(conn):
+    """Returns the (location, product, date) rows where stock_history disagrees with stock_movements."""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(f"""
+        SELECT COALESCE(l.location_id, h.location_id) as location_id,
+               COALESCE(l.product_id, h.product_id) as product_id,
+               COALESCE(l.record_date, h.record_date) as record_date,
+               l.remaining_stock as expected_stock, h.remaining_stock as snapshot_stock,
+               l.daily_in as expected_in, h.daily_in as snapshot_in,
+               l.daily_out as expected_out, h.daily_out as snapshot_out
+        FROM ({_LEDGER_AGGREGATE}) l
+        FULL OUTER JOIN stock_history h
+            ON h.location_id = l.location_id AND h.product_id = l.product_id AND h.record_date = l.record_date
+        WHERE l.product_id IS NULL OR h.product_id IS NULL
+           OR l.remaining_stock != h.remaining_stock
+           OR l.daily_in != h.daily_in
+           OR l.daily_out != h.daily_out
+        ORDER BY 1, 2, 3;
+    """)
+    mismatches = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    conn.rollback()
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the stock_history running-balance snapshot.")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    args = parser.parse_args(argv)
+
+    with pooled_connection() as conn:
+        if args.command == "rebuild":
+            print(f"Rebuilt stock_history with {rebuild(conn)} rows.")
+            return 0
+        mismatches = verify(conn)
+        for row in mismatches:
+            print(f"{row['location_id']} {row['product_id']} {row['record_date']}: "
+                  f"stock {row['snapshot_stock']} (expected {row['expected_stock']}), "
+                  f"in {row['snapshot_in']} (expected {row['expected_in']}), "
+                  f"out {row['snapshot_out']} (expected {row['expected_out']})")
+        print(f"{len(mismatches)} mismatched rows.")
+        return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# loadtest.py
+# Closed-loop HTTP load generator for comparing serving modes.
+#
+# Each of --concurrency threads sends one request at a time, back to back, for
+# --duration seconds, cycling through the given paths. Reports throughput and
+# latency percentiles per path.
+#
+# Usage:
+#   python server.py                                   # Flask dev server on :5001
+#   uvicorn asgi:app --port 5002                       # ASGI mode
+#   python loadtest.py http://localhost:5001 --path /stock-status --concurrency 200
+#   python loadtest.py http://localhost:5002 --path /stock-status --concurrency 200
+
+import argparse, itertools, json, sys, threading, time
+import urllib.error, urllib.request
+from collections import defaultdict
+
+import numpy as np
+
+
+def _worker(base_url, paths, deadline, timeout, results, lock):
+    local = defaultdict(lambda: {"latencies": [], "errors": 0})
+    for path in itertools.cycle(paths):
+        if time.monotonic() >= deadline:
+            break
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(base_url + path, timeout=timeout) as response:
+                response.read()
+            local[path]["latencies"].append(time.monotonic() - start)
+        except (urllib.error.URLError, OSError):
+            local[path]["errors"] += 1
+    with lock:
+        for path, result in local.items():
+            results[path]["latencies"].extend(result["latencies"])
+            results[path]["errors"] += result["errors"]
+
+
+def run(base_url, paths, concurrency=50, duration=10.0, timeout=30.0):
+    """
+    Returns:
+        dict: path -> {requests, errors, throughput, p50Ms, p95Ms, p99Ms, maxMs}
+    """
+    results = defaultdict(lambda: {"latencies": [], "errors": 0})
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [
+        threading.Thread(target=_worker, args=(base_url.rstrip('/'), paths[i % len(paths):] + paths[:i % len(paths)], deadline, timeout, results, lock))
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    report = {}
+    for path in paths:
+        latencies = np.array(results[path]["latencies"]) * 1000
+        report[path] = {
+            "requests": len(latencies),
+            "errors": results[path]["errors"],
+            "throughput": round(len(latencies) / elapsed, 1),
+            **({
+                "p50Ms": round(float(np.percentile(latencies, 50)), 1),
+                "p95Ms": round(float(np.percentile(latencies, 95)), 1),
+                "p99Ms": round(float(np.percentile(latencies, 99)), 1),
+                "maxMs": round(float(latencies.max()), 1),
+            } if len(latencies) else {}),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure throughput and latency of API endpoints under concurrent load.")
+    parser.add_argument("base_url", help="e.g. http://localhost:5001")
+    parser.add_argument("--path", action="append", dest="paths", help="endpoint to request (repeatable, default /stock-status)")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args.base_url, args.paths or ["/stock-status"], args.concurrency, args.duration, args.timeout)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"{'path':<40}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for path, r in report.items():
+        print(f"{path:<40}{r['requests']:>10}{r['errors']:>8}{r['throughput']:>9}"
+              f"{r.get('p50Ms', '-'):>9}{r.get('p95Ms', '-'):>9}{r.get('p99Ms', '-'):>9}")
+    return 1 if any(r['errors'] for r in report.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
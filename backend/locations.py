@@ -0,0 +1,177 @@
+# locations.py
+# Stores (locations) and the partitions that keep their stock data apart.
+#
+# Every movement, stock_history row, invoice, demand forecast, alert and
+# spending rollup belongs to one location. stock_movements is partitioned by
+# location and, within a location, by month of movement_date; stock_history is
+# partitioned by location. Routes read the location from ?location= or the
+# X-Location header (DEFAULT_LOCATION when neither is given) and pass it into
+# every query, so Postgres prunes a store's reads and writes to its own
+# partitions. Months are created PARTITION_MONTHS_AHEAD in advance by the
+# scheduler's "partitions" job; a movement dated in a month without a partition
+# lands in the location's default partition until the next run moves it out.
+#
+# Usage:
+#   python locations.py add store2 --name "Second store"
+#   python locations.py list
+#   python locations.py maintain   # create upcoming months, empty the default partitions
+
+import argparse, os, re, sys, time
+from datetime import date
+
+import psycopg2.extras
+from psycopg2 import sql
+
+from db import pooled_connection
+
+DEFAULT_LOCATION = os.getenv("DEFAULT_LOCATION", "main")
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+LOCATION_CACHE_TTL = float(os.getenv("LOCATION_CACHE_TTL", "60"))
+
+# Also enforced by the locations table; ids end up in partition names.
+LOCATION_ID_PATTERN = re.compile(r'^[a-z0-9_]{1,32}$')
+
+
+class InvalidLocation(ValueError):
+    """Raised for a location id that doesn't exist (or can't)."""
+
+
+def location_ids(cur):
+    cur.execute("SELECT id FROM locations ORDER BY id;")
+    return [row[0] for row in cur.fetchall()]
+
+def fetch_locations(cur):
+    cur.execute("SELECT id, name, created_at FROM locations ORDER BY id;")
+    return [dict(row) for row in cur.fetchall()]
+
+
+_known = frozenset()
+_known_loaded_at = 0.0
+
+def known_locations(get_conn=None, refresh=False):
+    """
+    Location ids cached per process for LOCATION_CACHE_TTL seconds. When they
+    need loading, get_conn() supplies the connection (the request's, in Flask
+    routes); without it a pooled connection is used. The load happens outside
+    any lock, so a request holding a connection never waits on one that doesn't.
+    """
+    global _known, _known_loaded_at
+    if refresh or time.monotonic() - _known_loaded_at > LOCATION_CACHE_TTL:
+        if get_conn is not None:
+            cur = get_conn().cursor()
+            ids = frozenset(location_ids(cur))
+            cur.close()
+        else:
+            with pooled_connection() as conn:
+                cur = conn.cursor()
+                ids = frozenset(location_ids(cur))
+                cur.close()
+        _known, _known_loaded_at = ids, time.monotonic()
+    return _known
+
+def from_request(args, headers, get_conn=None):
+    """
+    The location a request is scoped to: ?location=, else the X-Location
+    header, else DEFAULT_LOCATION.
+
+    Raises:
+        InvalidLocation: if no such location exists.
+    """
+    location = args.get('location') or headers.get('X-Location') or DEFAULT_LOCATION
+    # A location added since the cache was loaded shouldn't be rejected.
+    if location not in known_locations(get_conn) and location not in known_locations(get_conn, refresh=True):
+        raise InvalidLocation(f"Unknown location {location!r}")
+    return location
+
+
+def _months(first, count):
+    """`count` first-of-month dates starting with first's month."""
+    year, month = first.year, first.month
+    for _ in range(count):
+        yield date(year, month, 1)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def month_range(first, last):
+    """First-of-month dates of every month from first's to last's, inclusive."""
+    return list(_months(first, (last.year - first.year) * 12 + last.month - first.month + 1))
+
+
+def create_partitions(cur, location, months=()):
+    """
+    Creates the location's partitions if needed, and a monthly movement
+    partition for each date in `months` that doesn't have one. Call inside a
+    transaction.
+
+    Returns:
+        int: monthly partitions created.
+    """
+    cur.execute("SELECT create_location_partitions(%s);", (location,))
+    created = 0
+    for month in sorted(set(months)):
+        cur.execute("SELECT create_movement_partition(%s, %s);", (location, month))
+        created += cur.fetchone()[0]
+    return created
+
+
+def add_location(conn, location, name):
+    """Adds a location with its partitions for this month and the next PARTITION_MONTHS_AHEAD."""
+    if not LOCATION_ID_PATTERN.match(location or ''):
+        raise InvalidLocation("Location ids are 1-32 lowercase letters, digits or underscores")
+    cur = conn.cursor()
+    cur.execute("INSERT INTO locations (id, name) VALUES (%s, %s);", (location, name))
+    create_partitions(cur, location, _months(date.today(), PARTITION_MONTHS_AHEAD + 1))
+    conn.commit()
+    cur.close()
+
+
+def maintain(conn):
+    """
+    For every location, creates this month's and the next PARTITION_MONTHS_AHEAD
+    months' movement partitions, and moves rows that landed in the default
+    partition into partitions of their own. One transaction per location.
+
+    Returns:
+        int: monthly partitions created.
+    """
+    cur = conn.cursor()
+    created = 0
+    for location in location_ids(cur):
+        cur.execute("SELECT create_location_partitions(%s);", (location,))
+        cur.execute(sql.SQL("SELECT DISTINCT date_trunc('month', movement_date)::date FROM {};").format(
+            sql.Identifier(f"stock_movements_{location}_default")
+        ))
+        stray = [row[0] for row in cur.fetchall()]
+        created += create_partitions(cur, location, [*_months(date.today(), PARTITION_MONTHS_AHEAD + 1), *stray])
+        conn.commit()
+    cur.close()
+    return created
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage store locations and their partitions.")
+    parser.add_argument("command", choices=["add", "list", "maintain"])
+    parser.add_argument("location", nargs="?", help="add: the new location's id")
+    parser.add_argument("--name", help="add: display name (default: the id)")
+    args = parser.parse_args(argv)
+
+    with pooled_connection() as conn:
+        if args.command == "add":
+            try:
+                add_location(conn, args.location, args.name or args.location)
+            except (InvalidLocation, psycopg2.IntegrityError) as e:
+                print(f"Could not add location: {e}")
+                return 1
+            print(f"Added location {args.location}.")
+            return 0
+        if args.command == "maintain":
+            print(f"Created {maintain(conn)} monthly partitions.")
+            return 0
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        for row in fetch_locations(cur):
+            print(f"{row['id']:<34}{row['name']}")
+        cur.close()
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,8 @@
+-- Adds the per-day IN/OUT totals used by the stock_history running balance
+-- and indexes stock_movements for per-product range scans.
+-- After applying, populate the snapshot with: python ledger.py rebuild
+
+ALTER TABLE stock_history ADD COLUMN IF NOT EXISTS daily_in INT NOT NULL DEFAULT 0;
+ALTER TABLE stock_history ADD COLUMN IF NOT EXISTS daily_out INT NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_product_date ON stock_movements (product_id, movement_date);
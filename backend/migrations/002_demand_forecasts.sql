@@ -0,0 +1,17 @@
+-- Stores the fitted demand model and order-up-to level per product (see forecasting.py).
+-- After applying, fit the initial forecasts with: python forecasting.py rebuild
+
+CREATE TABLE IF NOT EXISTS demand_forecasts (
+    product_id VARCHAR(255) PRIMARY KEY,
+    fitted_through DATE NOT NULL,
+    level DOUBLE PRECISION NOT NULL,
+    seasonal DOUBLE PRECISION[] NOT NULL,
+    residual_var DOUBLE PRECISION NOT NULL,
+    observations INT NOT NULL,
+    horizon_days INT NOT NULL,
+    forecast DOUBLE PRECISION NOT NULL,
+    safety_stock DOUBLE PRECISION NOT NULL,
+    prediction INT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
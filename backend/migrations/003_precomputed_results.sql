@@ -0,0 +1,19 @@
+-- Storage for results precomputed by the background jobs in scheduler.py.
+
+CREATE TABLE IF NOT EXISTS precomputed_results (
+    key VARCHAR(255) PRIMARY KEY,
+    payload JSONB NOT NULL,
+    computed_for DATE NOT NULL,
+    computed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS scheduled_job_runs (
+    job_id VARCHAR(255) PRIMARY KEY,
+    last_started_at TIMESTAMP WITH TIME ZONE,
+    last_finished_at TIMESTAMP WITH TIME ZONE,
+    last_duration_ms DOUBLE PRECISION,
+    last_status VARCHAR(50),
+    last_error TEXT,
+    runs INT NOT NULL DEFAULT 0,
+    failures INT NOT NULL DEFAULT 0
+);
@@ -0,0 +1,16 @@
+-- Links stock movements to the invoice that produced them and indexes the
+-- movement log for keyset pagination on (movement_date, id).
+
+ALTER TABLE stock_movements ADD COLUMN IF NOT EXISTS invoice_id INT REFERENCES invoices(id) ON DELETE SET NULL;
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_date_id ON stock_movements (movement_date, id);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_invoice ON stock_movements (invoice_id);
+
+-- Backfill from the description written by save_invoice/update_invoice,
+-- "Received from <vendor> order #<invoice id>".
+UPDATE stock_movements m
+SET invoice_id = i.id
+FROM invoices i
+WHERE m.invoice_id IS NULL
+  AND m.description ~ '^Received from .* order #[0-9]+$'
+  AND i.id = substring(m.description from '#([0-9]+)$')::int;
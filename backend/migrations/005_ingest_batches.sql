@@ -0,0 +1,7 @@
+-- Idempotency keys and stored responses for POST /record-movements.
+
+CREATE TABLE IF NOT EXISTS ingest_batches (
+    idempotency_key VARCHAR(255) PRIMARY KEY,
+    response JSONB,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
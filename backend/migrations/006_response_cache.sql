@@ -0,0 +1,10 @@
+-- Shared storage for cache.py when RESPONSE_CACHE_BACKEND=postgres. UNLOGGED
+-- because the entries are disposable and shouldn't cost WAL writes.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS response_cache (
+    key VARCHAR(255) PRIMARY KEY,
+    body BYTEA NOT NULL,
+    etag VARCHAR(64) NOT NULL,
+    mimetype VARCHAR(255) NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
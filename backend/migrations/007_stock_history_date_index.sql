@@ -0,0 +1,4 @@
+-- Lets /stock-series read every product's daily totals for a date range with
+-- an index-only scan instead of a full pass over stock_history.
+
+CREATE INDEX IF NOT EXISTS idx_stock_history_date ON stock_history (record_date) INCLUDE (product_id, daily_in, daily_out);
@@ -0,0 +1,26 @@
+-- Alert state for alerts.py: the alerts currently firing, and the log of
+-- raised/cleared transitions that /alert-events and /alert-stream replay.
+
+CREATE TABLE IF NOT EXISTS active_alerts (
+    product_id VARCHAR(255) NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    threshold DOUBLE PRECISION NOT NULL,
+    message TEXT NOT NULL,
+    raised_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (product_id, type),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS alert_events (
+    id BIGSERIAL PRIMARY KEY,
+    product_id VARCHAR(255) NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    event VARCHAR(20) NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    threshold DOUBLE PRECISION NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_alert_events_created ON alert_events (created_at);
@@ -0,0 +1,27 @@
+-- Daily spending rollups maintained by spending.py. Amounts are unconstrained
+-- NUMERIC so that incremental updates and a rebuild agree to the cent.
+-- After applying, populate them with: python spending.py rebuild
+
+CREATE TABLE IF NOT EXISTS spending_daily_vendor (
+    spend_date DATE NOT NULL,
+    vendor_id VARCHAR(255) NOT NULL,
+    invoices INT NOT NULL,
+    spend NUMERIC NOT NULL,
+    items_cost NUMERIC NOT NULL,
+    bundle_savings NUMERIC NOT NULL,
+    shipping_paid NUMERIC NOT NULL,
+    shipping_saved NUMERIC NOT NULL,
+    PRIMARY KEY (spend_date, vendor_id),
+    FOREIGN KEY (vendor_id) REFERENCES vendors(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS spending_daily_product (
+    spend_date DATE NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    lines INT NOT NULL,
+    quantity NUMERIC NOT NULL,
+    spend NUMERIC NOT NULL,
+    bundle_savings NUMERIC NOT NULL,
+    PRIMARY KEY (spend_date, product_id),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
@@ -0,0 +1,50 @@
+-- Change log for the in-memory price index in optimization.py. Triggers on
+-- vendor_products and vendors keep one row per changed product or vendor with
+-- the id of the transaction that last changed it; a TRUNCATE of either table
+-- logs source 'all'. Each server process reads the rows from transactions
+-- newer than its last read and reloads only those entries.
+
+CREATE TABLE IF NOT EXISTS price_index_changes (
+    source VARCHAR(16) NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    PRIMARY KEY (source, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_price_index_changes_xid ON price_index_changes (xid);
+
+-- Arguments: the source to log and the column holding its key ('' for TRUNCATE).
+CREATE OR REPLACE FUNCTION log_price_index_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], '')
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid;
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], to_jsonb(OLD) ->> TG_ARGV[1])
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], to_jsonb(NEW) ->> TG_ARGV[1])
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER vendor_products_price_index
+    AFTER INSERT OR UPDATE OR DELETE ON vendor_products
+    FOR EACH ROW EXECUTE FUNCTION log_price_index_change('product', 'product_id');
+
+CREATE OR REPLACE TRIGGER vendor_products_price_index_truncate
+    AFTER TRUNCATE ON vendor_products
+    FOR EACH STATEMENT EXECUTE FUNCTION log_price_index_change('all');
+
+CREATE OR REPLACE TRIGGER vendors_price_index
+    AFTER INSERT OR UPDATE OR DELETE ON vendors
+    FOR EACH ROW EXECUTE FUNCTION log_price_index_change('vendor', 'id');
+
+CREATE OR REPLACE TRIGGER vendors_price_index_truncate
+    AFTER TRUNCATE ON vendors
+    FOR EACH STATEMENT EXECUTE FUNCTION log_price_index_change('all');
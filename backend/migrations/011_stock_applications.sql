@@ -0,0 +1,24 @@
+-- Queue of approved invoices waiting to be received into stock, worked by
+-- approvals.py. One row per invoice, so an invoice is applied at most once.
+
+CREATE TABLE IF NOT EXISTS stock_applications (
+    invoice_id INT PRIMARY KEY,
+    items JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    movements INT,
+    last_error TEXT,
+    queued_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP WITH TIME ZONE,
+    FOREIGN KEY (invoice_id) REFERENCES invoices(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_applications_queued ON stock_applications (invoice_id) WHERE status = 'queued';
+
+-- Invoices whose stock was received before the queue existed.
+INSERT INTO stock_applications (invoice_id, items, status, movements, queued_at, applied_at)
+SELECT i.id, COALESCE(i.items, '[]'::jsonb), 'applied', count(m.id), MIN(m.movement_date), MIN(m.movement_date)
+FROM invoices i
+JOIN stock_movements m ON m.invoice_id = i.id
+GROUP BY i.id
+ON CONFLICT (invoice_id) DO NOTHING;
@@ -0,0 +1,175 @@
+-- Makes the store (location) a dimension of stock data (see locations.py).
+--
+-- stock_movements becomes a partitioned table: one LIST partition per
+-- location, each split into monthly RANGE partitions on movement_date plus a
+-- default partition for months that don't have one yet. stock_history gets
+-- one LIST partition per location. Invoices, demand forecasts, alert state
+-- and the spending rollups carry the location in their keys. Everything that
+-- exists is moved into the 'main' location; set DEFAULT_LOCATION=main (the
+-- default) so requests without ?location= keep seeing it.
+--
+-- Run in a maintenance window: stock_movements and stock_history are copied
+-- into their new tables.
+
+CREATE TABLE IF NOT EXISTS locations (
+    id VARCHAR(32) PRIMARY KEY CHECK (id ~ '^[a-z0-9_]{1,32}$'),
+    name VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO locations (id, name) VALUES ('main', 'Main store') ON CONFLICT (id) DO NOTHING;
+
+-- Per (location, product) row that ledger writers lock before touching that
+-- product's stock_history, so stores don't serialize on the products table.
+CREATE TABLE IF NOT EXISTS stock_ledger_locks (
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    PRIMARY KEY (location_id, product_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+-- Creates a location's stock_movements and stock_history partitions.
+CREATE OR REPLACE FUNCTION create_location_partitions(p_location VARCHAR) RETURNS void AS $$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF stock_movements FOR VALUES IN (%L) PARTITION BY RANGE (movement_date)',
+                   'stock_movements_' || p_location, p_location);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I DEFAULT',
+                   'stock_movements_' || p_location || '_default', 'stock_movements_' || p_location);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF stock_history FOR VALUES IN (%L)',
+                   'stock_history_' || p_location, p_location);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Adds the month containing p_month to a location's movements, moving any of
+-- its rows out of the default partition first. Returns false if it existed.
+CREATE OR REPLACE FUNCTION create_movement_partition(p_location VARCHAR, p_month DATE) RETURNS boolean AS $$
+DECLARE
+    parent TEXT := 'stock_movements_' || p_location;
+    part TEXT := parent || '_' || to_char(p_month, 'YYYYMM');
+    month_start TIMESTAMP WITH TIME ZONE := date_trunc('month', p_month::timestamp with time zone);
+    month_end TIMESTAMP WITH TIME ZONE := date_trunc('month', p_month::timestamp with time zone) + interval '1 month';
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('movement-partitions:' || p_location));
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    -- Filled and then attached (rather than CREATE ... PARTITION OF) so only
+    -- this location's default partition is locked exclusively.
+    EXECUTE format('CREATE TABLE %I (LIKE stock_movements INCLUDING DEFAULTS)', part);
+    EXECUTE format('WITH moved AS (DELETE FROM %I WHERE movement_date >= %L AND movement_date < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                   parent || '_default', month_start, month_end, part);
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, part, month_start, month_end);
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Invoices and the tables keyed by product gain the location.
+
+ALTER TABLE invoices ADD COLUMN IF NOT EXISTS location_id VARCHAR(32) NOT NULL DEFAULT 'main' REFERENCES locations(id);
+ALTER TABLE invoices ALTER COLUMN location_id DROP DEFAULT;
+CREATE INDEX IF NOT EXISTS idx_invoices_location_date ON invoices (location_id, invoice_date);
+
+ALTER TABLE demand_forecasts ADD COLUMN IF NOT EXISTS location_id VARCHAR(32) NOT NULL DEFAULT 'main' REFERENCES locations(id) ON DELETE CASCADE;
+ALTER TABLE demand_forecasts ALTER COLUMN location_id DROP DEFAULT;
+ALTER TABLE demand_forecasts DROP CONSTRAINT demand_forecasts_pkey, ADD PRIMARY KEY (location_id, product_id);
+
+ALTER TABLE active_alerts ADD COLUMN IF NOT EXISTS location_id VARCHAR(32) NOT NULL DEFAULT 'main' REFERENCES locations(id) ON DELETE CASCADE;
+ALTER TABLE active_alerts ALTER COLUMN location_id DROP DEFAULT;
+ALTER TABLE active_alerts DROP CONSTRAINT active_alerts_pkey, ADD PRIMARY KEY (location_id, product_id, type);
+
+ALTER TABLE alert_events ADD COLUMN IF NOT EXISTS location_id VARCHAR(32) NOT NULL DEFAULT 'main';
+ALTER TABLE alert_events ALTER COLUMN location_id DROP DEFAULT;
+CREATE INDEX IF NOT EXISTS idx_alert_events_location ON alert_events (location_id, id);
+
+ALTER TABLE spending_daily_vendor ADD COLUMN IF NOT EXISTS location_id VARCHAR(32) NOT NULL DEFAULT 'main' REFERENCES locations(id) ON DELETE CASCADE;
+ALTER TABLE spending_daily_vendor ALTER COLUMN location_id DROP DEFAULT;
+ALTER TABLE spending_daily_vendor DROP CONSTRAINT spending_daily_vendor_pkey, ADD PRIMARY KEY (location_id, spend_date, vendor_id);
+
+ALTER TABLE spending_daily_product ADD COLUMN IF NOT EXISTS location_id VARCHAR(32) NOT NULL DEFAULT 'main' REFERENCES locations(id) ON DELETE CASCADE;
+ALTER TABLE spending_daily_product ALTER COLUMN location_id DROP DEFAULT;
+ALTER TABLE spending_daily_product DROP CONSTRAINT spending_daily_product_pkey, ADD PRIMARY KEY (location_id, spend_date, product_id);
+
+-- stock_movements and stock_history are rebuilt as partitioned tables.
+
+ALTER TABLE stock_movements RENAME TO stock_movements_unpartitioned;
+ALTER TABLE stock_movements_unpartitioned RENAME CONSTRAINT stock_movements_pkey TO stock_movements_unpartitioned_pkey;
+DROP INDEX IF EXISTS idx_stock_movements_product_date;
+DROP INDEX IF EXISTS idx_stock_movements_date_id;
+DROP INDEX IF EXISTS idx_stock_movements_invoice;
+
+CREATE TABLE stock_movements (
+    id INT NOT NULL DEFAULT nextval('stock_movements_id_seq'),
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    quantity INT NOT NULL,
+    total_cost NUMERIC(10, 2) DEFAULT 0,
+    movement_type VARCHAR(50) NOT NULL,
+    description TEXT,
+    movement_date TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    invoice_id INT,
+    PRIMARY KEY (movement_date, id, location_id),
+    FOREIGN KEY (location_id) REFERENCES locations(id),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
+    FOREIGN KEY (invoice_id) REFERENCES invoices(id) ON DELETE SET NULL
+) PARTITION BY LIST (location_id);
+
+ALTER SEQUENCE stock_movements_id_seq OWNED BY stock_movements.id;
+
+CREATE INDEX idx_stock_movements_product_date ON stock_movements (product_id, movement_date);
+CREATE INDEX idx_stock_movements_invoice ON stock_movements (invoice_id);
+
+ALTER TABLE stock_history RENAME TO stock_history_unpartitioned;
+ALTER TABLE stock_history_unpartitioned RENAME CONSTRAINT stock_history_pkey TO stock_history_unpartitioned_pkey;
+ALTER TABLE stock_history_unpartitioned RENAME CONSTRAINT stock_history_product_id_record_date_key TO stock_history_unpartitioned_product_id_record_date_key;
+DROP INDEX IF EXISTS idx_stock_history_date;
+
+CREATE TABLE stock_history (
+    id INT NOT NULL DEFAULT nextval('stock_history_id_seq'),
+    location_id VARCHAR(32) NOT NULL,
+    product_id VARCHAR(255) NOT NULL,
+    record_date DATE NOT NULL,
+    remaining_stock INT NOT NULL,
+    daily_in INT NOT NULL DEFAULT 0,
+    daily_out INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (location_id, id),
+    UNIQUE (location_id, product_id, record_date),
+    FOREIGN KEY (location_id) REFERENCES locations(id),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+) PARTITION BY LIST (location_id);
+
+ALTER SEQUENCE stock_history_id_seq OWNED BY stock_history.id;
+
+CREATE INDEX idx_stock_history_date ON stock_history (record_date) INCLUDE (product_id, daily_in, daily_out);
+
+SELECT create_location_partitions(id) FROM locations;
+SELECT create_movement_partition('main', month)
+FROM (
+    SELECT DISTINCT date_trunc('month', movement_date)::date as month FROM stock_movements_unpartitioned
+    UNION
+    SELECT generate_series(date_trunc('month', CURRENT_DATE), date_trunc('month', CURRENT_DATE) + interval '2 months', interval '1 month')::date
+) months
+ORDER BY month;
+
+INSERT INTO stock_movements (id, location_id, product_id, quantity, total_cost, movement_type, description, movement_date, invoice_id)
+SELECT id, 'main', product_id, quantity, total_cost, movement_type, description, COALESCE(movement_date, CURRENT_TIMESTAMP), invoice_id
+FROM stock_movements_unpartitioned;
+
+INSERT INTO stock_history (id, location_id, product_id, record_date, remaining_stock, daily_in, daily_out)
+SELECT id, 'main', product_id, record_date, remaining_stock, daily_in, daily_out
+FROM stock_history_unpartitioned;
+
+DROP TABLE stock_movements_unpartitioned;
+DROP TABLE stock_history_unpartitioned;
+
+INSERT INTO stock_ledger_locks (location_id, product_id)
+SELECT 'main', id FROM products
+ON CONFLICT DO NOTHING;
+
+-- Partitioned parents aren't analyzed by autovacuum.
+ANALYZE stock_movements;
+ANALYZE stock_history;
+
+-- Results and cached responses keyed without a location are dropped.
+DELETE FROM precomputed_results WHERE starts_with(key, 'stock-status:') OR starts_with(key, 'reorder-suggestions:');
+TRUNCATE response_cache;
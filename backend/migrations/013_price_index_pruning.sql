@@ -0,0 +1,31 @@
+-- Lets the scheduler prune price_index_changes (see optimization.py). Rows
+-- record when they were last written; price_index_pruned holds the newest
+-- xid pruned so far, and a price index whose last read is older reloads in
+-- full instead of missing the pruned changes.
+
+ALTER TABLE price_index_changes ADD COLUMN IF NOT EXISTS changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS price_index_pruned (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    through XID8 NOT NULL
+);
+
+-- Arguments: the source to log and the column holding its key ('' for TRUNCATE).
+CREATE OR REPLACE FUNCTION log_price_index_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], '')
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid, changed_at = EXCLUDED.changed_at;
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], to_jsonb(OLD) ->> TG_ARGV[1])
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid, changed_at = EXCLUDED.changed_at;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO price_index_changes (source, key) VALUES (TG_ARGV[0], to_jsonb(NEW) ->> TG_ARGV[1])
+        ON CONFLICT (source, key) DO UPDATE SET xid = EXCLUDED.xid, changed_at = EXCLUDED.changed_at;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,6 @@
+-- Lets the scheduler expire idempotency keys by age (movements.expire_batches).
+
+UPDATE ingest_batches SET received_at = CURRENT_TIMESTAMP WHERE received_at IS NULL;
+ALTER TABLE ingest_batches ALTER COLUMN received_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_ingest_batches_received_at ON ingest_batches (received_at);
@@ -0,0 +1,5 @@
+-- Per-location ledger version, bumped by every ledger write, so the scheduler
+-- can compute from a snapshot and check at store time that nothing changed
+-- instead of holding the location's stock_ledger_locks rows (see scheduler.py).
+
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS ledger_version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,382 @@
+# movements.py
+# Movement log queries and exports, and the bulk write path for stock movements.
+
+import base64, csv, io, json, os, threading, time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from db import pooled_connection
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+EXPORT_BATCH_SIZE = 2000
+EXPORT_MIMETYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+MAX_BATCH_ROWS = int(os.getenv("MAX_BATCH_ROWS", "50000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "60"))
+# How long a batch's idempotency key (and stored response) is kept, in seconds.
+INGEST_BATCH_RETENTION = int(os.getenv("INGEST_BATCH_RETENTION", str(7 * 86400)))
+
+LOG_COLUMNS = ['id', 'quantity', 'movement_type', 'description', 'movement_date', 'total_cost', 'product_name', 'approved_by']
+
+
+class InvalidLogQuery(ValueError):
+    """Raised for malformed filter or cursor parameters."""
+
+
+def encode_cursor(movement_date, movement_id):
+    raw = json.dumps([movement_date.isoformat(), movement_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        movement_date, movement_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(movement_date), int(movement_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidLogQuery("Invalid cursor") from e
+
+
+def _parse_date(value, name):
+    try:
+        return date.fromisoformat(value)
+    except ValueError as e:
+        raise InvalidLogQuery(f"Invalid '{name}' date") from e
+
+
+def is_paginated(args):
+    """Pages are only cut when the client asks for them; a plain read streams the whole filtered log."""
+    return bool(args.get('limit') or args.get('cursor'))
+
+
+def build_log_query(location, args, paginate=True):
+    """
+    Builds the location's movement log query from request args: productId,
+    type, from, to (inclusive dates), and for paginated reads limit (default
+    DEFAULT_PAGE_SIZE) and cursor.
+    Rows come newest first, ordered by (movement_date, id) so the keyset is
+    unique; from/to also limit the monthly partitions that are read.
+
+    Returns:
+        tuple: (sql, params, limit) where limit is None when not paginating.
+    """
+    conditions = ["m.location_id = %(location)s"]
+    params = {"location": location}
+    if args.get('productId'):
+        conditions.append("m.product_id = %(product_id)s")
+        params['product_id'] = args['productId']
+    if args.get('type'):
+        conditions.append("m.movement_type = %(movement_type)s")
+        params['movement_type'] = args['type']
+    # Ranges on the raw timestamp (not movement_date::date) so the index applies.
+    if args.get('from'):
+        conditions.append("m.movement_date >= %(from)s::timestamptz")
+        params['from'] = _parse_date(args['from'], 'from')
+    if args.get('to'):
+        conditions.append("m.movement_date < %(to)s::timestamptz")
+        params['to'] = _parse_date(args['to'], 'to') + timedelta(days=1)
+
+    limit = None
+    if paginate:
+        try:
+            limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        except ValueError as e:
+            raise InvalidLogQuery("Invalid 'limit'") from e
+        if args.get('cursor'):
+            conditions.append("(m.movement_date, m.id) < (%(cursor_date)s, %(cursor_id)s)")
+            params['cursor_date'], params['cursor_id'] = decode_cursor(args['cursor'])
+        # One extra row tells us whether there is a next page.
+        params['limit'] = limit + 1
+
+    query = f"""
+        SELECT
+            m.id,
+            m.quantity,
+            m.movement_type,
+            m.description,
+            m.movement_date,
+            m.total_cost,
+            p.name as product_name,
+            i.modified_by as approved_by
+        FROM stock_movements m
+        JOIN products p ON m.product_id = p.id
+        LEFT JOIN invoices i ON i.id = m.invoice_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY m.movement_date DESC, m.id DESC
+        {"LIMIT %(limit)s" if paginate else ""}
+    """
+    return query, params, limit
+
+
+def fetch_log_page(cur, location, args):
+    """
+    Returns:
+        tuple: (rows, next_cursor) where next_cursor is None on the last page.
+    """
+    query, params, limit = build_log_query(location, args)
+    cur.execute(query, params)
+    return split_page([dict(row) for row in cur.fetchall()], limit)
+
+def split_page(rows, limit):
+    """Drops the look-ahead row of a limit + 1 query and encodes the next cursor from the last kept row."""
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]['movement_date'], rows[-1]['id'])
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def export_head(export_format):
+    """Text that starts an export: the CSV header row, or the opening bracket of a JSON array."""
+    if export_format == 'csv':
+        return export_rows([LOG_COLUMNS], 'csv')
+    return '[' if export_format == 'json' else ''
+
+def export_tail(export_format):
+    return ']' if export_format == 'json' else ''
+
+def export_rows(rows, export_format, first=True):
+    """
+    Formats rows of LOG_COLUMNS values as CSV, NDJSON or JSON array elements
+    (with a leading comma unless they are the first batch).
+    """
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([[_export_value(v) for v in row] for row in rows])
+        return buffer.getvalue()
+    objects = [json.dumps(dict(zip(LOG_COLUMNS, map(_export_value, row)))) for row in rows]
+    if export_format == 'json':
+        return ('' if first else ',') + ','.join(objects)
+    return ''.join(line + '\n' for line in objects)
+
+
+def stream_log(location, args, export_format):
+    """
+    Yields the whole (filtered) log as a JSON array, NDJSON lines or CSV
+    text. Rows are read through a server-side cursor in batches, so memory
+    stays flat however long the log is. Uses its own pooled connection because the generator outlives
+    the request that created it.
+    """
+    query, params, _ = build_log_query(location, args, paginate=False)
+
+    def generate():
+        with pooled_connection() as conn:
+            cur = conn.cursor(name='movement_log_export')
+            cur.itersize = EXPORT_BATCH_SIZE
+            cur.execute(query, params)
+            yield export_head(export_format)
+            first = True
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield export_rows(rows, export_format, first)
+                first = False
+            yield export_tail(export_format)
+            cur.close()
+
+    return generate()
+
+
+# =================================================================
+# Bulk ingestion
+# =================================================================
+
+_INSERT_COLUMNS = ['product_id', 'quantity', 'movement_type', 'description', 'total_cost', 'movement_date', 'invoice_id']
+
+
+def insert_movements(cur, location, rows):
+    """
+    Writes many movements at a location with one COPY into a temporary staging
+    table and one INSERT ... SELECT, instead of a round trip per row.
+
+    Args:
+        rows: dicts with product_id, quantity, movement_type and optionally
+            description, total_cost, movement_date (defaults to now) and invoice_id.
+
+    Returns:
+        list: (product_id, quantity, movement_type, record_date) per inserted
+        row, ready for ledger.apply_movements().
+    """
+    if not rows:
+        return []
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            row['product_id'], row['quantity'], row['movement_type'], row.get('description'),
+            row.get('total_cost', 0), row.get('movement_date'), row.get('invoice_id')
+        ])
+    buffer.seek(0)
+
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS movement_staging (
+            product_id VARCHAR(255), quantity INT, movement_type VARCHAR(50), description TEXT,
+            total_cost NUMERIC(10, 2), movement_date TIMESTAMP WITH TIME ZONE, invoice_id INT
+        ) ON COMMIT DELETE ROWS;
+    """)
+    # csv writes None as an empty field; FORCE_NULL reads those back as NULL.
+    cur.copy_expert(
+        f"COPY movement_staging ({', '.join(_INSERT_COLUMNS)}) FROM STDIN "
+        "WITH (FORMAT csv, FORCE_NULL (description, total_cost, movement_date, invoice_id))",
+        buffer
+    )
+    cur.execute("""
+        INSERT INTO stock_movements (location_id, product_id, quantity, movement_type, description, total_cost, movement_date, invoice_id)
+        SELECT %s, product_id, quantity, movement_type, description, COALESCE(total_cost, 0),
+               COALESCE(movement_date, CURRENT_TIMESTAMP), invoice_id
+        FROM movement_staging
+        RETURNING product_id, quantity, movement_type, movement_date::date;
+    """, (location,))
+    inserted = cur.fetchall()
+    cur.execute("TRUNCATE movement_staging;")
+    return inserted
+
+
+_product_ids = frozenset()
+_product_ids_loaded_at = 0.0
+_product_ids_lock = threading.Lock()
+
+def known_product_ids(cur, refresh=False):
+    """Product ids cached per process for PRODUCT_CACHE_TTL seconds."""
+    global _product_ids, _product_ids_loaded_at
+    with _product_ids_lock:
+        if refresh or time.monotonic() - _product_ids_loaded_at > PRODUCT_CACHE_TTL:
+            cur.execute("SELECT id FROM products;")
+            _product_ids = frozenset(row[0] for row in cur.fetchall())
+            _product_ids_loaded_at = time.monotonic()
+        return _product_ids
+
+
+def parse_batch(body, content_type):
+    """
+    Splits a request body into raw records. JSON bodies must be an array;
+    application/x-ndjson bodies have one object per line.
+
+    Returns:
+        tuple: (records, errors) where records are (index, object) pairs and
+        errors are per-line parse failures.
+    """
+    if 'ndjson' in (content_type or ''):
+        records, errors = [], []
+        for index, line in enumerate(body.splitlines()):
+            if not line.strip():
+                continue
+            try:
+                records.append((index, json.loads(line)))
+            except ValueError as e:
+                errors.append({"index": index, "error": f"Invalid JSON: {e}"})
+        return records, errors
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise InvalidBatch(f"Invalid JSON: {e}") from e
+    if not isinstance(payload, list):
+        raise InvalidBatch("Expected a JSON array of movements")
+    return list(enumerate(payload)), []
+
+
+class InvalidBatch(ValueError):
+    """Raised when a batch can't be read at all (as opposed to per-row errors)."""
+
+
+def _validate_record(record, product_ids):
+    """Maps one API record to an insert row, or returns an error message."""
+    if not isinstance(record, dict):
+        return None, "Expected an object"
+    product_id = record.get('productId')
+    if product_id not in product_ids:
+        return None, f"Unknown productId {product_id!r}"
+    quantity = record.get('quantity')
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity == 0:
+        return None, "quantity must be a non-zero integer"
+    movement_type = record.get('movementType')
+    if not isinstance(movement_type, str) or not 0 < len(movement_type) <= 50:
+        return None, "movementType must be a non-empty string"
+    description = record.get('description')
+    if description is not None and not isinstance(description, str):
+        return None, "description must be a string"
+    total_cost = record.get('totalCost', 0)
+    if not isinstance(total_cost, (int, float)) or isinstance(total_cost, bool):
+        return None, "totalCost must be a number"
+    movement_date = record.get('movementDate')
+    if movement_date is not None:
+        try:
+            # fromisoformat only accepts a 'Z' offset from Python 3.11 on.
+            if isinstance(movement_date, str) and movement_date.endswith(('Z', 'z')):
+                movement_date = movement_date[:-1] + '+00:00'
+            movement_date = datetime.fromisoformat(movement_date)
+        except (TypeError, ValueError):
+            return None, "movementDate must be an ISO 8601 timestamp"
+    return {
+        "product_id": product_id, "quantity": quantity, "movement_type": movement_type,
+        "description": description, "total_cost": total_cost,
+        "movement_date": movement_date.isoformat() if movement_date else None,
+    }, None
+
+
+def validate_batch(cur, records):
+    """
+    Returns:
+        tuple: (rows, errors) with the insertable rows and an {index, error}
+        entry for every rejected record.
+    """
+    if len(records) > MAX_BATCH_ROWS:
+        raise InvalidBatch(f"Batches are limited to {MAX_BATCH_ROWS} movements")
+    product_ids = known_product_ids(cur)
+    if any(isinstance(r, dict) and r.get('productId') not in product_ids for _, r in records):
+        # A product created since the cache was loaded shouldn't be rejected.
+        product_ids = known_product_ids(cur, refresh=True)
+
+    rows, errors = [], []
+    for index, record in records:
+        row, error = _validate_record(record, product_ids)
+        if error:
+            errors.append({"index": index, "error": error})
+        else:
+            rows.append(row)
+    return rows, errors
+
+
+def claim_batch(cur, idempotency_key):
+    """
+    Registers an idempotency key inside the writing transaction.
+
+    Returns:
+        The stored response of an earlier batch with the same key, or None if
+        this is the first time the key is seen. A concurrent batch with the
+        same key blocks here until that one commits or rolls back.
+    """
+    cur.execute(
+        "INSERT INTO ingest_batches (idempotency_key) VALUES (%s) ON CONFLICT DO NOTHING RETURNING idempotency_key;",
+        (idempotency_key,)
+    )
+    if cur.fetchone():
+        return None
+    cur.execute("SELECT response FROM ingest_batches WHERE idempotency_key = %s;", (idempotency_key,))
+    return cur.fetchone()[0]
+
+def complete_batch(cur, idempotency_key, response):
+    cur.execute(
+        "UPDATE ingest_batches SET response = %s WHERE idempotency_key = %s;",
+        (json.dumps(response), idempotency_key)
+    )
+
+def expire_batches(conn):
+    """Deletes idempotency keys older than INGEST_BATCH_RETENTION seconds. Returns how many."""
+    cur = conn.cursor()
+    cur.execute(
+        "DELETE FROM ingest_batches WHERE received_at < CURRENT_TIMESTAMP - %s * interval '1 second';",
+        (INGEST_BATCH_RETENTION,)
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    cur.close()
+    return deleted
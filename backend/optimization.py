@@ -2,7 +2,10 @@
 # Logic to find the most cost-effective purchasing options, calculate savings,
 # and filter by selected vendors.
 
-import json
+import json, os, threading, time
+
+import numpy as np
+import pandas as pd
 
 def _calculate_item_cost(quantity, product_pricing):
     """
@@ -35,36 +38,781 @@ def _calculate_item_cost(quantity, product_pricing):
     return {"cost": cost, "nonDiscountedCost": non_discounted_cost, "savings": savings}
 
 
+def _load_vendor_offers(product_ids, db_connection, vendor_filter=None):
+    """
+    Loads every vendor offer for the given products, together with the vendor's
+    shipping terms, in a single query.
+    """
+    query = """
+        SELECT vp.product_id, vp.vendor_id, vp.price, vp.bundles,
+               v.name, v.shipping_cost, v.free_shipping_threshold
+        FROM vendor_products vp
+        JOIN vendors v ON v.id = vp.vendor_id
+        WHERE vp.product_id = ANY(%s)
+    """
+    params = [list(product_ids)]
+    if vendor_filter:
+        query += ' AND vp.vendor_id = ANY(%s)'
+        params.append(list(vendor_filter))
+
+    cur = db_connection.cursor()
+    cur.execute(query, tuple(params))
+    rows = cur.fetchall()
+    cur.close()
+    return pd.DataFrame(rows, columns=[
+        'product_id', 'vendor_id', 'price', 'bundles',
+        'vendor_name', 'shipping_cost', 'free_shipping_threshold'
+    ])
+
+
+def _bundle_matrix(bundles_column):
+    """
+    Bundle quantities and prices as (offers x depth) arrays, largest bundle
+    first in each row and zero-padded, for _greedy_costs.
+    """
+    sorted_bundles = [
+        sorted(bundles, key=lambda b: b['quantity'], reverse=True) if bundles else []
+        for bundles in bundles_column
+    ]
+    depth = max((len(b) for b in sorted_bundles), default=0)
+    bundle_qty = np.zeros((len(sorted_bundles), depth), dtype=np.int64)
+    bundle_price = np.zeros((len(sorted_bundles), depth), dtype=np.float64)
+    for row, bundles in enumerate(sorted_bundles):
+        for rank, bundle in enumerate(bundles):
+            bundle_qty[row, rank] = bundle['quantity']
+            bundle_price[row, rank] = bundle['price']
+    return bundle_qty, bundle_price
+
+
+def _greedy_costs(quantities, prices, bundle_qty, bundle_price):
+    """
+    Applies the bundles of a _bundle_matrix largest first, one bundle rank at a
+    time across all rows, so the floating point operations happen in the same
+    order as _calculate_item_cost.
+
+    Returns:
+        tuple: numpy arrays (cost, nonDiscountedCost, savings).
+    """
+    remaining = np.asarray(quantities, dtype=np.int64).copy()
+    cost = np.zeros(len(remaining), dtype=np.float64)
+    for rank in range(bundle_qty.shape[1]):
+        qty = bundle_qty[:, rank]
+        num_bundles = np.where(qty > 0, remaining // np.where(qty > 0, qty, 1), 0)
+        cost += num_bundles * bundle_price[:, rank]
+        remaining -= num_bundles * qty
+
+    cost += remaining * prices
+    non_discounted_cost = np.asarray(quantities, dtype=np.int64) * prices
+    return cost, non_discounted_cost, non_discounted_cost - cost
+
+
+def _calculate_offer_costs(quantities, prices, bundles_column):
+    """
+    Vectorized version of _calculate_item_cost over many (quantity, offer) rows.
+
+    Returns:
+        tuple: numpy arrays (cost, nonDiscountedCost, savings).
+    """
+    return _greedy_costs(quantities, prices, *_bundle_matrix(bundles_column))
+
+
+def _price_offers(quantities, db_connection, vendor_filter):
+    """
+    Prices every offer for the given {product id: quantity} from the price
+    index: 'cost'/'savings' with the greedy bundle rule, 'optimal_cost'/
+    'optimal_savings' with the exact bundle packing.
+    """
+    return _price_index.price(db_connection, quantities, vendor_filter)
+
+
+def _cheapest_offers(offers):
+    # idxmin keeps the first of several equally cheap offers, matching the
+    # strict '<' comparison of the per-item search.
+    return offers.loc[offers.groupby('product_id', sort=False)['cost'].idxmin()]
+
+
+def _offer_option(offer, cost, savings):
+    return {
+        "vendor_id": offer.vendor_id,
+        "cost": float(cost),
+        "savings": float(savings),
+        "price": offer.price,
+        "bundles": offer.bundles,
+        "vendor_name": offer.vendor_name,
+        "shipping_cost": offer.shipping_cost,
+        "free_shipping_threshold": offer.free_shipping_threshold,
+    }
+
+
+def find_best_vendors(items, db_connection, vendor_filter=[]):
+    """
+    Finds the cheapest vendor for every item in one pass: all candidate offers
+    are fetched with a single query and priced together in memory.
+
+    Returns:
+        dict: product id -> {'vendor_id', 'cost', 'savings', 'price', 'bundles',
+        'vendor_name', 'shipping_cost', 'free_shipping_threshold'} for each item
+        that at least one (allowed) vendor sells.
+    """
+    quantities = {item['id']: item['order_amount'] for item in items}
+    if not quantities:
+        return {}
+
+    offers = _price_offers(quantities, db_connection, vendor_filter)
+    if offers.empty:
+        return {}
+
+    return {
+        offer.product_id: _offer_option(offer, offer.cost, offer.savings)
+        for offer in _cheapest_offers(offers).itertuples(index=False)
+    }
+
+
 def find_best_vendor_for_item(item, db_connection, vendor_filter=[]):
     """
     Finds the cheapest vendor for a single item, optionally filtered by a list of vendor IDs.
     """
-    best_option = {"vendor_id": None, "cost": float('inf'), "savings": 0}
-    cur = db_connection.cursor()
+    best_option = find_best_vendors([item], db_connection, vendor_filter).get(item['id'])
+    if best_option is None:
+        return {"vendor_id": None, "cost": float('inf'), "savings": 0}
+    return {"vendor_id": best_option['vendor_id'], "cost": best_option['cost'], "savings": best_option['savings']}
 
-    query = 'SELECT vendor_id, price, bundles FROM vendor_products WHERE product_id = %s'
-    params = [item['id']]
 
-    # If a filter is provided, add it to the query
-    if vendor_filter:
-        query += ' AND vendor_id = ANY(%s)'
-        params.append(vendor_filter)
+# =================================================================
+# Whole-basket optimization
+# =================================================================
+# The greedy mode above prices each item in isolation and only applies the
+# vendors' shipping rules afterwards. The basket mode prices every offer with
+# an exact bundle DP and then searches vendor assignments for the lowest total
+# including shipping (a vendor charges shipping_cost unless its subtotal
+# reaches free_shipping_threshold).
 
-    cur.execute(query, tuple(params))
-    all_vendor_prices = cur.fetchall()
+BASKET_TIME_BUDGET = float(os.getenv("BASKET_TIME_BUDGET", "2.0"))
+_EPSILON = 1e-9
 
-    for vendor_price_info in all_vendor_prices:
-        vendor_id, price, bundles = vendor_price_info
-        
-        cost_details = _calculate_item_cost(
-            item['order_amount'], 
-            (float(price), bundles)
-        )
-        
-        if cost_details['cost'] < best_option['cost']:
-            best_option['vendor_id'] = vendor_id
-            best_option['cost'] = cost_details['cost']
-            best_option['savings'] = cost_details['savings']
-            
+
+def _optimal_bundle_costs(max_quantity, price, bundles):
+    """
+    Exact minimum cost of buying every quantity 0..max_quantity from one vendor,
+    using any mix of single units and (unbounded) bundles.
+
+    For one bundle of size b and price P the recurrence
+    cost'[q] = min_k cost[q - k*b] + k*P splits into b independent residue
+    classes, and within a class it is a running minimum of cost[m] - m*P, so
+    each bundle costs one reshape and one np.minimum.accumulate.
+
+    Returns:
+        numpy array: cost by quantity.
+    """
+    length = max_quantity + 1
+    costs = np.arange(length, dtype=np.float64) * float(price)
+    for bundle in bundles or []:
+        size = int(bundle['quantity'])
+        if size <= 0 or size > max_quantity:
+            continue
+        rows = -(-length // size)
+        grid = np.full(rows * size, np.inf)
+        grid[:length] = costs
+        grid = grid.reshape(rows, size)
+        offset = np.arange(rows, dtype=np.float64)[:, None] * float(bundle['price'])
+        grid = np.minimum.accumulate(grid - offset, axis=0) + offset
+        costs = grid.ravel()[:length]
+    return costs
+
+
+def _calculate_optimal_offer_costs(quantities, prices, bundles_column):
+    """
+    Same contract as _calculate_offer_costs, but with the exact bundle packing.
+    Offers without bundles are priced vectorized; a single bundle has a closed
+    form (all-bundles or no-bundles is always optimal); only offers with two or
+    more bundle sizes need the DP.
+    """
+    quantities = np.asarray(quantities, dtype=np.int64)
+    non_discounted_cost = quantities * prices
+    cost = non_discounted_cost.copy()
+    for row, bundles in enumerate(bundles_column):
+        bundles = [b for b in bundles or [] if b['quantity'] > 0]
+        if not bundles:
+            continue
+        quantity = int(quantities[row])
+        if len(bundles) == 1:
+            count = quantity // bundles[0]['quantity']
+            bundled = count * float(bundles[0]['price']) + (quantity - count * bundles[0]['quantity']) * prices[row]
+            cost[row] = min(cost[row], bundled)
+        else:
+            cost[row] = _optimal_bundle_costs(quantity, prices[row], bundles)[quantity]
+    return cost, non_discounted_cost, non_discounted_cost - cost
+
+
+class _BasketSearch:
+    """
+    Assignment search over an (items x vendors) cost matrix, where inf marks a
+    vendor that doesn't sell the item.
+    """
+
+    def __init__(self, cost, shipping, threshold, deadline):
+        self.cost = cost
+        self.shipping = shipping
+        self.threshold = threshold
+        self.deadline = deadline
+        self.items = np.arange(cost.shape[0])
+        self.vendor_count = cost.shape[1]
+        self.nodes = 0
+        self.timed_out = False
+
+    def _expired(self):
+        if time.monotonic() > self.deadline:
+            self.timed_out = True
+        return self.timed_out
+
+    def _shipping_for(self, subtotals, vendors=slice(None)):
+        return np.where(subtotals >= self.threshold[vendors], 0.0, self.shipping[vendors])
+
+    def _tally(self, assign):
+        subtotals = np.bincount(assign, weights=self.cost[self.items, assign], minlength=self.vendor_count)
+        counts = np.bincount(assign, minlength=self.vendor_count)
+        return subtotals, counts
+
+    def total(self, assign):
+        subtotals, counts = self._tally(assign)
+        return float(subtotals.sum() + self._shipping_for(subtotals)[counts > 0].sum())
+
+    def cheapest(self, allowed):
+        masked = np.where(allowed, self.cost, np.inf)
+        return masked.argmin(axis=1)
+
+    def _best_single_move(self, assign, allowed, subtotals, counts):
+        """Change in total for moving each item to each vendor, as one (items x vendors) array."""
+        src_cost = self.cost[self.items, assign]
+        src_before = self._shipping_for(subtotals[assign], assign)
+        src_after = np.where(counts[assign] == 1, 0.0, self._shipping_for(subtotals[assign] - src_cost, assign))
+        dst_before = np.where(counts > 0, self._shipping_for(subtotals), 0.0)
+        dst_after = self._shipping_for(subtotals[None, :] + self.cost)
+        delta = (self.cost - src_cost[:, None] + (src_after - src_before)[:, None]
+                 + dst_after - dst_before[None, :])
+        delta[self.items, assign] = 0.0
+        delta[:, ~allowed] = np.inf
+        item, vendor = np.unravel_index(delta.argmin(), delta.shape)
+        return item, vendor, delta[item, vendor]
+
+    def _group_moves(self, assign, allowed, counts):
+        """
+        Candidate assignments that move several items at once: closing a vendor
+        (its items go to the cheapest other open vendor), or topping a vendor up
+        to its free shipping threshold with the items that cost least extra there.
+        """
+        subtotals, _ = self._tally(assign)
+        current = self.cost[self.items, assign]
+        for vendor in np.flatnonzero(counts):
+            others = allowed & (counts > 0)
+            others[vendor] = False
+            members = assign == vendor
+            if not others.any():
+                continue
+            options = np.where(others, self.cost[members], np.inf)
+            if np.isfinite(options.min(axis=1)).all():
+                candidate = assign.copy()
+                candidate[members] = options.argmin(axis=1)
+                yield candidate
+
+        for vendor in np.flatnonzero(allowed & (subtotals < self.threshold)):
+            movable = np.flatnonzero((assign != vendor) & np.isfinite(self.cost[:, vendor]))
+            if not len(movable):
+                continue
+            extra = self.cost[movable, vendor] - current[movable]
+            movable = movable[np.argsort(extra, kind='stable')]
+            reached = np.searchsorted(
+                np.cumsum(self.cost[movable, vendor]), self.threshold[vendor] - subtotals[vendor]
+            )
+            if reached < len(movable):
+                candidate = assign.copy()
+                candidate[movable[:reached + 1]] = vendor
+                yield candidate
+
+    def improve(self, assign, allowed):
+        """
+        Local search until no move helps: repeatedly apply the best single-item
+        move, then try the group moves from _group_moves().
+        """
+        assign = assign.copy()
+        current = self.total(assign)
+        improved = True
+        while improved and not self._expired():
+            improved = False
+            subtotals, counts = self._tally(assign)
+            while not self._expired():
+                item, vendor, delta = self._best_single_move(assign, allowed, subtotals, counts)
+                if not delta < -_EPSILON:
+                    break
+                src = assign[item]
+                subtotals[src] -= self.cost[item, src]
+                counts[src] -= 1
+                if counts[src] == 0:
+                    subtotals[src] = 0.0
+                subtotals[vendor] += self.cost[item, vendor]
+                counts[vendor] += 1
+                assign[item] = vendor
+                improved = True
+
+            current = self.total(assign)
+            for candidate in self._group_moves(assign, allowed, counts):
+                candidate_total = self.total(candidate)
+                if candidate_total < current - _EPSILON:
+                    assign, current = candidate, candidate_total
+                    improved = True
+                    break
+        return assign
+
+    def branch_and_bound(self, assign):
+        """
+        Depth-first search over which vendors may be used. The bound is the sum
+        of each item's cheapest remaining offer, which no assignment restricted
+        to those vendors can beat; leaves are refined with improve().
+        """
+        best = [self.total(assign), assign]
+        finite = np.isfinite(self.cost)
+        popularity = np.bincount(self.cheapest(np.ones(self.vendor_count, dtype=bool)), minlength=self.vendor_count)
+        order = [v for v in np.argsort(-popularity, kind='stable') if finite[:, v].any()]
+
+        def visit(depth, included, excluded):
+            if self._expired():
+                return
+            self.nodes += 1
+            candidates = ~excluded
+            bound = np.where(candidates, self.cost, np.inf).min(axis=1).sum()
+            if not bound < best[0] - _EPSILON:
+                return
+            if depth == len(order):
+                leaf = self.cheapest(included)
+                # A vendor that no item picks is the same leaf as excluding it.
+                if (np.bincount(leaf, minlength=self.vendor_count)[included] == 0).any():
+                    return
+                leaf = self.improve(leaf, included)
+                leaf_total = self.total(leaf)
+                if leaf_total < best[0] - _EPSILON:
+                    best[0], best[1] = leaf_total, leaf
+                return
+            vendor = order[depth]
+            with_vendor = included.copy()
+            with_vendor[vendor] = True
+            visit(depth + 1, with_vendor, excluded)
+            without_vendor = excluded.copy()
+            without_vendor[vendor] = True
+            visit(depth + 1, included, without_vendor)
+
+        visit(0, np.zeros(self.vendor_count, dtype=bool), np.zeros(self.vendor_count, dtype=bool))
+        return best[1]
+
+
+def _basket_total(costs, vendor_ids, shipping_by_vendor, threshold_by_vendor):
+    subtotals = pd.Series(costs).groupby(np.asarray(vendor_ids)).sum()
+    shipping = sum(
+        0.0 if subtotal >= threshold_by_vendor[vendor] else shipping_by_vendor[vendor]
+        for vendor, subtotal in subtotals.items()
+    )
+    return float(subtotals.sum() + shipping)
+
+
+def optimize_basket(items, db_connection, vendor_filter=[], time_budget=None):
+    """
+    Chooses vendors for the whole order at once, minimizing item cost plus
+    shipping, with exact bundle packing per item.
+
+    Returns:
+        tuple: (options, summary). options has the same shape as the result of
+        find_best_vendors; summary reports the greedy baseline total, the
+        optimized total, the savings between them and how the search ended.
+    """
+    started = time.monotonic()
+    time_budget = BASKET_TIME_BUDGET if time_budget is None else time_budget
+    quantities = {item['id']: item['order_amount'] for item in items}
+    summary = {"mode": "basket", "greedyTotalCost": 0.0, "totalCost": 0.0, "savingsVsGreedy": 0.0,
+               "timedOut": False, "nodesExplored": 0, "elapsedMs": 0.0}
+    if not quantities:
+        return {}, summary
+    offers = _price_offers(quantities, db_connection, vendor_filter)
+    if offers.empty:
+        return {}, summary
+
+    optimal_cost = offers['optimal_cost'].to_numpy()
+
+    vendors = offers.drop_duplicates('vendor_id').set_index('vendor_id')
+    shipping_by_vendor = vendors['shipping_cost'].astype(float)
+    threshold_by_vendor = vendors['free_shipping_threshold'].astype(float).fillna(np.inf)
+
+    greedy = _cheapest_offers(offers)
+    summary["greedyTotalCost"] = _basket_total(
+        greedy['cost'].to_numpy(), greedy['vendor_id'].to_numpy(), shipping_by_vendor, threshold_by_vendor
+    )
+
+    product_ids = pd.Index(greedy['product_id'])
+    vendor_ids = vendors.index
+    rows = product_ids.get_indexer(offers['product_id'])
+    cols = vendor_ids.get_indexer(offers['vendor_id'])
+    cost = np.full((len(product_ids), len(vendor_ids)), np.inf)
+    cost[rows, cols] = optimal_cost
+    offer_index = np.full(cost.shape, -1, dtype=np.int64)
+    offer_index[rows, cols] = np.arange(len(offers))
+
+    search = _BasketSearch(
+        cost, shipping_by_vendor.to_numpy(), threshold_by_vendor.to_numpy(),
+        deadline=started + time_budget
+    )
+    everyone = np.ones(len(vendor_ids), dtype=bool)
+    starts = [search.cheapest(everyone), vendor_ids.get_indexer(greedy['vendor_id'])]
+    assign = min((search.improve(start, everyone) for start in starts), key=search.total)
+    assign = search.branch_and_bound(assign)
+
+    options = {}
+    for i, vendor in enumerate(assign):
+        offer = offers.iloc[offer_index[i, vendor]]
+        options[offer.product_id] = _offer_option(offer, offer.optimal_cost, offer.optimal_savings)
+
+    total = search.total(assign)
+    summary.update({
+        "totalCost": total,
+        "savingsVsGreedy": summary["greedyTotalCost"] - total,
+        "timedOut": search.timed_out,
+        "nodesExplored": search.nodes,
+        "elapsedMs": round((time.monotonic() - started) * 1000, 3),
+    })
+    return options, summary
+
+
+# =================================================================
+# Price index
+# =================================================================
+# Each process keeps every vendor offer in memory, keyed by product, with its
+# bundles parsed and sorted once. Offers with two or more bundle sizes also
+# keep their exact cost for every quantity up to PRICE_INDEX_MAX_QUANTITY
+# (_optimal_bundle_costs), so pricing one is an array lookup; offers with no
+# or one bundle size have a closed form, and larger quantities run the DP for
+# that offer only.
+#
+# Triggers on vendor_products and vendors (migrations/010) log which products
+# and vendors changed, with the changing transaction's id. Before each use the
+# index reads the entries from transactions at or after the xmin of its last
+# read's snapshot (so a transaction that was still open then isn't missed)
+# and reloads just those products or vendors; a TRUNCATE reloads everything.
+#
+# The scheduler prunes change rows older than PRICE_INDEX_CHANGE_RETENTION
+# (prune_price_index_changes) and records the newest xid it deleted; an index
+# whose last read is older than that reloads everything, since it may have
+# missed a pruned change.
+
+PRICE_INDEX_MAX_QUANTITY = int(os.getenv("PRICE_INDEX_MAX_QUANTITY", "1000"))
+PRICE_INDEX_CHANGE_RETENTION = int(os.getenv("PRICE_INDEX_CHANGE_RETENTION", "86400"))
+
+_INDEX_CHANGES_QUERY = """
+    SELECT s.horizon::text, p.through::text, c.source, c.key, c.xid::text
+    FROM (SELECT pg_snapshot_xmin(pg_current_snapshot()) as horizon) s
+    LEFT JOIN price_index_pruned p ON true
+    LEFT JOIN price_index_changes c ON c.xid >= %(after)s::xid8;
+"""
+
+# Only changes every open snapshot can already see are pruned.
+_PRUNE_CHANGES_QUERY = """
+    WITH pruned AS (
+        DELETE FROM price_index_changes
+        WHERE changed_at < CURRENT_TIMESTAMP - %(retention)s * interval '1 second'
+          AND xid < pg_snapshot_xmin(pg_current_snapshot())
+        RETURNING xid
+    ), newest AS (
+        SELECT xid FROM pruned ORDER BY xid DESC LIMIT 1
+    )
+    INSERT INTO price_index_pruned (id, through)
+    SELECT true, xid FROM newest
+    ON CONFLICT (id) DO UPDATE SET through = GREATEST(price_index_pruned.through, EXCLUDED.through)
+    RETURNING (SELECT count(*) FROM pruned);
+"""
+
+_INDEX_OFFERS_QUERY = "SELECT product_id, vendor_id, price, bundles FROM vendor_products {where} ORDER BY product_id, vendor_id;"
+_INDEX_VENDORS_QUERY = "SELECT id, name, shipping_cost, free_shipping_threshold FROM vendors {where};"
+
+
+class _ProductOffers:
+    """One product's offers: vendor ids, unit prices, sorted bundle arrays and cost tables."""
+
+    __slots__ = ('vendor_ids', 'prices', 'bundles', 'bundle_qty', 'bundle_price', 'table_rows', 'tables')
+
+    def __init__(self, offers, max_quantity):
+        """offers: (vendor_id, price, bundles) rows of one product."""
+        self.vendor_ids = [offer[0] for offer in offers]
+        self.prices = np.array([float(offer[1]) for offer in offers])
+        self.bundles = [offer[2] for offer in offers]
+        usable = [[b for b in bundles or [] if b['quantity'] > 0] for bundles in self.bundles]
+        self.bundle_qty, self.bundle_price = _bundle_matrix(usable)
+        self.table_rows = [row for row, bundles in enumerate(usable) if len(bundles) > 1]
+        self.tables = np.empty((len(self.table_rows), max_quantity + 1))
+        for i, row in enumerate(self.table_rows):
+            self.tables[i] = _optimal_bundle_costs(max_quantity, self.prices[row], usable[row])
+
+    @property
+    def nbytes(self):
+        return self.prices.nbytes + self.bundle_qty.nbytes + self.bundle_price.nbytes + self.tables.nbytes
+
+
+class _PriceView:
+    """
+    All indexed offers in one set of arrays, each product's offers in a
+    contiguous slice, for pricing many products at once. A full load writes
+    every product and leaves spare rows; a reloaded product is then written
+    to unused rows after the last one and its slice repointed, so a change
+    costs O(that product) and threads pricing from the view never see rows
+    being rewritten. The cost tables are referenced, not copied.
+    """
+
+    def __init__(self, products, vendors, max_quantity, spare=0.25):
+        self.max_quantity = max_quantity
+        self.slices = {}
+        self._vendors = vendors
+        total = sum(len(entry.vendor_ids) for entry in products.values())
+        capacity = total + max(64, int(total * spare))
+        depth = max((entry.bundle_qty.shape[1] for entry in products.values()), default=0)
+        self.product_ids = np.empty(capacity, dtype=object)
+        self.vendor_ids = np.empty(capacity, dtype=object)
+        self.bundles = np.empty(capacity, dtype=object)
+        self.prices = np.zeros(capacity)
+        self.bundle_qty = np.zeros((capacity, depth), dtype=np.int64)
+        self.bundle_price = np.zeros((capacity, depth))
+        self.bundle_count = np.zeros(capacity, dtype=np.int64)
+        self.tables = []
+        self.table_of = np.full(capacity, -1, dtype=np.int64)
+        self.table_row = np.zeros(capacity, dtype=np.int64)
+        # (known vendor mask, (name, shipping_cost, threshold) rows), swapped as one.
+        self.vendor_state = (np.zeros(capacity, dtype=bool), np.empty((capacity, 3), dtype=object))
+        self.used = 0
+        self.dead = 0
+        for product_id in sorted(products):
+            self._write(product_id, products[product_id])
+
+    def _write(self, product_id, entry):
+        """Appends a product's offers and points its slice at them. False if they don't fit."""
+        lo, hi = self.used, self.used + len(entry.vendor_ids)
+        width = entry.bundle_qty.shape[1]
+        if hi > len(self.prices) or width > self.bundle_qty.shape[1]:
+            return False
+        self.product_ids[lo:hi] = product_id
+        self.vendor_ids[lo:hi] = entry.vendor_ids
+        for i, bundles in enumerate(entry.bundles):
+            self.bundles[lo + i] = bundles
+        self.prices[lo:hi] = entry.prices
+        self.bundle_qty[lo:hi, :width] = entry.bundle_qty
+        self.bundle_price[lo:hi, :width] = entry.bundle_price
+        self.bundle_count[lo:hi] = (entry.bundle_qty > 0).sum(axis=1)
+        if entry.table_rows:
+            rows = lo + np.asarray(entry.table_rows)
+            self.table_of[rows] = len(self.tables)
+            self.table_row[rows] = np.arange(len(entry.table_rows))
+            self.tables.append(entry.tables)
+        known_vendor, vendor_terms = self.vendor_state
+        self._set_terms(known_vendor, vendor_terms, np.arange(lo, hi))
+        self.used = hi
+        previous = self.slices.get(product_id)
+        self.slices[product_id] = (lo, hi)
+        if previous:
+            self.dead += previous[1] - previous[0]
+        return True
+
+    def _set_terms(self, known_vendor, vendor_terms, rows):
+        terms = [self._vendors.get(vendor_id) for vendor_id in self.vendor_ids[rows]]
+        known_vendor[rows] = [term is not None for term in terms]
+        for row, term in zip(rows, terms):
+            vendor_terms[row] = term if term is not None else (None, None, None)
+
+    def update_product(self, product_id, entry):
+        """
+        Points product_id at its reloaded offers (entry None: it has none).
+        Returns False if the view has no room left and must be rebuilt.
+        """
+        if entry is None:
+            previous = self.slices.pop(product_id, None)
+            if previous:
+                self.dead += previous[1] - previous[0]
+            return True
+        return self._write(product_id, entry)
+
+    def update_vendors(self, vendor_ids):
+        """Re-reads the terms of every offer from vendor_ids into copies, then swaps them in."""
+        known_vendor, vendor_terms = (array.copy() for array in self.vendor_state)
+        rows = np.flatnonzero(np.isin(self.vendor_ids[:self.used], list(vendor_ids)))
+        self._set_terms(known_vendor, vendor_terms, rows)
+        self.vendor_state = (known_vendor, vendor_terms)
+
+    @property
+    def nbytes(self):
+        arrays = (self.prices, self.bundle_qty, self.bundle_price, self.bundle_count,
+                  self.table_of, self.table_row, self.vendor_state[0])
+        return sum(array.nbytes for array in arrays)
+
+    def _optimal_costs(self, rows, quantities):
+        """Exact bundle-packing cost of each selected offer: closed form, table lookup or DP."""
+        prices = self.prices[rows]
+        cost = quantities * prices
+        single = self.bundle_count[rows] == 1
+        size, bundle_price = self.bundle_qty[rows[single], 0], self.bundle_price[rows[single], 0]
+        count = quantities[single] // size
+        cost[single] = np.minimum(cost[single], count * bundle_price + (quantities[single] - count * size) * prices[single])
+
+        tabled = np.flatnonzero((self.table_of[rows] >= 0) & (quantities <= self.max_quantity))
+        for i, table, row, quantity in zip(tabled.tolist(), self.table_of[rows[tabled]].tolist(),
+                                           self.table_row[rows[tabled]].tolist(), quantities[tabled].tolist()):
+            cost[i] = self.tables[table][row, quantity]
+        beyond = np.flatnonzero((self.bundle_count[rows] > 1) & (quantities > self.max_quantity))
+        if len(beyond):
+            cost[beyond], _, _ = _calculate_optimal_offer_costs(quantities[beyond], prices[beyond], self.bundles[rows[beyond]])
+        return cost
+
+    def price(self, quantities, vendor_filter=None):
+        """
+        The offers for {product id: quantity}, in the shape of _load_vendor_offers
+        plus greedy ('cost', 'savings') and exact ('optimal_cost',
+        'optimal_savings') pricing.
+        """
+        found = [(self.slices[product_id], quantity) for product_id, quantity in quantities.items()
+                 if product_id in self.slices]
+        bounds = np.array([bound for bound, _ in found], dtype=np.int64).reshape(-1, 2)
+        counts = bounds[:, 1] - bounds[:, 0]
+        # Row numbers of every offer of every found product, without a Python loop per product.
+        rows = np.arange(counts.sum()) + np.repeat(bounds[:, 0] - (np.cumsum(counts) - counts), counts)
+        amounts = np.repeat(np.array([quantity for _, quantity in found], dtype=np.int64), counts)
+        known_vendor, vendor_terms = self.vendor_state
+        keep = known_vendor[rows]
+        if vendor_filter:
+            keep &= np.isin(self.vendor_ids[rows], list(vendor_filter))
+        rows, amounts = rows[keep], amounts[keep]
+
+        prices = self.prices[rows]
+        cost, non_discounted_cost, savings = _greedy_costs(amounts, prices, self.bundle_qty[rows], self.bundle_price[rows])
+        optimal_cost = self._optimal_costs(rows, amounts)
+        terms = vendor_terms[rows]
+        return pd.DataFrame({
+            'product_id': self.product_ids[rows],
+            'vendor_id': self.vendor_ids[rows],
+            'price': prices,
+            'bundles': self.bundles[rows],
+            'vendor_name': terms[:, 0],
+            'shipping_cost': terms[:, 1],
+            'free_shipping_threshold': terms[:, 2],
+            'cost': cost,
+            'savings': savings,
+            'optimal_cost': optimal_cost,
+            'optimal_savings': non_discounted_cost - optimal_cost,
+        })
+
+
+class _PriceIndex:
+    def __init__(self, max_quantity=PRICE_INDEX_MAX_QUANTITY):
+        self.max_quantity = max_quantity
+        self._lock = threading.Lock()
+        self._products = {}
+        self._vendors = {}
+        self._applied = {}
+        self._horizon = None
+        self._view = None
+        self._stats = {"fullLoads": 0, "productReloads": 0, "vendorReloads": 0, "viewRebuilds": 0, "lastRefreshMs": 0.0}
+
+    def _load_products(self, cur, product_ids=None):
+        where = "WHERE product_id = ANY(%(ids)s)" if product_ids is not None else ""
+        cur.execute(_INDEX_OFFERS_QUERY.format(where=where), {"ids": product_ids})
+        offers = {}
+        for product_id, vendor_id, price, bundles in cur.fetchall():
+            offers.setdefault(product_id, []).append((vendor_id, price, bundles))
+        for product_id in product_ids or []:
+            self._products.pop(product_id, None)
+        for product_id, rows in offers.items():
+            self._products[product_id] = _ProductOffers(rows, self.max_quantity)
+        return len(product_ids) if product_ids is not None else len(offers)
+
+    def _load_vendors(self, cur, vendor_ids=None):
+        where = "WHERE id = ANY(%(ids)s)" if vendor_ids is not None else ""
+        cur.execute(_INDEX_VENDORS_QUERY.format(where=where), {"ids": vendor_ids})
+        for vendor_id in vendor_ids or []:
+            self._vendors.pop(vendor_id, None)
+        for vendor_id, name, shipping_cost, threshold in cur.fetchall():
+            self._vendors[vendor_id] = (name, shipping_cost, threshold)
+
+    def _refresh(self, conn):
+        started = time.perf_counter()
+        cur = conn.cursor()
+        cur.execute(_INDEX_CHANGES_QUERY, {"after": self._horizon})
+        rows = cur.fetchall()
+        changed = {
+            (source, key): xid for _, _, source, key, xid in rows
+            if source is not None and self._applied.get((source, key)) != xid
+        }
+        pruned_through = rows[0][1]
+        vendor_ids = [key for source, key in changed if source == 'vendor']
+        product_ids = [key for source, key in changed if source == 'product']
+        if (self._horizon is None or ('all', '') in changed
+                or (pruned_through is not None and int(pruned_through) >= int(self._horizon))):
+            self._products, self._vendors = {}, {}
+            self._load_vendors(cur)
+            self._load_products(cur)
+            self._view = None
+            self._stats["fullLoads"] += 1
+        elif changed:
+            if vendor_ids:
+                self._load_vendors(cur, vendor_ids)
+                self._stats["vendorReloads"] += len(vendor_ids)
+            if product_ids:
+                self._stats["productReloads"] += self._load_products(cur, product_ids)
+        cur.close()
+
+        self._applied.update(changed)
+        self._horizon = rows[0][0]
+        if self._view is not None and changed:
+            if vendor_ids:
+                self._view.update_vendors(vendor_ids)
+            patched = all(self._view.update_product(product_id, self._products.get(product_id)) for product_id in product_ids)
+            # Rebuilt once it runs out of spare rows or half of it is superseded offers.
+            if not patched or self._view.dead > self._view.used // 2:
+                self._view = None
+        if self._view is None:
+            self._view = _PriceView(self._products, self._vendors, self.max_quantity)
+            self._stats["viewRebuilds"] += 1
+        if changed:
+            self._stats["lastRefreshMs"] = round((time.perf_counter() - started) * 1000, 3)
+
+    def price(self, db_connection, quantities, vendor_filter=None):
+        with self._lock:
+            self._refresh(db_connection)
+            view = self._view
+        return view.price(quantities, vendor_filter)
+
+    def metrics(self):
+        with self._lock:
+            products, view = list(self._products.values()), self._view
+            stats = dict(self._stats)
+        table_bytes = sum(entry.tables.nbytes for entry in products)
+        return {
+            "maxQuantity": self.max_quantity,
+            "products": len(products),
+            "offers": sum(len(entry.vendor_ids) for entry in products),
+            "tabledOffers": sum(len(entry.table_rows) for entry in products),
+            "tableBytes": table_bytes,
+            "arrayBytes": sum(entry.nbytes for entry in products) + (view.nbytes if view is not None else 0),
+            **stats,
+        }
+
+
+_price_index = _PriceIndex()
+
+
+def prune_price_index_changes(conn):
+    """Deletes price index change rows older than PRICE_INDEX_CHANGE_RETENTION seconds. Returns how many."""
+    cur = conn.cursor()
+    cur.execute(_PRUNE_CHANGES_QUERY, {"retention": PRICE_INDEX_CHANGE_RETENTION})
+    row = cur.fetchone()
+    conn.commit()
     cur.close()
-    return best_option
+    return row[0] if row else 0
+
+
+def price_index_metrics():
+    """
+    Size of this process's price index: products, offers and offers with a
+    cost table, the bytes held by the cost tables and by all of its NumPy
+    arrays, and how often it has been (re)loaded.
+    """
+    return _price_index.metrics()
@@ -1,14 +1,19 @@
 import psycopg2.extras
 
-def calculate_orders(current_stock_levels, db_connection):
+from forecasting import load_predictions
+
+def calculate_orders(current_stock_levels, db_connection, location):
     """
     Calculates the amount of each item to order and includes the data
-    used for the calculation in the output.
+    used for the calculation in the output. The target level comes from the
+    location's precomputed demand forecast when one exists, otherwise from the
+    item's static prediction.
     """
     items_to_order = []
+    forecasts = load_predictions(db_connection, location, [item['id'] for item in current_stock_levels])
 
     for item_data in current_stock_levels:
-        prediction = int(item_data['prediction'])
+        prediction = int(forecasts.get(item_data['id'], item_data['prediction']))
         remaining_stock = int(item_data['remaining_stock'])
         min_stock = int(item_data['min_stock'])
         max_stock = int(item_data['max_stock'])
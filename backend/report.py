@@ -1,20 +1,11 @@
-def generate_stock_alerts(products, db_connection=None):
+from alerts import evaluate
+from forecasting import load_usage_rates
+
+def generate_stock_alerts(products, db_connection=None, location=None):
     """
     Checks current stock against min/max levels and generates alerts from a given product list.
-    This function no longer needs a database connection as all data is passed in.
+    With a database connection and the products' location, products projected to
+    run out within a few days at their forecast usage rate are flagged too (see alerts.evaluate).
     """
-    alerts = []
-    for product in products:
-        # The fix is here: Use the 'remaining_stock' key (snake_case)
-        # which matches the database column name.
-        if product['remaining_stock'] < product['min_stock']:
-            alerts.append({
-                "type": "low",
-                "message": f"{product['name']} is below minimum stock ({product['remaining_stock']}/{product['min_stock']})."
-            })
-        elif product['remaining_stock'] > product['max_stock']:
-            alerts.append({
-                "type": "high",
-                "message": f"{product['name']} is over maximum stock ({product['remaining_stock']}/{product['max_stock']})."
-            })
-    return alerts
+    usage_rates = load_usage_rates(db_connection, location, [p['id'] for p in products]) if db_connection else None
+    return evaluate(products, usage_rates)
@@ -0,0 +1,229 @@
+# scheduler.py
+# Background precomputation of the dashboard's expensive results.
+#
+# Jobs run on APScheduler, either inside each web worker (SCHEDULER_ENABLED=1)
+# or as a sidecar process (python scheduler.py). Results go to the
+# precomputed_results table so every worker can serve them, and each job takes
+# a Postgres advisory lock so that only one process runs it at a time no
+# matter how many schedulers are up. The dashboard and forecast jobs work
+# through the locations one at a time, each in its own transaction, and the
+# partitions job keeps every location's monthly movement partitions ahead of
+# the calendar. The prune jobs drop old price index change rows and expired
+# ingest batch idempotency keys. Writes that change stock clear the affected
+# location's results in their own transaction and ask for an early re-run.
+
+import os, sys, threading, time, traceback
+from datetime import date, datetime
+
+import psycopg2.extras
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from db import pooled_connection
+from ledger import fetch_stock_status, ledger_version
+from prediction import calculate_orders
+from report import generate_stock_alerts
+import alerts
+import forecasting
+import locations
+import movements
+import optimization
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "0") == "1"
+DASHBOARD_INTERVAL = int(os.getenv("SCHEDULER_DASHBOARD_INTERVAL", "60"))
+FORECAST_INTERVAL = int(os.getenv("SCHEDULER_FORECAST_INTERVAL", "3600"))
+PARTITIONS_INTERVAL = int(os.getenv("SCHEDULER_PARTITIONS_INTERVAL", "86400"))
+PRUNE_INTERVAL = int(os.getenv("SCHEDULER_PRUNE_INTERVAL", "3600"))
+# Tries at a location before leaving its results to the on-demand path.
+PRECOMPUTE_ATTEMPTS = int(os.getenv("SCHEDULER_PRECOMPUTE_ATTEMPTS", "3"))
+
+# Keys of results derived from current stock levels, followed by "<location>:".
+STOCK_RESULT_PREFIXES = ('stock-status:', 'reorder-suggestions:')
+
+
+def stock_status_key(location, record_date):
+    return f"stock-status:{location}:{record_date}"
+
+def reorder_suggestions_key(location, record_date):
+    return f"reorder-suggestions:{location}:{record_date}"
+
+
+def precompute_location(conn, location):
+    """
+    Today's stock status with alerts at one location, and the reorder
+    suggestions derived from it. Alert changes since the last run are recorded
+    for the push endpoints.
+    """
+    today = date.today().isoformat()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    for _ in range(PRECOMPUTE_ATTEMPTS):
+        # Everything is read from one snapshot without locks, so writers carry
+        # on while we compute. Writers bump the ledger version and clear these
+        # results before committing; storing only if the version is still the
+        # one our snapshot saw means a write that landed meanwhile can't leave
+        # a stale result behind. The version row is locked just for the store.
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        version = ledger_version(cur, location)
+        products = fetch_stock_status(cur, location, today)
+        stock_alerts = generate_stock_alerts(products, conn, location)
+        suggestions = calculate_orders(products, conn, location)
+        conn.commit()
+
+        if ledger_version(cur, location, lock=True) != version:
+            conn.rollback()
+            continue
+        alerts.sync(cur, location, stock_alerts)
+        store_result(cur, stock_status_key(location, today), {"stockItems": products, "alerts": stock_alerts})
+        store_result(cur, reorder_suggestions_key(location, today), suggestions)
+        conn.commit()
+        break
+    cur.close()
+
+def precompute_dashboard(conn):
+    """Runs precompute_location for every location, then drops results from earlier days."""
+    cur = conn.cursor()
+    location_ids = locations.location_ids(cur)
+    # precompute_location starts its own transactions.
+    conn.commit()
+    for location in location_ids:
+        precompute_location(conn, location)
+    cur.execute("DELETE FROM precomputed_results WHERE computed_for < CURRENT_DATE;")
+    conn.commit()
+    cur.close()
+
+def refit_forecasts(conn):
+    """Folds new days into every location's demand forecasts, then refreshes the suggestions that use them."""
+    cur = conn.cursor()
+    for location in locations.location_ids(cur):
+        forecasting.refit(conn, location)
+    cur.close()
+    precompute_dashboard(conn)
+
+
+JOBS = {
+    "dashboard": (precompute_dashboard, DASHBOARD_INTERVAL),
+    "forecasts": (refit_forecasts, FORECAST_INTERVAL),
+    "partitions": (locations.maintain, PARTITIONS_INTERVAL),
+    "price-index-prune": (optimization.prune_price_index_changes, PRUNE_INTERVAL),
+    "ingest-batches-prune": (movements.expire_batches, PRUNE_INTERVAL),
+}
+
+
+def store_result(cur, key, payload):
+    cur.execute("""
+        INSERT INTO precomputed_results (key, payload, computed_for, computed_at)
+        VALUES (%s, %s, CURRENT_DATE, CURRENT_TIMESTAMP)
+        ON CONFLICT (key) DO UPDATE SET payload = EXCLUDED.payload,
+            computed_for = EXCLUDED.computed_for, computed_at = EXCLUDED.computed_at;
+    """, (key, psycopg2.extras.Json(payload)))
+
+def read_result(cur, key):
+    """Returns the stored payload for key, or None if it hasn't been computed (or was invalidated)."""
+    cur.execute("SELECT payload FROM precomputed_results WHERE key = %s;", (key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def invalidate_stock_results(cur, location):
+    """Drops the location's results derived from stock levels. Call inside the writing transaction."""
+    cur.execute(
+        "DELETE FROM precomputed_results WHERE " + " OR ".join(["starts_with(key, %s)"] * len(STOCK_RESULT_PREFIXES)) + ";",
+        [f"{prefix}{location}:" for prefix in STOCK_RESULT_PREFIXES]
+    )
+
+
+def run_job(job_id):
+    """Runs one job under its advisory lock and records the outcome in scheduled_job_runs."""
+    func, _ = JOBS[job_id]
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s));", ("job:" + job_id,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return
+        try:
+            cur.execute("""
+                INSERT INTO scheduled_job_runs (job_id, last_started_at) VALUES (%s, CURRENT_TIMESTAMP)
+                ON CONFLICT (job_id) DO UPDATE SET last_started_at = EXCLUDED.last_started_at;
+            """, (job_id,))
+            conn.commit()
+            started = time.monotonic()
+            error = None
+            try:
+                func(conn)
+            except Exception:
+                conn.rollback()
+                error = traceback.format_exc(limit=5)
+                print(f"Error running job {job_id}: {error}")
+            cur.execute("""
+                UPDATE scheduled_job_runs
+                SET last_finished_at = CURRENT_TIMESTAMP, last_duration_ms = %s,
+                    last_status = %s, last_error = %s,
+                    runs = runs + 1, failures = failures + %s
+                WHERE job_id = %s;
+            """, (round((time.monotonic() - started) * 1000, 3), 'failed' if error else 'ok', error, int(bool(error)), job_id))
+            conn.commit()
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", ("job:" + job_id,))
+            conn.commit()
+            cur.close()
+
+
+def fetch_job_runs(cur):
+    cur.execute("SELECT * FROM scheduled_job_runs ORDER BY job_id;")
+    runs = [dict(row) for row in cur.fetchall()]
+    if _scheduler is not None:
+        for run in runs:
+            job = _scheduler.get_job(run['job_id'])
+            run['next_run_at'] = job.next_run_time if job else None
+    return runs
+
+
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+def _add_jobs(scheduler):
+    for job_id, (_, interval) in JOBS.items():
+        scheduler.add_job(
+            run_job, 'interval', args=[job_id], id=job_id, seconds=interval,
+            next_run_time=datetime.now(), coalesce=True, max_instances=1
+        )
+
+def start():
+    """
+    Starts the in-process scheduler for this worker when SCHEDULER_ENABLED=1.
+    Safe to call on every request; like the connection pool it is per PID, so
+    workers forked from a preloaded app each start their own thread.
+    """
+    global _scheduler, _scheduler_pid
+    if not SCHEDULER_ENABLED or _scheduler_pid == os.getpid():
+        return
+    with _scheduler_lock:
+        if _scheduler_pid != os.getpid():
+            _scheduler = BackgroundScheduler(daemon=True)
+            _add_jobs(_scheduler)
+            _scheduler.start()
+            _scheduler_pid = os.getpid()
+
+def shutdown():
+    """Stops this worker's in-process scheduler without waiting for a running job."""
+    global _scheduler, _scheduler_pid
+    with _scheduler_lock:
+        if _scheduler is not None and _scheduler_pid == os.getpid():
+            _scheduler.shutdown(wait=False)
+        _scheduler = None
+        _scheduler_pid = None
+
+def request_refresh(job_id="dashboard"):
+    """Moves a job's next run forward to now after a write (no-op without an in-process scheduler)."""
+    if _scheduler is not None and _scheduler.get_job(job_id) is not None:
+        _scheduler.modify_job(job_id, next_run_time=datetime.now())
+
+
+if __name__ == '__main__':
+    sidecar = BlockingScheduler()
+    _add_jobs(sidecar)
+    try:
+        sidecar.start()
+    except (KeyboardInterrupt, SystemExit):
+        sys.exit(0)
@@ -1,178 +1,402 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-import psycopg2, os, json
+import psycopg2, os, json, math
 import psycopg2.extras
 from datetime import date, timedelta
 
+import alerts
+import approvals
+import cache
+import db
+import instrumentation
+import locations
+from db import get_db_connection
 from prediction import calculate_orders
-from optimization import find_best_vendor_for_item
+from optimization import find_best_vendors, optimize_basket, price_index_metrics
 from report import generate_stock_alerts
+from ledger import InvalidSeriesQuery, apply_movements, fetch_stock_series, fetch_stock_status, parse_series_args
+import scheduler
+import spending
+from movements import (
+    InvalidBatch, InvalidLogQuery, claim_batch, complete_batch, fetch_log_page,
+    EXPORT_MIMETYPES, insert_movements, is_paginated, parse_batch, stream_log, validate_batch
+)
 
 app = Flask(__name__)
-CORS(app)
+# The movement log's next-page cursor is a response header the browser must be allowed to read.
+CORS(app, expose_headers=['X-Next-Cursor'])
+db.init_app(app)
+instrumentation.init_app(app)
 
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASS = os.getenv("DB_PASS")
-DB_HOST = os.getenv("DB_HOST")
-DB_PORT = "5432"
+@app.before_request
+def start_scheduler():
+    scheduler.start()
+    approvals.start_worker()
 
-def get_db_connection():
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT)
-    return conn
+INVOICE_LOGS_QUERY = """
+    SELECT l.new_status, l.changed_by, l.change_date
+    FROM invoice_status_logs l
+    JOIN invoices i ON i.id = l.invoice_id
+    WHERE l.invoice_id = %s AND i.location_id = %s
+    ORDER BY l.change_date DESC;
+"""
+
+def _location():
+    """The location this request is scoped to (see locations.from_request)."""
+    return locations.from_request(request.args, request.headers, get_db_connection)
+
+@app.route('/locations', methods=['GET'])
+def get_locations():
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        rows = locations.fetch_locations(cur)
+        cur.close()
+        return jsonify(rows)
+    except Exception as e:
+        print(f"Error fetching locations: {e}")
+        return jsonify({"error": "Failed to fetch locations"}), 500
 
 @app.route('/daily-spending', methods=['GET'])
 def get_daily_spending():
     """Calculates the total spending on approved invoices for today."""
     try:
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
         today = date.today()
         query = """
-            SELECT invoice_date, SUM(total_cost) as total_spent
-            FROM invoices
-            WHERE status = 'Approved' AND invoice_date = %s
-            GROUP BY invoice_date;
+            SELECT spend_date as invoice_date, SUM(spend) as total_spent
+            FROM spending_daily_vendor
+            WHERE location_id = %s AND spend_date = %s
+            GROUP BY spend_date;
         """
-        cur.execute(query, (today,))
+        cur.execute(query, (location, today))
         spending_data = [dict(row) for row in cur.fetchall()]
         
         cur.close()
-        conn.close()
         return jsonify(spending_data)
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error fetching daily spending: {e}")
         return jsonify({"error": "Failed to fetch daily spending"}), 500
 
+@app.route('/spending-by-vendor', methods=['GET'])
+def get_spending_by_vendor():
+    """
+    Spend, bundle savings and shipping paid/saved per vendor for each day (or
+    interval=week / interval=month) from `from` to `to`, default the last 30
+    days. vendorId limits it to one vendor. Reads only the daily rollups.
+    """
+    try:
+        from_date, to_date, interval = spending.parse_range_args(request.args)
+        location = _location()
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        rows = spending.fetch_vendor_spending(cur, location, from_date, to_date, interval, request.args.get('vendorId'))
+        cur.close()
+        return jsonify(rows)
+    except (spending.InvalidSpendingQuery, locations.InvalidLocation) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error fetching spending by vendor: {e}")
+        return jsonify({"error": "Failed to fetch spending by vendor"}), 500
+
+@app.route('/spending-by-product', methods=['GET'])
+def get_spending_by_product():
+    """Quantity bought, spend and bundle savings per product and period; same parameters as /spending-by-vendor, with productId."""
+    try:
+        from_date, to_date, interval = spending.parse_range_args(request.args)
+        location = _location()
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        rows = spending.fetch_product_spending(cur, location, from_date, to_date, interval, request.args.get('productId'))
+        cur.close()
+        return jsonify(rows)
+    except (spending.InvalidSpendingQuery, locations.InvalidLocation) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error fetching spending by product: {e}")
+        return jsonify({"error": "Failed to fetch spending by product"}), 500
+
 @app.route('/daily-spending-breakdown', methods=['GET'])
 def get_daily_spending_breakdown():
-    """Fetches all items from approved invoices for a specific date."""
+    """
+    What was spent at the location on one date, read from the spending
+    rollups: per vendor (invoices, item cost, bundle savings, shipping paid
+    and saved) and per product (quantity, cost, bundle savings).
+    """
     invoice_date_str = request.args.get('date')
     if not invoice_date_str:
         return jsonify({"error": "A date parameter is required"}), 400
     try:
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        query = """
-            SELECT 
-                i.items, 
-                v.name as vendor_name, 
-                i.total_cost,
-                -- Calculate shipping cost based on free shipping threshold
-                CASE 
-                    WHEN (i.total_cost - v.shipping_cost) >= v.free_shipping_threshold THEN 0 
-                    ELSE v.shipping_cost 
-                END as shipping_cost
-            FROM invoices i
-            JOIN vendors v ON i.vendor_id = v.id
-            WHERE i.status = 'Approved' AND i.invoice_date = %s;
-        """
-        cur.execute(query, (invoice_date_str,))
-        
-        breakdown = []
-        for row in cur.fetchall():
-            # Calculate bundle savings for each item
-            items_with_savings = []
-            for item in row['items']:
-                # This is a simplified savings calculation. A more robust solution
-                # would store the actual savings per item in the invoice JSON.
-                non_discounted_cost = item['quantity'] * item['price']
-                savings = non_discounted_cost - item['cost']
-                item['savings'] = savings
-                items_with_savings.append(item)
-
-            breakdown.append({
-                "vendorName": row['vendor_name'],
-                "items": items_with_savings,
-                "totalCost": float(row['total_cost']),
-                "shippingCost": float(row['shipping_cost'])
-            })
-            
+        vendors = spending.fetch_vendor_spending(cur, location, invoice_date_str, invoice_date_str)
+        products = spending.fetch_product_spending(cur, location, invoice_date_str, invoice_date_str)
         cur.close()
-        conn.close()
-        return jsonify(breakdown)
+        return jsonify({
+            "vendors": [{
+                "vendorId": row['vendor_id'],
+                "vendorName": row['vendor_name'],
+                "invoices": row['invoices'],
+                "itemsCost": row['items_cost'],
+                "bundleSavings": row['bundle_savings'],
+                "shippingCost": row['shipping_paid'],
+                "shippingSaved": row['shipping_saved'],
+                "totalCost": row['spend'],
+            } for row in vendors],
+            "products": [{
+                "id": row['product_id'],
+                "name": row['product_name'],
+                "unit": row['unit'],
+                "quantity": row['quantity'],
+                "cost": row['spend'],
+                "savings": row['bundle_savings'],
+            } for row in products],
+        })
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error fetching daily spending breakdown: {e}")
         return jsonify({"error": "Failed to fetch spending breakdown"}), 500
 
+def _stock_status_key():
+    try:
+        return cache.stock_status_key(_location(), request.args.get('date'))
+    except locations.InvalidLocation:
+        return None
+
 @app.route('/stock-status', methods=['GET'])
+@cache.cached(_stock_status_key)
 def get_stock_status():
     record_date_str = request.args.get('date', date.today().isoformat())
     
     try:
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        query = """
-            SELECT 
-                p.id, p.name, p.unit, p.image_url, 
-                p.min_stock, p.max_stock, p.prediction,
-                COALESCE((SELECT SUM(m.quantity) FROM stock_movements m WHERE m.product_id = p.id AND m.movement_date::date <= %s), 0) as remaining_stock,
-                COALESCE((SELECT SUM(m.quantity) FROM stock_movements m WHERE m.product_id = p.id AND m.movement_type = 'IN' AND m.movement_date::date = %s), 0) as daily_in,
-                COALESCE((SELECT SUM(m.quantity) FROM stock_movements m WHERE m.product_id = p.id AND m.movement_type != 'IN' AND m.movement_date::date = %s), 0) as daily_out
-            FROM products p
-            ORDER BY p.name;
-        """
-        cur.execute(query, (record_date_str, record_date_str, record_date_str))
 
-        products = [dict(row) for row in cur.fetchall()]
+        if record_date_str == date.today().isoformat():
+            precomputed = scheduler.read_result(cur, scheduler.stock_status_key(location, record_date_str))
+            if precomputed is not None:
+                cur.close()
+                return jsonify(precomputed)
+
+        products = fetch_stock_status(cur, location, record_date_str)
         cur.close()
-        alerts = generate_stock_alerts(products)
-        conn.close()
+        # Stockout projections only make sense from today's levels.
+        alerts = generate_stock_alerts(products, conn if record_date_str == date.today().isoformat() else None, location)
         
         return jsonify({"stockItems": products, "alerts": alerts})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error fetching stock status: {e}")
         return jsonify({"error": "Failed to fetch stock status"}), 500
 
+def _stock_series_key():
+    try:
+        return cache.stock_series_key(_location(), *parse_series_args(request.args))
+    except (InvalidSeriesQuery, locations.InvalidLocation):
+        return None
+
+@app.route('/stock-series', methods=['GET'])
+@cache.cached(_stock_series_key)
+def get_stock_series():
+    """
+    Opening, in, out and closing stock per product for every day from `from`
+    to `to` (default the last 90 days), as one array per field. interval=week
+    or interval=month sums the days into buckets; products=id1,id2 limits the
+    products.
+    """
+    try:
+        from_date, to_date, interval, product_ids = parse_series_args(request.args)
+        location = _location()
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        series = fetch_stock_series(cur, location, from_date, to_date, interval, product_ids)
+        cur.close()
+        return jsonify(series)
+    except (InvalidSeriesQuery, locations.InvalidLocation) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error fetching stock series: {e}")
+        return jsonify({"error": "Failed to fetch stock series"}), 500
+
+@app.route('/alerts', methods=['GET'])
+def get_alerts():
+    """Alerts firing as of the last dashboard run, and the event id to pass to /alert-events as `after`."""
+    try:
+        location = _location()
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        active, last_event_id = alerts.fetch_active(cur, location)
+        cur.close()
+        return jsonify({"alerts": active, "lastEventId": last_event_id})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error fetching alerts: {e}")
+        return jsonify({"error": "Failed to fetch alerts"}), 500
+
+@app.route('/alert-events', methods=['GET'])
+def get_alert_events():
+    """
+    Alerts raised or cleared after event `after` (default: the latest event).
+    With wait=<seconds> the request is held until there is at least one, up
+    to ALERT_MAX_WAIT_SECONDS, so dashboards can long-poll this instead of
+    /stock-status.
+    """
+    try:
+        after = request.args.get('after')
+        wait = float(request.args.get('wait', 0))
+        location = _location()
+        if after is None:
+            cur = get_db_connection().cursor()
+            after = alerts.latest_event_id(cur)
+            cur.close()
+        db.release_db_connection()
+        events = alerts.wait_for_events(location, int(after), wait)
+        return jsonify({"events": events, "lastEventId": events[-1]['id'] if events else int(after)})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
+    except ValueError:
+        return jsonify({"error": "Invalid 'after' or 'wait'"}), 400
+    except Exception as e:
+        print(f"Error fetching alert events: {e}")
+        return jsonify({"error": "Failed to fetch alert events"}), 500
+
 @app.route('/record-movement', methods=['POST'])
 def record_movement():
     try:
         data = request.json
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute(
-            "INSERT INTO stock_movements (product_id, quantity, movement_type, description, total_cost) VALUES (%s, %s, %s, %s, %s);",
-            (data['productId'], data['quantity'], data['movementType'], data['description'], data.get('totalCost', 0))
+            "INSERT INTO stock_movements (location_id, product_id, quantity, movement_type, description, total_cost) VALUES (%s, %s, %s, %s, %s, %s) RETURNING product_id, quantity, movement_type, movement_date::date;",
+            (location, data['productId'], data['quantity'], data['movementType'], data['description'], data.get('totalCost', 0))
         )
+        movements = cur.fetchall()
+        apply_movements(cur, location, movements)
+        scheduler.invalidate_stock_results(cur, location)
         conn.commit()
         cur.close()
-        conn.close()
+        cache.invalidate_stock_status(location, movements)
+        scheduler.request_refresh()
         return jsonify({"success": True})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error recording stock movement: {e}")
         return jsonify({"error": "Failed to record movement"}), 500
 
+@app.route('/record-movements', methods=['POST'])
+def record_movements():
+    """
+    Bulk version of /record-movement for POS and scanner uploads. Accepts a JSON
+    array or NDJSON (Content-Type: application/x-ndjson) of movements, writes
+    every valid one in a single transaction and reports the rejected ones by
+    index. Retrying with the same Idempotency-Key header (at the same location)
+    replays the first response instead of writing the batch twice.
+    """
+    try:
+        records, errors = parse_batch(request.get_data(as_text=True), request.content_type)
+        location = _location()
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            idempotency_key = f"{location}:{idempotency_key}"
+        conn = get_db_connection()
+        cur = conn.cursor()
+
+        if idempotency_key:
+            previous = claim_batch(cur, idempotency_key)
+            if previous is not None:
+                conn.rollback()
+                cur.close()
+                response = jsonify(previous)
+                response.headers['Idempotent-Replay'] = 'true'
+                return response
+
+        rows, row_errors = validate_batch(cur, records)
+        movements = insert_movements(cur, location, rows)
+        apply_movements(cur, location, movements)
+        if movements:
+            scheduler.invalidate_stock_results(cur, location)
+        result = {
+            "success": True,
+            "inserted": len(movements),
+            "rejected": sorted(errors + row_errors, key=lambda error: error['index'])
+        }
+        if idempotency_key:
+            complete_batch(cur, idempotency_key, result)
+        conn.commit()
+        cur.close()
+        if movements:
+            cache.invalidate_stock_status(location, movements)
+            scheduler.request_refresh()
+        return jsonify(result)
+    except (InvalidBatch, locations.InvalidLocation) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error recording stock movements: {e}")
+        return jsonify({"error": "Failed to record movements"}), 500
+
+@app.route('/reorder-suggestions', methods=['GET'])
+def get_reorder_suggestions():
+    """Items to reorder today, served from the background job's result when available."""
+    try:
+        location = _location()
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        today = date.today().isoformat()
+        suggestions = scheduler.read_result(cur, scheduler.reorder_suggestions_key(location, today))
+        if suggestions is None:
+            suggestions = calculate_orders(fetch_stock_status(cur, location, today), conn, location)
+        cur.close()
+        return jsonify(suggestions)
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error fetching reorder suggestions: {e}")
+        return jsonify({"error": "Failed to fetch reorder suggestions"}), 500
+
 @app.route('/movement-log', methods=['GET'])
 def get_movement_log():
+    """
+    Newest-first movement log, filterable by productId, type, from and to.
+    With limit or cursor, pages are cut at `limit` and the next page's cursor
+    is returned in the X-Next-Cursor header. Without either, the whole
+    filtered log is streamed as a JSON array in batches (or as NDJSON or CSV
+    with format=ndjson / format=csv).
+    """
     try:
+        location = _location()
+        export_format = request.args.get('format', 'json')
+        if export_format in ('ndjson', 'csv') or not is_paginated(request.args):
+            export_format = export_format if export_format in EXPORT_MIMETYPES else 'json'
+            return Response(stream_log(location, request.args, export_format), mimetype=EXPORT_MIMETYPES[export_format])
+
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        query = """
-            SELECT 
-                m.quantity, 
-                m.movement_type, 
-                m.description, 
-                m.movement_date, 
-                m.total_cost,
-                p.name as product_name,
-                i.modified_by as approved_by
-            FROM stock_movements m
-            JOIN products p ON m.product_id = p.id
-            LEFT JOIN invoices i ON m.description LIKE 'Received from % order #' || i.id
-            ORDER BY m.movement_date DESC;
-        """
-        cur.execute(query)
-        logs = [dict(row) for row in cur.fetchall()]
+        logs, next_cursor = fetch_log_page(cur, location, request.args)
         cur.close()
-        conn.close()
-        return jsonify(logs)
+        response = jsonify(logs)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    except (InvalidLogQuery, locations.InvalidLocation) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error fetching movement log: {e}")
         return jsonify({"error": "Failed to fetch movement log"}), 500
 
 @app.route('/vendors', methods=['GET'])
+@cache.cached(lambda: "vendors")
 def get_vendors():
     try:
         conn = get_db_connection()
@@ -180,13 +404,13 @@ def get_vendors():
         cur.execute('SELECT id, name FROM vendors ORDER BY name;')
         vendors = [dict(row) for row in cur.fetchall()]
         cur.close()
-        conn.close()
         return jsonify(vendors)
     except Exception as e:
         print(f"Error fetching vendors: {e}")
         return jsonify({"error": "Failed to fetch vendors"}), 500
 
 @app.route('/vendor-products/<vendor_id>', methods=['GET'])
+@cache.cached(lambda vendor_id: f"vendor-products:{vendor_id}")
 def get_vendor_products(vendor_id):
     """Fetches all products sold by a specific vendor."""
     try:
@@ -202,7 +426,6 @@ def get_vendor_products(vendor_id):
         cur.execute(query, (vendor_id,))
         products = [dict(row) for row in cur.fetchall()]
         cur.close()
-        conn.close()
         return jsonify(products)
     except Exception as e:
         print(f"Error fetching vendor products: {e}")
@@ -214,24 +437,30 @@ def generate_invoice():
         data = request.json
         current_stock_levels = data['stockItems']
         vendor_filter = data.get('vendorFilter', [])
+        optimization_mode = data.get('optimizationMode', 'greedy')
+        time_budget = data.get('timeBudgetMs')
+        if time_budget is not None and (
+                not isinstance(time_budget, (int, float)) or isinstance(time_budget, bool)
+                or not math.isfinite(time_budget) or time_budget <= 0):
+            return jsonify({"error": "timeBudgetMs must be a positive number of milliseconds"}), 400
+        location = _location()
         conn = get_db_connection()
-        items_to_order = calculate_orders(current_stock_levels, conn)
+        items_to_order = calculate_orders(current_stock_levels, conn, location)
+        if optimization_mode == 'basket':
+            best_options, optimization_summary = optimize_basket(
+                items_to_order, conn, vendor_filter,
+                time_budget=time_budget / 1000 if time_budget is not None else None
+            )
+        else:
+            best_options = find_best_vendors(items_to_order, conn, vendor_filter)
         vendor_orders = {}
         for item in items_to_order:
-            best_option = find_best_vendor_for_item(item, conn, vendor_filter)
+            best_option = best_options.get(item['id'])
             if best_option and best_option['vendor_id']:
                 vendor_id = best_option['vendor_id']
                 if vendor_id not in vendor_orders:
-                    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                    cur.execute('SELECT name, shipping_cost, free_shipping_threshold FROM vendors WHERE id = %s;', (vendor_id,))
-                    vendor_info = dict(cur.fetchone())
-                    cur.close()
-                    vendor_orders[vendor_id] = {"vendorName": vendor_info['name'], "items": [], "subtotal": 0, "bundleSavings": 0, "shippingCost": float(vendor_info['shipping_cost']), "originalShippingCost": float(vendor_info['shipping_cost']), "freeShippingThreshold": float(vendor_info['free_shipping_threshold'])}
-                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                cur.execute('SELECT price, bundles FROM vendor_products WHERE vendor_id = %s AND product_id = %s;', (vendor_id, item['id']))
-                pricing_info = dict(cur.fetchone())
-                cur.close()
-                vendor_orders[vendor_id]['items'].append({"id": item['id'], "name": item['name'], "unit": item['unit'], "quantity": item['order_amount'], "cost": float(best_option['cost']), "price": float(pricing_info['price']), "bundles": pricing_info['bundles'], "prediction": item['prediction'], "remaining_stock": item['remaining_stock']})
+                    vendor_orders[vendor_id] = {"vendorName": best_option['vendor_name'], "items": [], "subtotal": 0, "bundleSavings": 0, "shippingCost": float(best_option['shipping_cost']), "originalShippingCost": float(best_option['shipping_cost']), "freeShippingThreshold": float(best_option['free_shipping_threshold'])}
+                vendor_orders[vendor_id]['items'].append({"id": item['id'], "name": item['name'], "unit": item['unit'], "quantity": item['order_amount'], "cost": float(best_option['cost']), "price": float(best_option['price']), "bundles": best_option['bundles'], "prediction": item['prediction'], "remaining_stock": item['remaining_stock']})
                 vendor_orders[vendor_id]['bundleSavings'] += float(best_option['savings'])
         total_cost = 0; total_bundle_savings = 0; total_shipping_savings = 0
         for vendor_id, order in vendor_orders.items():
@@ -242,8 +471,11 @@ def generate_invoice():
             total_cost += order['subtotal'] + order['shippingCost']
             total_bundle_savings += order['bundleSavings']
         invoice = {"vendorOrders": vendor_orders, "totalCost": total_cost, "totalBundleSavings": total_bundle_savings, "totalShippingSavings": total_shipping_savings, "totalSavings": total_bundle_savings + total_shipping_savings}
-        conn.close()
+        if optimization_mode == 'basket':
+            invoice["optimization"] = optimization_summary
         return jsonify({"invoice": invoice})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error generating invoice: {e}")
         return jsonify({"error": "Failed to generate invoice"}), 500
@@ -252,12 +484,13 @@ def generate_invoice():
 def save_invoice():
     try:
         data = request.json
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
         cur.execute(
-            "INSERT INTO invoices (vendor_id, status, modified_by, items, total_cost) VALUES (%s, %s, %s, %s, %s) RETURNING id;",
-            (data['vendorId'], data['status'], data['modifiedBy'], json.dumps(data['items']), data['totalCost'])
+            "INSERT INTO invoices (location_id, vendor_id, status, modified_by, items, total_cost) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;",
+            (location, data['vendorId'], data['status'], data['modifiedBy'], json.dumps(data['items']), data['totalCost'])
         )
         new_invoice_id = cur.fetchone()['id']
 
@@ -266,20 +499,19 @@ def save_invoice():
             (new_invoice_id, 'N/A', data['status'], data['modifiedBy'])
         )
 
+        stock_application = None
         if data['status'] == 'Approved':
-            cur.execute("SELECT name FROM vendors WHERE id = %s;", (data['vendorId'],))
-            vendor_name = cur.fetchone()['name']
-            for item in data['items']:
-                description = f"Received from {vendor_name} order #{new_invoice_id}"
-                cur.execute(
-                    "INSERT INTO stock_movements (product_id, quantity, movement_type, description, total_cost) VALUES (%s, %s, 'IN', %s, %s);", 
-                    (item['id'], item['quantity'], description, item['cost'])
-                )
+            spending.apply_invoices(cur, [new_invoice_id])
+            stock_application = approvals.enqueue(cur, location, new_invoice_id, data['items'])
         
         conn.commit()
         cur.close()
-        conn.close()
-        return jsonify({"success": True, "invoiceId": new_invoice_id})
+        cache.invalidate(f"invoice-logs:{location}:{new_invoice_id}")
+        if stock_application:
+            approvals.wake()
+        return jsonify({"success": True, "invoiceId": new_invoice_id, "stockApplication": stock_application})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error saving invoice: {e}")
         return jsonify({"error": "Failed to save invoice"}), 500
@@ -288,18 +520,28 @@ def save_invoice():
 def update_invoice(invoice_id):
     try:
         data = request.json
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        cur.execute("SELECT status FROM invoices WHERE id = %s;", (invoice_id,))
+        # Locked so a concurrent update can't change the row between taking
+        # its old spending out of the rollups and putting the new one in. NO
+        # KEY UPDATE still lets the apply worker insert movements referencing
+        # the invoice; with FOR UPDATE, re-queueing an invoice the worker holds
+        # would deadlock with it.
+        cur.execute("SELECT status FROM invoices WHERE id = %s AND location_id = %s FOR NO KEY UPDATE;", (invoice_id, location))
         result = cur.fetchone()
         if not result: return jsonify({"error": "Invoice not found"}), 404
         old_status = result['status']
 
+        if old_status == 'Approved':
+            spending.apply_invoices(cur, [invoice_id], -1)
         cur.execute(
             "UPDATE invoices SET status = %s, modified_by = %s, items = %s, total_cost = %s WHERE id = %s;",
             (data['status'], data['modifiedBy'], json.dumps(data['items']), data['totalCost'], invoice_id)
         )
+        if data['status'] == 'Approved':
+            spending.apply_invoices(cur, [invoice_id])
 
         if old_status != data['status']:
             cur.execute(
@@ -307,37 +549,129 @@ def update_invoice(invoice_id):
                 (invoice_id, old_status, data['status'], data['modifiedBy'])
             )
 
-        if data['status'] == 'Approved' and old_status != 'Approved':
-            cur.execute("SELECT name FROM vendors WHERE id = %s;", (data['vendorId'],))
-            vendor_name = cur.fetchone()['name']
-            for item in data['items']:
-                description = f"Received from {vendor_name} order #{invoice_id}"
-                cur.execute(
-                    "INSERT INTO stock_movements (product_id, quantity, movement_type, description, total_cost) VALUES (%s, %s, 'IN', %s, %s);", 
-                    (item['id'], item['quantity'], description, item['cost'])
-                )
+        # Receiving the stock is queued, not done here. Concurrent approvals
+        # queue one after another under the row lock above, each with the
+        # items it saved, and enqueue leaves an invoice whose stock was
+        # already received alone, so it is received once.
+        stock_application = None
+        if data['status'] == 'Approved':
+            stock_application = approvals.enqueue(cur, location, invoice_id, data['items'])
         
         conn.commit()
         cur.close()
-        conn.close()
-        return jsonify({"success": True})
+        cache.invalidate(f"invoice-logs:{location}:{invoice_id}")
+        if stock_application:
+            approvals.wake()
+        return jsonify({"success": True, "stockApplication": stock_application})
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error updating invoice: {e}")
         return jsonify({"error": "Failed to update invoice"}), 500
 
+@app.route('/invoice-stock/<int:invoice_id>', methods=['GET'])
+def get_invoice_stock(invoice_id):
+    """
+    Whether an approved invoice's items have been received into stock yet:
+    status is 'queued', 'applied' or 'failed' (see approvals.py).
+    """
+    try:
+        location = _location()
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        stock_application = approvals.fetch_status(cur, location, invoice_id)
+        cur.close()
+        if stock_application is None:
+            return jsonify({"error": "Invoice has not been approved"}), 404
+        return jsonify(stock_application)
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error fetching invoice stock status: {e}")
+        return jsonify({"error": "Failed to fetch invoice stock status"}), 500
+
+def _invoice_logs_key(invoice_id):
+    try:
+        return f"invoice-logs:{_location()}:{invoice_id}"
+    except locations.InvalidLocation:
+        return None
+
 @app.route('/invoice-logs/<int:invoice_id>', methods=['GET'])
+@cache.cached(_invoice_logs_key)
 def get_invoice_logs(invoice_id):
     try:
+        location = _location()
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute("SELECT new_status, changed_by, change_date FROM invoice_status_logs WHERE invoice_id = %s ORDER BY change_date DESC;", (invoice_id,))
+        cur.execute(INVOICE_LOGS_QUERY, (invoice_id, location))
         logs = [dict(row) for row in cur.fetchall()]
         cur.close()
-        conn.close()
         return jsonify(logs)
+    except locations.InvalidLocation as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error fetching invoice logs: {e}")
         return jsonify({"error": "Failed to fetch invoice logs"}), 500
 
+@app.route('/jobs', methods=['GET'])
+def get_jobs():
+    """Last run, duration and failure counts of the background jobs."""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        runs = scheduler.fetch_job_runs(cur)
+        cur.close()
+        return jsonify(runs)
+    except Exception as e:
+        print(f"Error fetching job runs: {e}")
+        return jsonify({"error": "Failed to fetch job runs"}), 500
+
+@app.route('/pool-stats', methods=['GET'])
+def get_pool_stats():
+    """Reports connection pool usage for this worker process."""
+    return jsonify({"pid": os.getpid(), **db.get_pool().metrics()})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics for this worker process: per-route latency and database work, pool and cache usage."""
+    pool = db.get_pool().metrics()
+    cache_stats = cache.metrics()
+    price_stats = price_index_metrics()
+    extra = {
+        "db_pool_connections_in_use": ("gauge", "Pooled connections checked out.", pool['inUse']),
+        "db_pool_connections_idle": ("gauge", "Pooled connections idle.", pool['idle']),
+        "db_pool_checkout_failures_total": ("counter", "Checkouts that timed out or failed.", pool['checkoutFailures']),
+        "db_pool_wait_seconds_total": ("counter", "Time spent waiting for a pooled connection.", pool['waitTimeTotalMs'] / 1000),
+        "response_cache_hits_total": ("counter", "Response cache hits.", cache_stats['hits']),
+        "response_cache_misses_total": ("counter", "Response cache misses.", cache_stats['misses']),
+        "response_cache_evictions_total": ("counter", "Response cache evictions.", cache_stats['evictions']),
+        "price_index_table_bytes": ("gauge", "Bytes held by the price index's bundle cost tables.", price_stats['tableBytes']),
+        "price_index_array_bytes": ("gauge", "Bytes held by all of the price index's arrays.", price_stats['arrayBytes']),
+        "price_index_product_reloads_total": ("counter", "Products reloaded into the price index after a change.", price_stats['productReloads']),
+    }
+    return Response(instrumentation.render_metrics(extra), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile', methods=['GET'])
+def get_profile():
+    """
+    Stacks sampled by the profiler (PROFILER_ENABLED=1) in collapsed format,
+    for flamegraph.pl or speedscope. ?route= limits them to one route and
+    ?reset=1 clears the samples after reading.
+    """
+    if not instrumentation.PROFILER_ENABLED:
+        return jsonify({"error": "Profiler is disabled (set PROFILER_ENABLED=1)"}), 404
+    stacks = instrumentation.collapsed_stacks(request.args.get('route'), request.args.get('reset') == '1')
+    return Response(stacks, mimetype='text/plain')
+
+@app.route('/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """Response cache hit/miss, 304 and eviction counters for this worker process."""
+    return jsonify({"pid": os.getpid(), **cache.metrics()})
+
+@app.route('/price-index-stats', methods=['GET'])
+def get_price_index_stats():
+    """Size and reload counters of this worker process's vendor price index."""
+    return jsonify({"pid": os.getpid(), **price_index_metrics()})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
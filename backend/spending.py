@@ -0,0 +1,250 @@
+# spending.py
+# Daily spending rollups per vendor and per product, kept next to invoices.
+#
+# An approved invoice adds its spend, bundle savings and shipping paid/saved to
+# spending_daily_vendor and, line by line, to spending_daily_product for its
+# location and invoice_date. save_invoice and update_invoice call apply_invoices() in the
+# same transaction as the invoice write: +1 once an invoice is Approved, and
+# -1 before an Approved invoice is changed, so the rollups always equal the
+# aggregate over the currently Approved invoices. Spending reports read only
+# the rollups, never the invoices' items JSON.
+#
+# Shipping follows the invoice generator's rule: an invoice paid the vendor's
+# shipping_cost unless its total without shipping reached the
+# free_shipping_threshold, in which case that cost counts as saved.
+#
+# Usage:
+#   python spending.py rebuild   # recompute the rollups from approved invoices
+#   python spending.py verify    # report rows where the two disagree
+
+import argparse, sys
+from datetime import date, timedelta
+
+import psycopg2.extras
+
+from db import pooled_connection
+
+INTERVALS = ('day', 'week', 'month')
+DEFAULT_RANGE_DAYS = 30
+
+# Per invoice: totals over its item lines, and the shipping it paid or saved.
+# {invoice_filter} picks the invoices.
+_INVOICE_TOTALS = """
+    SELECT i.id, i.location_id, i.invoice_date, i.vendor_id, i.total_cost as spend,
+           COALESCE(l.items_cost, 0) as items_cost,
+           COALESCE(l.bundle_savings, 0) as bundle_savings,
+           CASE WHEN (i.total_cost - v.shipping_cost) >= v.free_shipping_threshold THEN 0 ELSE v.shipping_cost END as shipping_paid,
+           CASE WHEN (i.total_cost - v.shipping_cost) >= v.free_shipping_threshold THEN v.shipping_cost ELSE 0 END as shipping_saved
+    FROM invoices i
+    JOIN vendors v ON v.id = i.vendor_id
+    LEFT JOIN LATERAL (
+        SELECT SUM(line.cost) as items_cost, SUM(line.quantity * line.price - line.cost) as bundle_savings
+        FROM jsonb_to_recordset(i.items) as line(quantity numeric, price numeric, cost numeric)
+    ) l ON true
+    {invoice_filter}
+"""
+
+_INVOICE_LINES = """
+    SELECT i.id, i.location_id, i.invoice_date, line.id as product_id,
+           COALESCE(line.quantity, 0) as quantity,
+           COALESCE(line.cost, 0) as spend,
+           COALESCE(line.quantity * line.price - line.cost, 0) as bundle_savings
+    FROM invoices i
+    CROSS JOIN LATERAL jsonb_to_recordset(i.items) as line(id varchar, quantity numeric, price numeric, cost numeric)
+    JOIN products p ON p.id = line.id
+    {invoice_filter}
+"""
+
+_VENDOR_ROLLUP = f"""
+    SELECT location_id, invoice_date as spend_date, vendor_id, %(sign)s * count(*) as invoices,
+           %(sign)s * SUM(spend) as spend, %(sign)s * SUM(items_cost) as items_cost,
+           %(sign)s * SUM(bundle_savings) as bundle_savings,
+           %(sign)s * SUM(shipping_paid) as shipping_paid, %(sign)s * SUM(shipping_saved) as shipping_saved
+    FROM ({_INVOICE_TOTALS}) t
+    GROUP BY 1, 2, 3
+"""
+
+_PRODUCT_ROLLUP = f"""
+    SELECT location_id, invoice_date as spend_date, product_id, %(sign)s * count(*) as lines,
+           %(sign)s * SUM(quantity) as quantity, %(sign)s * SUM(spend) as spend,
+           %(sign)s * SUM(bundle_savings) as bundle_savings
+    FROM ({_INVOICE_LINES}) l
+    GROUP BY 1, 2, 3
+"""
+
+_APPLY_VENDOR = f"""
+    INSERT INTO spending_daily_vendor (location_id, spend_date, vendor_id, invoices, spend, items_cost, bundle_savings, shipping_paid, shipping_saved)
+    {_VENDOR_ROLLUP}
+    ON CONFLICT (location_id, spend_date, vendor_id) DO UPDATE SET
+        invoices = spending_daily_vendor.invoices + EXCLUDED.invoices,
+        spend = spending_daily_vendor.spend + EXCLUDED.spend,
+        items_cost = spending_daily_vendor.items_cost + EXCLUDED.items_cost,
+        bundle_savings = spending_daily_vendor.bundle_savings + EXCLUDED.bundle_savings,
+        shipping_paid = spending_daily_vendor.shipping_paid + EXCLUDED.shipping_paid,
+        shipping_saved = spending_daily_vendor.shipping_saved + EXCLUDED.shipping_saved
+    {{returning}};
+"""
+
+_APPLY_PRODUCT = f"""
+    INSERT INTO spending_daily_product (location_id, spend_date, product_id, lines, quantity, spend, bundle_savings)
+    {_PRODUCT_ROLLUP}
+    ON CONFLICT (location_id, spend_date, product_id) DO UPDATE SET
+        lines = spending_daily_product.lines + EXCLUDED.lines,
+        quantity = spending_daily_product.quantity + EXCLUDED.quantity,
+        spend = spending_daily_product.spend + EXCLUDED.spend,
+        bundle_savings = spending_daily_product.bundle_savings + EXCLUDED.bundle_savings
+    {{returning}};
+"""
+
+_BY_IDS = "WHERE i.id = ANY(%(invoice_ids)s)"
+_APPROVED = "WHERE i.status = 'Approved'"
+
+
+class InvalidSpendingQuery(ValueError):
+    """Raised for malformed spending report parameters."""
+
+
+def apply_invoices(cur, invoice_ids, sign=1):
+    """
+    Adds (sign=1) or removes (sign=-1) the given invoices' spending in the
+    rollups, computed from their rows as they are now. Call with -1 before
+    changing an Approved invoice and with 1 once an invoice is Approved.
+    """
+    params = {"invoice_ids": list(invoice_ids), "sign": sign}
+    for table, query, key, count in (
+        ("spending_daily_vendor", _APPLY_VENDOR, "vendor_id", "invoices"),
+        ("spending_daily_product", _APPLY_PRODUCT, "product_id", "lines"),
+    ):
+        returning = f"RETURNING location_id, spend_date, {key}, {count}" if sign < 0 else ""
+        cur.execute(query.format(invoice_filter=_BY_IDS, returning=returning), params)
+        if sign < 0:
+            # Days whose last approved invoice went away shouldn't linger as
+            # zero rows; only the keys just decremented are checked.
+            emptied = [row[:3] for row in cur.fetchall() if row[3] == 0]
+            if emptied:
+                location_ids, days, keys = zip(*emptied)
+                cur.execute(f"""
+                    DELETE FROM {table}
+                    WHERE (location_id, spend_date, {key}) IN (
+                        SELECT * FROM unnest(%s::varchar[], %s::date[], %s::varchar[])
+                    ) AND {count} = 0;
+                """, (list(location_ids), list(days), list(keys)))
+
+
+def parse_range_args(args):
+    """
+    Reads from, to (inclusive dates, default the last 30 days) and interval
+    (day, week or month).
+
+    Returns:
+        tuple: (from_date, to_date, interval)
+    """
+    try:
+        to_date = date.fromisoformat(args['to']) if args.get('to') else date.today()
+        from_date = date.fromisoformat(args['from']) if args.get('from') else to_date - timedelta(days=DEFAULT_RANGE_DAYS - 1)
+    except ValueError as e:
+        raise InvalidSpendingQuery("Invalid 'from' or 'to' date") from e
+    if from_date > to_date:
+        raise InvalidSpendingQuery("'from' is after 'to'")
+    interval = args.get('interval', 'day')
+    if interval not in INTERVALS:
+        raise InvalidSpendingQuery(f"'interval' must be one of {', '.join(INTERVALS)}")
+    return from_date, to_date, interval
+
+
+def fetch_vendor_spending(cur, location, from_date, to_date, interval='day', vendor_id=None):
+    """Spend, bundle savings and shipping paid/saved at the location per vendor and period, newest period first."""
+    cur.execute(f"""
+        SELECT date_trunc(%(interval)s, s.spend_date)::date as period, s.vendor_id, v.name as vendor_name,
+               SUM(s.invoices)::int as invoices, SUM(s.spend)::float8 as spend,
+               SUM(s.items_cost)::float8 as items_cost, SUM(s.bundle_savings)::float8 as bundle_savings,
+               SUM(s.shipping_paid)::float8 as shipping_paid, SUM(s.shipping_saved)::float8 as shipping_saved
+        FROM spending_daily_vendor s
+        JOIN vendors v ON v.id = s.vendor_id
+        WHERE s.location_id = %(location)s AND s.spend_date BETWEEN %(from)s AND %(to)s
+        {"AND s.vendor_id = %(vendor_id)s" if vendor_id else ""}
+        GROUP BY 1, 2, 3
+        ORDER BY 1 DESC, spend DESC;
+    """, {"location": location, "interval": interval, "from": from_date, "to": to_date, "vendor_id": vendor_id})
+    return [dict(row) for row in cur.fetchall()]
+
+
+def fetch_product_spending(cur, location, from_date, to_date, interval='day', product_id=None):
+    """Quantity bought, spend and bundle savings at the location per product and period, newest period first."""
+    cur.execute(f"""
+        SELECT date_trunc(%(interval)s, s.spend_date)::date as period, s.product_id, p.name as product_name, p.unit,
+               SUM(s.lines)::int as lines, SUM(s.quantity)::float8 as quantity,
+               SUM(s.spend)::float8 as spend, SUM(s.bundle_savings)::float8 as bundle_savings
+        FROM spending_daily_product s
+        JOIN products p ON p.id = s.product_id
+        WHERE s.location_id = %(location)s AND s.spend_date BETWEEN %(from)s AND %(to)s
+        {"AND s.product_id = %(product_id)s" if product_id else ""}
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1 DESC, spend DESC;
+    """, {"location": location, "interval": interval, "from": from_date, "to": to_date, "product_id": product_id})
+    return [dict(row) for row in cur.fetchall()]
+
+
+def rebuild(conn):
+    """Recomputes both rollup tables from the approved invoices."""
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE invoices IN SHARE MODE;")
+    cur.execute("TRUNCATE spending_daily_vendor, spending_daily_product;")
+    cur.execute(_APPLY_VENDOR.format(invoice_filter=_APPROVED, returning=""), {"sign": 1})
+    vendor_rows = cur.rowcount
+    cur.execute(_APPLY_PRODUCT.format(invoice_filter=_APPROVED, returning=""), {"sign": 1})
+    product_rows = cur.rowcount
+    conn.commit()
+    cur.close()
+    return vendor_rows, product_rows
+
+
+def verify(conn):
+    """Returns the rollup rows that disagree with an aggregate over the approved invoices."""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    mismatches = []
+    for table, key, query in (
+        ("spending_daily_vendor", "vendor_id", _VENDOR_ROLLUP),
+        ("spending_daily_product", "product_id", _PRODUCT_ROLLUP),
+    ):
+        keys = ("location_id", "spend_date", key)
+        join = " AND ".join(f"r.{k} = e.{k}" for k in keys)
+        values = "".join(f" - '{k}'" for k in keys)
+        cur.execute(f"""
+            SELECT '{table}' as rollup, COALESCE(e.location_id, r.location_id) as location_id,
+                   COALESCE(e.spend_date, r.spend_date) as spend_date,
+                   COALESCE(e.{key}, r.{key}) as key,
+                   to_jsonb(e){values} as expected,
+                   to_jsonb(r){values} as rollup_row
+            FROM ({query.format(invoice_filter=_APPROVED)}) e
+            FULL OUTER JOIN {table} r ON {join}
+            WHERE e.spend_date IS NULL OR r.spend_date IS NULL
+               OR (to_jsonb(e){values}) != (to_jsonb(r){values})
+            ORDER BY 2, 3, 4;
+        """, {"sign": 1})
+        mismatches.extend(dict(row) for row in cur.fetchall())
+    cur.close()
+    conn.rollback()
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the daily spending rollups.")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    args = parser.parse_args(argv)
+
+    with pooled_connection() as conn:
+        if args.command == "rebuild":
+            vendor_rows, product_rows = rebuild(conn)
+            print(f"Rebuilt spending rollups: {vendor_rows} vendor-days, {product_rows} product-days.")
+            return 0
+        mismatches = verify(conn)
+        for row in mismatches:
+            print(f"{row['rollup']} {row['location_id']} {row['spend_date']} {row['key']}: "
+                  f"rollup {row['rollup_row']} (expected {row['expected']})")
+        print(f"{len(mismatches)} mismatched rows.")
+        return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# stress_approvals.py
+# Fires many concurrent approvals at the same invoices and checks that each
+# invoice was received into stock exactly once.
+#
+# Creates --invoices Pending invoices through /save-invoice, then sends
+# --approvals simultaneous /update-invoice approvals for each of them from
+# --concurrency threads, waits for /invoice-stock to report every invoice
+# applied, and compares the database against the invoices: one IN movement per
+# item, one Pending -> Approved log entry per invoice, and a stock increase per
+# product equal to the quantities ordered. One more invoice is approved with an
+# item whose product doesn't exist, and once its stock application has failed
+# it is corrected through /update-invoice; it must then be received with the
+# corrected items only. Adds real invoices and stock, so run
+# it against a scratch database (see datagen.py) with nothing else writing.
+# The invoices are saved at --location (DEFAULT_LOCATION if not given).
+#
+# Usage:
+#   python server.py
+#   python stress_approvals.py http://localhost:5001 --invoices 50 --approvals 8 --concurrency 64
+#   python stress_approvals.py http://localhost:5001 --location store2
+
+import argparse, json, sys, threading, time
+import urllib.error, urllib.parse, urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+import psycopg2.extras
+
+from db import pooled_connection
+from ledger import fetch_stock_status
+from locations import DEFAULT_LOCATION
+
+
+def _request(base_url, path, body=None, timeout=30.0):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _pick_items(cur, items_per_invoice, rng):
+    """A vendor with enough products, and that many of its products at their listed price."""
+    cur.execute("""
+        SELECT vendor_id FROM vendor_products GROUP BY vendor_id HAVING count(*) >= %s ORDER BY vendor_id LIMIT 1;
+    """, (items_per_invoice,))
+    vendor_id = cur.fetchone()[0]
+    cur.execute("SELECT product_id, price FROM vendor_products WHERE vendor_id = %s ORDER BY product_id;", (vendor_id,))
+    offers = cur.fetchall()
+    return vendor_id, [offers[i] for i in rng.choice(len(offers), size=items_per_invoice, replace=False)]
+
+
+def _wait_for_status(base_url, invoice_id, query, statuses, wait):
+    """Polls /invoice-stock until the invoice's status is one of statuses (or wait runs out); returns the last one."""
+    deadline = time.monotonic() + wait
+    while True:
+        status = _request(base_url, f"/invoice-stock/{invoice_id}{query}")['status']
+        if status in statuses or time.monotonic() >= deadline:
+            return status
+        time.sleep(0.2)
+
+
+def _stock_levels(cur, location, product_ids):
+    levels = {row['id']: row['remaining_stock'] for row in fetch_stock_status(cur, location, date.today().isoformat())}
+    return {product_id: levels[product_id] for product_id in product_ids}
+
+
+def run(base_url, invoices=50, approvals=8, concurrency=64, items_per_invoice=5, wait=60.0, seed=0,
+        location=DEFAULT_LOCATION):
+    base_url = base_url.rstrip('/')
+    rng = np.random.default_rng(seed)
+    with pooled_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        vendor_id, offers = _pick_items(cur, items_per_invoice, rng)
+        before = _stock_levels(cur, location, [product_id for product_id, _ in offers])
+        cur.close()
+        conn.rollback()
+
+    query = "?" + urllib.parse.urlencode({"location": location})
+    bodies = {}
+    for _ in range(invoices):
+        items = [
+            {"id": product_id, "quantity": int(quantity), "price": float(price), "cost": round(int(quantity) * float(price), 2)}
+            for (product_id, price), quantity in zip(offers, rng.integers(1, 20, size=len(offers)))
+        ]
+        body = {"vendorId": vendor_id, "status": "Pending", "modifiedBy": "stress", "items": items,
+                "totalCost": round(sum(item['cost'] for item in items), 2)}
+        invoice_id = _request(base_url, "/save-invoice" + query, body)['invoiceId']
+        bodies[invoice_id] = dict(body, status="Approved")
+
+    # An approved invoice whose application fails, then is corrected.
+    broken = dict(body, status="Approved", items=body['items'] + [
+        {"id": "stress-missing-product", "quantity": 1, "price": 1.0, "cost": 1.0}
+    ])
+    broken['totalCost'] = round(sum(item['cost'] for item in broken['items']), 2)
+    corrected_id = _request(base_url, "/save-invoice" + query, broken)['invoiceId']
+    failed_status = _wait_for_status(base_url, corrected_id, query, ('failed', 'applied'), wait)
+    corrected = dict(body, status="Approved")
+    _request(base_url, f"/update-invoice/{corrected_id}{query}", corrected)
+
+    # Each invoice's approvals are adjacent, so they run concurrently with each other.
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def approve(invoice_id):
+        try:
+            _request(base_url, f"/update-invoice/{invoice_id}{query}", bodies[invoice_id])
+        except (urllib.error.URLError, OSError) as e:
+            with lock:
+                errors[type(e).__name__] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(approve, [invoice_id for invoice_id in bodies for _ in range(approvals)]))
+    approve_seconds = time.monotonic() - started
+    bodies[corrected_id] = corrected
+
+    pending = set(bodies)
+    statuses = {}
+    deadline = time.monotonic() + wait
+    while pending and time.monotonic() < deadline:
+        for invoice_id in list(pending):
+            statuses[invoice_id] = _request(base_url, f"/invoice-stock/{invoice_id}{query}")['status']
+            if statuses[invoice_id] != 'queued':
+                pending.discard(invoice_id)
+        if pending:
+            time.sleep(0.2)
+    applied_seconds = time.monotonic() - started
+
+    ids = list(bodies)
+    with pooled_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            SELECT invoice_id, count(*) as movements, SUM(quantity) as quantity
+            FROM stock_movements WHERE invoice_id = ANY(%s) GROUP BY invoice_id;
+        """, (ids,))
+        moved = {row['invoice_id']: (row['movements'], row['quantity']) for row in cur.fetchall()}
+        cur.execute("""
+            SELECT invoice_id, count(*) as approvals FROM invoice_status_logs
+            WHERE invoice_id = ANY(%s) AND new_status = 'Approved' GROUP BY invoice_id;
+        """, (ids,))
+        logged = {row['invoice_id']: row['approvals'] for row in cur.fetchall()}
+        after = _stock_levels(cur, location, before)
+        cur.close()
+        conn.rollback()
+
+    expected_stock = defaultdict(int)
+    problems = []
+    if failed_status != 'failed':
+        problems.append(f"invoice {corrected_id}: stock application {failed_status} before correction, expected failed")
+    for invoice_id, body in bodies.items():
+        expected = (len(body['items']), sum(item['quantity'] for item in body['items']))
+        if moved.get(invoice_id, (0, 0)) != expected:
+            problems.append(f"invoice {invoice_id}: movements {moved.get(invoice_id, (0, 0))}, expected {expected}")
+        if logged.get(invoice_id, 0) != 1:
+            problems.append(f"invoice {invoice_id}: {logged.get(invoice_id, 0)} approval log entries")
+        if statuses.get(invoice_id) != 'applied':
+            problems.append(f"invoice {invoice_id}: stock application {statuses.get(invoice_id)}")
+        for item in body['items']:
+            expected_stock[item['id']] += item['quantity']
+    for product_id, quantity in expected_stock.items():
+        if after[product_id] - before[product_id] != quantity:
+            problems.append(f"product {product_id}: stock rose by {after[product_id] - before[product_id]}, expected {quantity}")
+
+    return {
+        "invoices": invoices,
+        "approvalRequests": invoices * approvals,
+        "requestErrors": dict(errors),
+        "approveSeconds": round(approve_seconds, 3),
+        "allAppliedSeconds": round(applied_seconds, 3),
+        "problems": problems,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that concurrent invoice approvals receive stock exactly once.")
+    parser.add_argument("base_url", help="e.g. http://localhost:5001")
+    parser.add_argument("--invoices", type=int, default=50)
+    parser.add_argument("--approvals", type=int, default=8, help="concurrent approvals per invoice")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--items", type=int, default=5, help="items per invoice")
+    parser.add_argument("--wait", type=float, default=60.0, help="seconds to wait for the stock to be applied")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--location", default=DEFAULT_LOCATION, help="store the invoices are saved at")
+    args = parser.parse_args(argv)
+
+    report = run(args.base_url, args.invoices, args.approvals, args.concurrency, args.items, args.wait, args.seed,
+                 args.location)
+    print(json.dumps(report, indent=2))
+    return 1 if report["problems"] or report["requestErrors"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -240,7 +240,7 @@ export default function App() {
          <div className="absolute top-16 right-4 mt-2 w-80 bg-white rounded-lg shadow-xl p-4 z-50">
             <h3 className="font-bold mb-2">Notifications</h3>
             {alerts.length > 0 ? (
-            <ul className="space-y-2">{alerts.map((alert, index) => <li key={index} className="text-sm text-gray-700"><span className={alert.type === 'low' ? 'text-red-600' : 'text-blue-600'}>● </span>{alert.message}</li>)}</ul>
+            <ul className="space-y-2">{alerts.map((alert, index) => <li key={index} className="text-sm text-gray-700"><span className={alert.type === 'high' ? 'text-blue-600' : 'text-red-600'}>● </span>{alert.message}</li>)}</ul>
             ) : (
             <p className="text-sm text-gray-500">No new alerts.</p>
             )}
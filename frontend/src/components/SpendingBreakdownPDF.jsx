@@ -1,11 +1,11 @@
 import React from 'react';
 
 const SpendingBreakdownPDF = ({ breakdownData, date }) => {
-  if (!breakdownData || breakdownData.length === 0) {
+  if (!breakdownData || breakdownData.vendors.length === 0) {
     return <div className="p-8">No spending data available for this date.</div>;
   }
 
-  const grandTotal = breakdownData.reduce((sum, vendorOrder) => sum + vendorOrder.totalCost, 0);
+  const grandTotal = breakdownData.vendors.reduce((sum, vendor) => sum + vendor.totalCost, 0);
 
   return (
     <div className="p-8 bg-white text-gray-800 font-sans">
@@ -14,48 +14,68 @@ const SpendingBreakdownPDF = ({ breakdownData, date }) => {
         <p className="text-lg text-gray-600">Date: {new Date(date).toLocaleDateString()}</p>
       </header>
 
-      {breakdownData.map((vendorOrder, index) => (
-        <section key={index} className="mb-8">
-          <h2 className="text-2xl font-bold text-gray-700 mb-3">{vendorOrder.vendorName}</h2>
-          <table className="w-full text-left">
-            <thead className="bg-gray-100">
-              <tr>
-                <th className="p-3 font-bold">ITEM</th>
-                <th className="p-3 font-bold text-center">QTY</th>
-                <th className="p-3 font-bold text-right">TOTAL COST</th>
+      <section className="mb-8">
+        <h2 className="text-2xl font-bold text-gray-700 mb-3">Vendors</h2>
+        <table className="w-full text-left">
+          <thead className="bg-gray-100">
+            <tr>
+              <th className="p-3 font-bold">VENDOR</th>
+              <th className="p-3 font-bold text-center">INVOICES</th>
+              <th className="p-3 font-bold text-right">SUBTOTAL</th>
+              <th className="p-3 font-bold text-right">SHIPPING</th>
+              <th className="p-3 font-bold text-right">TOTAL COST</th>
+            </tr>
+          </thead>
+          <tbody>
+            {breakdownData.vendors.map(vendor => (
+              <tr key={vendor.vendorId} className="border-b">
+                <td className="p-3">
+                  {vendor.vendorName}
+                  {vendor.bundleSavings > 0 && (
+                    <span className="text-xs text-green-600 ml-2">(Bundle Savings: ${vendor.bundleSavings.toFixed(2)})</span>
+                  )}
+                </td>
+                <td className="p-3 text-center">{vendor.invoices}</td>
+                <td className="p-3 text-right">${(vendor.totalCost - vendor.shippingCost).toFixed(2)}</td>
+                <td className="p-3 text-right">
+                  ${vendor.shippingCost.toFixed(2)}
+                  {vendor.shippingSaved > 0 && (
+                    <span className="text-xs text-green-600 ml-2">(Saved: ${vendor.shippingSaved.toFixed(2)})</span>
+                  )}
+                </td>
+                <td className="p-3 text-right">${vendor.totalCost.toFixed(2)}</td>
               </tr>
-            </thead>
-            <tbody>
-              {vendorOrder.items.map(item => (
-                <tr key={item.id} className="border-b">
-                  <td className="p-3">
-                    {item.name}
-                    {item.savings > 0 && (
-                      <span className="text-xs text-green-600 ml-2">(Bundle Savings: ${item.savings.toFixed(2)})</span>
-                    )}
-                  </td>
-                  <td className="p-3 text-center">{item.quantity} {item.unit}</td>
-                  <td className="p-3 text-right">${item.cost.toFixed(2)}</td>
-                </tr>
-              ))}
-            </tbody>
-            <tfoot>
-              <tr className="font-bold">
-                <td colSpan="2" className="p-3 text-right">Subtotal:</td>
-                <td className="p-3 text-right">${(vendorOrder.totalCost - vendorOrder.shippingCost).toFixed(2)}</td>
-              </tr>
-              <tr>
-                <td colSpan="2" className="p-3 text-right">Shipping:</td>
-                <td className="p-3 text-right">${vendorOrder.shippingCost.toFixed(2)}</td>
-              </tr>
-              <tr className="font-bold text-lg border-t-2">
-                <td colSpan="2" className="p-3 text-right">Vendor Total:</td>
-                <td className="p-3 text-right">${vendorOrder.totalCost.toFixed(2)}</td>
+            ))}
+          </tbody>
+        </table>
+      </section>
+
+      <section className="mb-8">
+        <h2 className="text-2xl font-bold text-gray-700 mb-3">Items</h2>
+        <table className="w-full text-left">
+          <thead className="bg-gray-100">
+            <tr>
+              <th className="p-3 font-bold">ITEM</th>
+              <th className="p-3 font-bold text-center">QTY</th>
+              <th className="p-3 font-bold text-right">TOTAL COST</th>
+            </tr>
+          </thead>
+          <tbody>
+            {breakdownData.products.map(item => (
+              <tr key={item.id} className="border-b">
+                <td className="p-3">
+                  {item.name}
+                  {item.savings > 0 && (
+                    <span className="text-xs text-green-600 ml-2">(Bundle Savings: ${item.savings.toFixed(2)})</span>
+                  )}
+                </td>
+                <td className="p-3 text-center">{item.quantity} {item.unit}</td>
+                <td className="p-3 text-right">${item.cost.toFixed(2)}</td>
               </tr>
-            </tfoot>
-          </table>
-        </section>
-      ))}
+            ))}
+          </tbody>
+        </table>
+      </section>
 
       <section className="mt-12 text-right">
         <div className="w-1/2 ml-auto text-2xl font-bold">